@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+# Similitud coseno mínima para considerar dos preguntas "la misma".
+ANSWER_CACHE_THRESHOLD = float(os.getenv("LOLA_ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("LOLA_ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("LOLA_ANSWER_CACHE_MAX_ENTRIES", "500"))
+
+
+class SemanticAnswerCache:
+    """
+    In-memory cache of final answers, matched by query-embedding similarity.
+
+    Each entry is scoped by the tool that produced it and by the knowledge base
+    version it was computed against, so an answer is never served after the
+    documents change. Entries expire after `ttl_seconds`, and the least recently
+    used ones are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # id -> (herramienta, versión, embedding, respuesta, creado)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _expire(self, now):
+        expired = [entry_id for entry_id, entry in self._entries.items() if now - entry[4] > self.ttl_seconds]
+        for entry_id in expired:
+            del self._entries[entry_id]
+
+    def get(self, query_embedding, kb_version, tool=None):
+        """
+        Returns `(tool, answer)` of the most similar cached question for this knowledge
+        base version (and `tool`, if given), or None if none reaches the threshold.
+        """
+        if self.max_entries <= 0:
+            return None
+        query_vector = self._normalize(query_embedding)
+        with self._lock:
+            self._expire(time.monotonic())
+            candidates = [(entry_id, entry) for entry_id, entry in self._entries.items()
+                          if entry[1] == kb_version and (tool is None or entry[0] == tool)]
+            best_id, best_similarity = None, self.threshold
+            if candidates:
+                similarities = np.stack([entry[2] for _, entry in candidates]) @ query_vector
+                index = int(np.argmax(similarities))
+                if similarities[index] >= best_similarity:
+                    best_id, best_similarity = candidates[index][0], float(similarities[index])
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            entry = self._entries[best_id]
+            return entry[0], entry[3]
+
+    def put(self, query_embedding, kb_version, tool, answer):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # Las respuestas de versiones anteriores ya no se pueden servir: se liberan.
+            for entry_id in [entry_id for entry_id, entry in self._entries.items() if entry[1] != kb_version]:
+                del self._entries[entry_id]
+            self._entries[self._next_id] = (tool, kb_version, self._normalize(query_embedding), answer, now)
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+            }
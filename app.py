@@ -1,7 +1,10 @@
+import threading
+from itertools import chain
 import streamlit as st
 from lola_main_agent import LolaAgent
 # We need to import the specific writing tool function to call it directly
 from lola_tools import perform_document_writing
+from rate_limiter import is_rate_limit_error, get_rate_limiter
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -15,8 +18,9 @@ st.set_page_config(
 def load_lola_agent():
     print("Iniciando Lola Agent por primera vez para la sesión de Streamlit...")
     agent = LolaAgent()
-    agent.populate_knowledge_base()
-    print("Base de conocimiento poblada. Lola está lista.")
+    # La ingesta corre en segundo plano: la base persistente ya responde mientras se sincroniza.
+    threading.Thread(target=agent.populate_knowledge_base, name="lola-populate", daemon=True).start()
+    print("Sincronización de la base de conocimiento iniciada en segundo plano. Lola está lista.")
     return agent
 
 lola = load_lola_agent()
@@ -26,6 +30,28 @@ lola = load_lola_agent()
 with st.sidebar:
     st.header("Acciones del Agente")
     st.markdown("Usa este botón para forzar una sincronización con Google Drive.")
+
+    progress = lola.get_ingest_progress()
+    if progress['status'] == 'running':
+        st.info(
+            f"Indexando documentos: {progress['files_processed']}/{progress['files_total']} archivos, "
+            f"{progress['chunks_written']} fragmentos escritos."
+        )
+        if progress['files_total']:
+            st.progress(progress['files_processed'] / progress['files_total'])
+    elif progress['status'] == 'done':
+        st.caption(
+            f"Última sincronización: {progress['files_processed']} archivos procesados, "
+            f"{progress['files_failed']} con errores, {progress['chunks_written']} fragmentos escritos."
+        )
+
+    limiter_stats = get_rate_limiter().stats()
+    if limiter_stats['calls']:
+        st.caption(
+            f"Cola de Gemini: {limiter_stats['queue_depth']} en espera, {limiter_stats['active']} en curso; "
+            f"espera p50 {limiter_stats['wait_p50']:.1f}s, p95 {limiter_stats['wait_p95']:.1f}s; "
+            f"{limiter_stats['rate_limited']} límites de cuota."
+        )
     
     if st.button("🔄 Sincronizar Base de Conocimiento"):
         with st.spinner("Buscando nuevos documentos y actualizaciones..."):
@@ -82,22 +108,23 @@ if prompt := st.chat_input("¿Qué te gustaría saber?"):
 
     # Get and display Lola's response
     with st.chat_message("assistant"):
-        with st.spinner("Lola está pensando..."):
-            
-            # --- NEW: ROBUST ERROR HANDLING FOR THE UI ---
-            try:
-                # The regular chat input still uses the main answer_query router
-                response = lola.answer_query(prompt)
-            except Exception as e:
-                if "429" in str(e) and "quota" in str(e).lower():
-                    print(f"❌ Límite de tasa de Gemini alcanzado en la app. Error: {e}")
-                    response = "He recibido demasiadas peticiones en este momento. Por favor, espera un minuto antes de volver a preguntar."
-                else:
-                    print(f"❌ Error inesperado en la app: {e}")
-                    response = "Lo siento, tuve un problema inesperado al procesar tu petición."
-            # --- END OF NEW ERROR HANDLING ---
-
-        st.markdown(response)
+        # --- NEW: ROBUST ERROR HANDLING FOR THE UI ---
+        try:
+            # The regular chat input uses the main router, streaming the answer as it is generated.
+            # The spinner only covers routing and retrieval, until the first fragment arrives.
+            with st.spinner("Lola está pensando..."):
+                stream = lola.answer_query_stream(prompt)
+                first_chunk = next(stream, "")
+            response = st.write_stream(chain([first_chunk], stream))
+        except Exception as e:
+            if is_rate_limit_error(e):
+                print(f"❌ Límite de tasa de Gemini alcanzado en la app. Error: {e}")
+                response = "He recibido demasiadas peticiones en este momento. Por favor, espera un minuto antes de volver a preguntar."
+            else:
+                print(f"❌ Error inesperado en la app: {e}")
+                response = "Lo siento, tuve un problema inesperado al procesar tu petición."
+            st.markdown(response)
+        # --- END OF NEW ERROR HANDLING ---
     
     # Add Lola's response to history
     st.session_state.messages.append({"role": "assistant", "content": response})
\ No newline at end of file
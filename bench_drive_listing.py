@@ -0,0 +1,112 @@
+import re
+import sys
+import time
+
+from drive_utils import iter_files_in_folder_tree, FOLDER_MIME_TYPE
+
+# --- Benchmark of the Drive folder-tree listing against a local fake Drive service ---
+# Each files.list call sleeps LATENCY seconds to mimic a Drive round trip, so the
+# numbers show how listing time grows with the number of folders.
+
+LATENCY = 0.02
+FILES_PER_FOLDER = 5
+FAKE_DEFAULT_PAGE_SIZE = 100
+
+
+class FakeRequest:
+    def __init__(self, fn):
+        self._fn = fn
+
+    def execute(self, http=None):
+        time.sleep(LATENCY)
+        return self._fn()
+
+
+class FakeFiles:
+    def __init__(self, children):
+        self.children = children
+        self.calls = 0
+
+    def list(self, q, spaces=None, fields=None, pageToken=None, pageSize=None):
+        self.calls += 1
+        parent_ids = re.findall(r"'([^']+)' in parents", q)
+        items = [item for parent_id in parent_ids for item in self.children.get(parent_id, [])]
+        page_size = pageSize or FAKE_DEFAULT_PAGE_SIZE
+        start = int(pageToken or 0)
+
+        def respond():
+            response = {'files': items[start:start + page_size]}
+            if start + page_size < len(items):
+                response['nextPageToken'] = str(start + page_size)
+            return response
+        return FakeRequest(respond)
+
+
+class FakeDriveService:
+    def __init__(self, folder_count, fanout=4):
+        """Builds a tree of `folder_count` folders (each with `fanout` sub-folders) under 'root'."""
+        self.children = {}
+        folders = ['root']
+        next_index = 0
+        while len(folders) < folder_count + 1:
+            parent = folders[next_index]
+            next_index += 1
+            for _ in range(fanout):
+                if len(folders) > folder_count:
+                    break
+                folder_id = f"folder-{len(folders)}"
+                folders.append(folder_id)
+                self.children.setdefault(parent, []).append(
+                    {'id': folder_id, 'name': folder_id, 'mimeType': FOLDER_MIME_TYPE, 'parents': [parent]})
+        for folder_id in folders:
+            for i in range(FILES_PER_FOLDER):
+                self.children.setdefault(folder_id, []).append(
+                    {'id': f"{folder_id}-file-{i}", 'name': f"doc-{i}.pdf", 'mimeType': 'application/pdf',
+                     'modifiedTime': '2025-01-01T00:00:00Z', 'parents': [folder_id]})
+        self._files = FakeFiles(self.children)
+
+    def files(self):
+        return self._files
+
+
+def list_sequential(service, folder_id):
+    """The previous algorithm: BFS with one paginated files.list per folder and the default page size."""
+    all_files = []
+    folders_to_search = [folder_id]
+    while folders_to_search:
+        current_folder_id = folders_to_search.pop(0)
+        page_token = None
+        while True:
+            response = service.files().list(q=f"'{current_folder_id}' in parents and trashed = false",
+                                            pageToken=page_token).execute()
+            for item in response.get('files', []):
+                if item['mimeType'] == FOLDER_MIME_TYPE:
+                    folders_to_search.append(item['id'])
+                else:
+                    all_files.append(item)
+            page_token = response.get('nextPageToken')
+            if page_token is None:
+                break
+    return all_files
+
+
+def time_listing(list_fn, folder_count):
+    service = FakeDriveService(folder_count)
+    start = time.perf_counter()
+    first_file_at = None
+    count = 0
+    for _ in list_fn(service, 'root'):
+        if first_file_at is None:
+            first_file_at = time.perf_counter() - start
+        count += 1
+    return time.perf_counter() - start, first_file_at, count, service.files().calls
+
+
+if __name__ == '__main__':
+    folder_counts = [int(arg) for arg in sys.argv[1:]] or [10, 50, 100, 300]
+    print(f"--- Listado de Drive (latencia simulada {LATENCY * 1000:.0f} ms por llamada) ---")
+    print(f"{'carpetas':>9} | {'método':<11} | {'archivos':>8} | {'llamadas':>8} | {'1er archivo':>11} | {'total':>8}")
+    for folder_count in folder_counts:
+        for label, list_fn in (("secuencial", list_sequential), ("combinado", iter_files_in_folder_tree)):
+            total, first, count, calls = time_listing(list_fn, folder_count)
+            print(f"{folder_count:>9} | {label:<11} | {count:>8} | {calls:>8} | {first:>10.3f}s | {total:>7.3f}s")
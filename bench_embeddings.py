@@ -0,0 +1,77 @@
+import random
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from embedding_engines import create_embedding_engine
+
+# --- Micro-benchmark of the embedding engines on synthetic chunks ---
+# Measures bulk throughput (chunks/s) and the p50 latency of embedding a single
+# query, and checks that each engine's vectors agree with sentence-transformers
+# (mean cosine similarity), i.e. that they are compatible with the collection.
+
+CHUNK_COUNT = 512
+QUERY_RUNS = 50
+BATCH_SIZE = 64
+WORDS = ("contrato cliente factura proyecto entrega reunión presupuesto informe equipo plazo "
+         "servicio pago revisión propuesta documento análisis riesgo calidad soporte mercado").split()
+QUERIES = ["¿Cuál es el plazo de entrega del proyecto?", "resumen del informe de calidad",
+           "presupuesto aprobado para el cliente", "riesgos del contrato de soporte"]
+
+ENGINE_CONFIGS = [
+    ("sentence-transformers", {}),
+    ("onnx", {}),
+    ("onnx-int8", {}),
+    ("sentence-transformers x2 procesos", {"engine_name": "sentence-transformers", "processes": 2}),
+]
+
+
+def make_chunks(count, seed=0):
+    """Chunks of 20 to 300 words, so length sorting has padding to save."""
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k=rng.randint(20, 300))) + "." for _ in range(count)]
+
+
+def time_engine(engine, chunks):
+    engine(chunks[:BATCH_SIZE])  # calentamiento
+    start = time.perf_counter()
+    vectors = engine(chunks)
+    throughput = len(chunks) / (time.perf_counter() - start)
+    latencies = []
+    for i in range(QUERY_RUNS):
+        start = time.perf_counter()
+        engine([QUERIES[i % len(QUERIES)]])
+        latencies.append(time.perf_counter() - start)
+    return throughput, statistics.median(latencies), np.array(vectors)
+
+
+def mean_cosine(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return float((a * b).sum(axis=1).mean())
+
+
+if __name__ == '__main__':
+    selected = sys.argv[1:]
+    chunks = make_chunks(CHUNK_COUNT)
+    baseline = None
+    print(f"--- Motores de embeddings ({CHUNK_COUNT} fragmentos, lotes de {BATCH_SIZE}) ---")
+    print(f"{'motor':<36} | {'fragmentos/s':>12} | {'p50 consulta':>12} | {'coseno vs ST':>12}")
+    for label, options in ENGINE_CONFIGS:
+        engine_name = options.get("engine_name", label)
+        if selected and label not in selected and engine_name not in selected:
+            continue
+        try:
+            engine = create_embedding_engine(engine_name, batch_size=BATCH_SIZE, processes=options.get("processes", 1))
+        except Exception as e:
+            print(f"{label:<36} | no disponible: {e}")
+            continue
+        throughput, p50, vectors = time_engine(engine, chunks)
+        if baseline is None and engine_name == "sentence-transformers":
+            baseline = vectors
+        agreement = f"{mean_cosine(baseline, vectors):.4f}" if baseline is not None else "-"
+        print(f"{label:<36} | {throughput:>12.1f} | {p50 * 1000:>10.1f}ms | {agreement:>12}")
+        if hasattr(engine, "close"):
+            engine.close()
@@ -1,65 +1,412 @@
+import io
 import os
+import re
+import csv
+import zlib
+import hashlib
+import tempfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain
 import pypdf
 import docx
 import openpyxl
+from pptx import Presentation
 from bs4 import BeautifulSoup
 
-def read_text_from_file(file_path, mime_type=None):
-    """Reads content from various document types (PDF, DOCX, XLSX, TXT, HTML)."""
+# Límites para que un PDF patológico no bloquee la ingesta.
+PDF_MAX_PAGES = int(os.getenv("LOLA_PDF_MAX_PAGES", "2000"))
+PDF_MAX_BYTES = int(float(os.getenv("LOLA_PDF_MAX_MB", "200")) * 1024 * 1024)
+# Solo los PDFs largos se reparten entre procesos; en los cortos el arranque de procesos no compensa.
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("LOLA_PDF_PARALLEL_MIN_PAGES", "60"))
+PDF_PAGES_PER_TASK = 20
+PDF_WORKERS = int(os.getenv("LOLA_PDF_WORKERS", str(os.cpu_count() or 1)))
+# Hojas de cálculo: filas por fragmento y tope de caracteres (también por celda y por fila).
+SHEET_ROWS_PER_CHUNK = int(os.getenv("LOLA_SHEET_ROWS_PER_CHUNK", "40"))
+SHEET_MAX_CHUNK_CHARS = 6000
+SHEET_MAX_CELL_CHARS = 500
+# Unidad del tamaño de fragmento: 'words' (palabras) o 'tokens' (tokens del modelo de embeddings).
+CHUNK_UNIT = os.getenv("LOLA_CHUNK_UNIT", "words")
+TOKENIZER_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+@contextmanager
+def _open_binary(source):
+    """
+    Binary stream for a path, raw bytes or an already open file-like object. Only a
+    stream opened here is closed on exit: the caller's file-like object stays usable.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        with io.BytesIO(source) as file:
+            yield file
+    elif isinstance(source, str):
+        with open(source, 'rb') as file:
+            yield file
+    else:
+        yield source
+
+def read_text_from_file(file_path, mime_type=None, extension=None):
+    """
+    Reads content from various document types (PDF, DOCX, XLSX, PPTX, CSV, TXT, HTML).
+    `file_path` may also be the document's bytes or a file-like object, in which
+    case `extension` (e.g. '.pdf') tells which reader to use.
+    """
     # Usamos la extensión para determinar el tipo, ya que la descarga de Drive ya la definió.
-    extension = os.path.splitext(file_path)[1].lower()
+    if extension is None:
+        extension = os.path.splitext(file_path)[1] if isinstance(file_path, str) else ''
+    extension = extension.lower()
+    display_name = file_path if isinstance(file_path, str) else f"<documento en memoria{extension}>"
 
     try:
         if extension == '.pdf':
-            with open(file_path, 'rb') as file:
-                reader = pypdf.PdfReader(file)
-                text = "".join(page.extract_text() or "" for page in reader.pages)
-            return text
+            return "".join(text for _, text in iter_pdf_pages(file_path))
         
         elif extension == '.docx':
-            doc = docx.Document(file_path)
+            with _open_binary(file_path) as file:
+                doc = docx.Document(file)
             return "\n".join([paragraph.text for paragraph in doc.paragraphs])
             
         elif extension == '.xlsx':
-            workbook = openpyxl.load_workbook(file_path)
-            text = []
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-                text.append(f"--- Hoja: {sheet_name} ---")
-                for row in sheet.iter_rows():
-                    row_values = [str(cell.value) if cell.value is not None else "" for cell in row]
-                    text.append("\t".join(row_values))
-            return "\n".join(text)
+            return "\n".join(chunk for chunk, _ in iter_spreadsheet_chunks(file_path))
+
+        elif extension == '.pptx':
+            with _open_binary(file_path) as file:
+                presentation = Presentation(file)
+            slides = []
+            for number, slide in enumerate(presentation.slides, start=1):
+                texts = [shape.text_frame.text for shape in slide.shapes if shape.has_text_frame and shape.text_frame.text.strip()]
+                slides.append(f"--- Diapositiva {number} ---\n" + "\n".join(texts))
+            return "\n".join(slides)
+
+        elif extension == '.csv':
+            return "\n".join(chunk for chunk, _ in iter_csv_chunks(file_path))
 
         elif extension in ['.txt', '.html'] or mime_type in ['text/plain', 'text/html']:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                if extension == '.html':
-                    soup = BeautifulSoup(content, 'html.parser')
-                    return soup.get_text(separator='\n')
-                return content
+            with _open_binary(file_path) as f:
+                # 'utf-8-sig' descarta el BOM que añaden las exportaciones de texto de Google.
+                content = f.read().decode('utf-8-sig')
+            if extension == '.html':
+                soup = BeautifulSoup(content, 'html.parser')
+                return soup.get_text(separator='\n')
+            return content
         else:
-            print(f"Advertencia: Tipo de archivo no soportado para lectura: {file_path}")
+            print(f"Advertencia: Tipo de archivo no soportado para lectura: {display_name}")
             return None
     except Exception as e:
-        print(f"Error leyendo {file_path}: {e}")
+        print(f"Error leyendo {display_name}: {e}")
         return None
 
-def chunk_text(text, chunk_size=1000, chunk_overlap=100):
-    """Divide el texto en fragmentos (chunks) con superposición para embeddings."""
+def _source_size(source):
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    return None
+
+def _extract_pdf_page_range(path, start, end):
+    """Process-pool task: returns [(page_number, text), ...] for pages [start, end) of a PDF file (1-based numbers)."""
+    with open(path, 'rb') as file:
+        reader = pypdf.PdfReader(file)
+        return [(number + 1, reader.pages[number].extract_text() or "") for number in range(start, end)]
+
+def iter_pdf_pages(source, max_workers=PDF_WORKERS, max_pages=PDF_MAX_PAGES, max_bytes=PDF_MAX_BYTES,
+                   pages_per_task=PDF_PAGES_PER_TASK):
+    """
+    Yields `(page_number, text)` for each page of a PDF, in order, as soon as it is ready.
+
+    Long PDFs are split in page ranges extracted on a process pool, so throughput
+    scales with cores. Files over `max_bytes` are skipped and only the first
+    `max_pages` pages are read, so a pathological file cannot stall the ingestion.
+    Inside a worker process (e.g. the ingest pipeline's extraction pool) pages are
+    always read inline, so pools are never nested.
+    """
+    size = _source_size(source)
+    if size is not None and size > max_bytes:
+        print(f"Advertencia: PDF de {size} bytes supera el límite de {max_bytes}; se omite.")
+        return
+    # Un proceso hijo no abre su propio pool: el paralelismo ya lo da el pool que lo lanzó.
+    if multiprocessing.parent_process() is not None:
+        max_workers = 1
+    with _open_binary(source) as file:
+        reader = pypdf.PdfReader(file)
+        page_count = len(reader.pages)
+        if page_count > max_pages:
+            print(f"Advertencia: PDF de {page_count} páginas; solo se leen las primeras {max_pages}.")
+            page_count = max_pages
+        if max_workers <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+            # Sin pool, el PDF se analiza una sola vez y se reutiliza el mismo lector para todas las páginas.
+            for number in range(page_count):
+                yield number + 1, reader.pages[number].extract_text() or ""
+            return
+        data = None
+        if not isinstance(source, str):
+            file.seek(0)
+            data = file.read()
+
+    # Los procesos reciben la ruta de un archivo temporal en vez de una copia del PDF por tarea.
+    temp_path = None
+    if data is not None:
+        fd, temp_path = tempfile.mkstemp(suffix='.pdf')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        source = temp_path
+    try:
+        ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+        workers = min(max_workers, len(ranges))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            for pages in pool.map(_extract_pdf_page_range, [source] * len(ranges),
+                                  [start for start, _ in ranges], [end for _, end in ranges]):
+                yield from pages
+    finally:
+        if temp_path:
+            os.remove(temp_path)
+
+def _format_row(values):
+    """Tab-joined row text without trailing empty cells, with long cells and rows truncated."""
+    cells = ["" if value is None else str(value)[:SHEET_MAX_CELL_CHARS] for value in values]
+    while cells and not cells[-1].strip():
+        cells.pop()
+    return "\t".join(cells)[:SHEET_MAX_CHUNK_CHARS // 2]
+
+def iter_row_group_chunks(sheet_name, rows, rows_per_chunk=SHEET_ROWS_PER_CHUNK, max_chunk_chars=SHEET_MAX_CHUNK_CHARS):
+    """
+    Groups a stream of row value tuples into self-contained chunks: each one starts
+    with the sheet name and the header row (the first non-empty row).
+    Yields `(chunk, {"sheet": name, "row_start": n, "row_end": m})` with 1-based row numbers.
+    """
+    header = None
+    group = []
+    group_chars = 0
+    group_start = None
+    for row_number, values in enumerate(rows, start=1):
+        line = _format_row(values)
+        if not line.strip():
+            continue
+        if header is None:
+            header = line
+            continue
+        if group and (len(group) >= rows_per_chunk or group_chars + len(line) > max_chunk_chars):
+            yield _row_group_chunk(sheet_name, header, group, group_start, last_row)
+            group, group_chars = [], 0
+        if not group:
+            group_start = row_number
+        group.append(line)
+        group_chars += len(line) + 1
+        last_row = row_number
+    if group:
+        yield _row_group_chunk(sheet_name, header, group, group_start, last_row)
+    elif header is not None:
+        # Hoja con una sola fila: se indexa igualmente.
+        yield f"--- Hoja: {sheet_name} ---\n{header}", {"sheet": sheet_name, "row_start": 1, "row_end": 1}
+
+def _row_group_chunk(sheet_name, header, lines, row_start, row_end):
+    text = f"--- Hoja: {sheet_name} (filas {row_start}-{row_end}) ---\n{header}\n" + "\n".join(lines)
+    return text, {"sheet": sheet_name, "row_start": row_start, "row_end": row_end}
+
+def iter_spreadsheet_chunks(source, rows_per_chunk=SHEET_ROWS_PER_CHUNK):
+    """
+    Streams an .xlsx workbook in read-only mode (no cell objects or styles kept in
+    memory) and yields row-group chunks that repeat the header row, so memory stays
+    constant however long or wide the sheets are.
+    """
+    with _open_binary(source) as file:
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        try:
+            for sheet in workbook.worksheets:
+                yield from iter_row_group_chunks(sheet.title, sheet.iter_rows(values_only=True), rows_per_chunk=rows_per_chunk)
+        finally:
+            workbook.close()
+
+def iter_csv_chunks(source, sheet_name="CSV", rows_per_chunk=SHEET_ROWS_PER_CHUNK):
+    """Streams a CSV (e.g. a Google Sheet exported as text/csv) into header-repeating row-group chunks."""
+    with _open_binary(source) as file:
+        text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+        try:
+            yield from iter_row_group_chunks(sheet_name, csv.reader(text), rows_per_chunk=rows_per_chunk)
+        finally:
+            text.detach()
+
+def iter_pdf_chunks(pages, chunk_size=1000, chunk_overlap=100, unit=CHUNK_UNIT):
+    """
+    Chunks a stream of `(page_number, text)` pages with iter_text_spans, one page at a
+    time, so an edit on one page never changes the chunks of the others. Yields
+    `(chunk, {"page_start": n, "page_end": n, "char_start": i, "char_end": j})` with the
+    offsets within the page's text.
+    """
+    for page_number, text in pages:
+        for span in iter_text_spans(text, chunk_size=chunk_size, chunk_overlap=chunk_overlap, unit=unit):
+            yield span.text, {"page_start": page_number, "page_end": page_number,
+                              "char_start": span.start, "char_end": span.end}
+
+# Fin de frase (., !, ?, … seguidos de espacio) o salto de párrafo (línea en blanco).
+_SEGMENT_BOUNDARY = re.compile(r'(?<=[.!?…])\s+|\n\s*\n')
+_WORD = re.compile(r'\S+')
+
+def content_hash(text):
+    """Short content hash of a chunk, used for its id (so an unchanged chunk keeps it across edits)."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+class TextSpan:
+    """
+    A chunk of `source` given by character offsets. The text (and its hash) is only
+    sliced out of the source when first accessed.
+    """
+    __slots__ = ('source', 'start', 'end', '_hash')
+
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = end
+        self._hash = None
+
+    @property
+    def text(self):
+        return self.source[self.start:self.end]
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = content_hash(self.text)
+        return self._hash
+
+    def __repr__(self):
+        return f"TextSpan({self.start}, {self.end})"
+
+@lru_cache(maxsize=None)
+def get_token_counter(model_name=TOKENIZER_MODEL_NAME):
+    """Returns a function counting the embedding model's tokens in a string (loaded once per process)."""
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+def _word_counter(text):
+    return sum(1 for _ in _WORD.finditer(text))
+
+def _iter_segments(text, size_fn, max_size, piece_size):
+    """
+    Yields `(start, end, size)` for each sentence or paragraph of `text`. A segment larger
+    than `max_size` (e.g. a table or a text without punctuation) is cut at word boundaries
+    into pieces of up to `piece_size`, so the overlap still works inside it.
+    """
+    position = 0
+    boundaries = chain(((m.start(), m.end()) for m in _SEGMENT_BOUNDARY.finditer(text)), [(len(text), len(text))])
+    for boundary_start, boundary_end in boundaries:
+        start, end = position, boundary_start
+        position = boundary_end
+        # Un tramo solo con espacios (texto vacío, saltos de línea sueltos) no es una frase.
+        if start >= end or not text[start:end].strip():
+            continue
+        size = size_fn(text[start:end])
+        if size <= max_size:
+            yield start, end, size
+            continue
+        piece_start = piece_end = None
+        current_size = 0
+        for word in _WORD.finditer(text, start, end):
+            word_size = size_fn(word.group()) if size_fn is not _word_counter else 1
+            if piece_start is not None and current_size + word_size > piece_size:
+                yield piece_start, piece_end, current_size
+                piece_start, current_size = None, 0
+            if piece_start is None:
+                piece_start = word.start()
+            piece_end = word.end()
+            current_size += word_size
+        if piece_start is not None:
+            yield piece_start, piece_end, current_size
+
+def _is_anchor(text, start, end, size, spacing):
+    """
+    Content-defined cut point: a segment is an anchor with probability `size / spacing`,
+    decided by a hash of its text, so anchors fall on average every `spacing` and do
+    not move when text elsewhere in the document changes.
+    """
+    return zlib.crc32(text[start:end].encode('utf-8')) < size / spacing * 0x100000000
+
+def iter_text_spans(text, chunk_size=1000, chunk_overlap=100, unit=CHUNK_UNIT):
+    """
+    Sentence-aware chunker over character offsets. Sentences and paragraphs are packed
+    into chunks of up to `chunk_size` words (or embedding-model tokens with
+    `unit='tokens'`); consecutive chunks share trailing sentences worth up to
+    `chunk_overlap`. Yields TextSpan objects; the original whitespace and line breaks
+    are kept in each chunk's text.
+
+    Chunks end at content-defined anchors (see _is_anchor) once they hold a quarter of
+    `chunk_size`, and only fall back to cutting at `chunk_size`. Cut points therefore
+    depend on the surrounding sentences rather than on their offset in the document,
+    and an edit changes the chunks around it instead of every chunk after it.
+    """
     if not text:
-        return []
-    
-    # Dividimos por espacios o saltos de línea y usamos tokens (palabras) para chunking
-    words = text.split() 
-    chunks = []
-    
-    # Aseguramos que la superposición no sea mayor que el chunk_size
-    step = chunk_size - chunk_overlap
-    if step <= 0:
-        step = 1
-        
-    for i in range(0, len(words), step):
-        chunk = " ".join(words[i:i + chunk_size])
-        chunks.append(chunk)
-    return chunks
\ No newline at end of file
+        return
+    size_fn = get_token_counter() if unit == 'tokens' else _word_counter
+    chunk_overlap = max(0, min(chunk_overlap, chunk_size - 1))
+    min_size = max(1, chunk_size // 4)
+    anchor_spacing = max(1, chunk_size // 2)
+    window = deque()  # (inicio, fin, tamaño) de cada frase del fragmento en curso
+    window_size = 0
+    emitted_until_end = False
+    for segment in _iter_segments(text, size_fn, chunk_size, chunk_overlap or chunk_size):
+        if window and window_size + segment[2] > chunk_size:
+            if not emitted_until_end:
+                yield TextSpan(text, window[0][0], window[-1][1])
+            # Se conservan las últimas frases que quepan en la superposición.
+            while window and (window_size > chunk_overlap or window_size + segment[2] > chunk_size):
+                window_size -= window.popleft()[2]
+            emitted_until_end = True
+        window.append(segment)
+        window_size += segment[2]
+        emitted_until_end = False
+        if window_size >= min_size and _is_anchor(text, *segment, anchor_spacing):
+            yield TextSpan(text, window[0][0], window[-1][1])
+            while window and window_size > chunk_overlap:
+                window_size -= window.popleft()[2]
+            emitted_until_end = True
+    if window and not emitted_until_end:
+        yield TextSpan(text, window[0][0], window[-1][1])
+
+def iter_text_chunks(text, chunk_size=1000, chunk_overlap=100, unit=CHUNK_UNIT):
+    """Genera los fragmentos (chunks) con superposición de uno en uno, sin acumularlos."""
+    for span in iter_text_spans(text, chunk_size=chunk_size, chunk_overlap=chunk_overlap, unit=unit):
+        yield span.text
+
+def chunk_text(text, chunk_size=1000, chunk_overlap=100, unit=CHUNK_UNIT):
+    """Divide el texto en fragmentos (chunks) con superposición para embeddings."""
+    return list(iter_text_chunks(text, chunk_size=chunk_size, chunk_overlap=chunk_overlap, unit=unit))
+
+def extract_chunks(download, chunk_size=1000, chunk_overlap=100, unit=CHUNK_UNIT, pdf_workers=PDF_WORKERS):
+    """
+    Worker entry point for the ingest pipeline. `download` is the `(content, extension)`
+    pair from drive_utils.download_file_content: bytes are parsed in memory, a path
+    (large files spilled to disk) is parsed and then removed.
+    Returns a list of `(chunk, extra_metadata)` pairs; PDF chunks carry their page,
+    spreadsheet chunks their sheet and rows, and text chunks their character offsets.
+    `pdf_workers` caps the processes used for a long PDF; pass 1 when the caller
+    already extracts several files in parallel.
+    """
+    content, extension = download
+    try:
+        if extension.lower() == '.pdf':
+            try:
+                return list(iter_pdf_chunks(iter_pdf_pages(content, max_workers=pdf_workers), chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                            unit=unit))
+            except Exception as e:
+                print(f"Error leyendo PDF: {e}")
+                return []
+        if extension.lower() in ('.xlsx', '.csv'):
+            try:
+                if extension.lower() == '.csv':
+                    return list(iter_csv_chunks(content))
+                return list(iter_spreadsheet_chunks(content))
+            except Exception as e:
+                print(f"Error leyendo hoja de cálculo: {e}")
+                return []
+        text = read_text_from_file(content, extension=extension)
+        return [(span.text, {"char_start": span.start, "char_end": span.end})
+                for span in iter_text_spans(text, chunk_size=chunk_size, chunk_overlap=chunk_overlap, unit=unit)]
+    finally:
+        if isinstance(content, str):
+            try:
+                os.remove(content)
+            except OSError as e:
+                print(f"Error removing temporary file {content}: {e}")
@@ -8,6 +8,11 @@ from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
 import io
 import time
 import mimetypes
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import httplib2
+import google_auth_httplib2
 import streamlit as st # Add streamlit import
 
 # Define the scopes Lola needs. Ensure these match what you configured in Google Cloud.
@@ -18,10 +23,15 @@ SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets'  # For Google Sheets
 ]
 
+# Registro de clientes de la API compartido por todo el proceso: credenciales y clientes se construyen una sola vez.
+_credentials = None
+_services = {}
+_registry_lock = threading.Lock()
+
 # Modificamos la función para usar 'token.json' como en el flujo inicial.
-def get_drive_service():
+def _load_credentials():
     """
-    Authenticates with Google Drive. Works for both local development
+    Loads Google credentials. Works for both local development
     (using token.json) and Streamlit Cloud deployment (using st.secrets).
     """
     try:
@@ -47,8 +57,59 @@ def get_drive_service():
 
             with open(TOKEN_FILE, 'w') as token:
                 token.write(creds.to_json())
+    return creds
+
+def get_credentials():
+    """Returns the process-wide Google credentials, loading them on first use."""
+    global _credentials
+    with _registry_lock:
+        if _credentials is None:
+            _credentials = _load_credentials()
+        return _credentials
+
+def get_service(api_name, api_version):
+    """
+    Returns the process-wide client for a Google API ('drive', 'docs', 'sheets'...),
+    building it on first use from the discovery documents bundled with
+    google-api-python-client (no discovery round trip).
+    Clients are shared across threads: pass get_thread_http(service) to execute()
+    when calling from a worker thread.
+    """
+    credentials = get_credentials()
+    key = (api_name, api_version)
+    with _registry_lock:
+        service = _services.get(key)
+        if service is None:
+            service = build(api_name, api_version, credentials=credentials,
+                            static_discovery=True, cache_discovery=False)
+            _services[key] = service
+        return service
+
+def get_drive_service():
+    """Authenticates with Google Drive and returns the shared Drive v3 client."""
+    return get_service('drive', 'v3')
 
-    return build('drive', 'v3', credentials=creds)
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+_thread_local = threading.local()
+
+def get_thread_http(service):
+    """
+    Returns an authorized HTTP client private to the calling thread.
+    httplib2 is not thread-safe, so worker threads must not share the service's
+    own connection. Returns None for services without credentials (e.g. fakes).
+    """
+    credentials = getattr(getattr(service, '_http', None), 'credentials', None)
+    if credentials is None:
+        return None
+    clients = getattr(_thread_local, 'http_clients', None)
+    if clients is None:
+        clients = _thread_local.http_clients = {}
+    http = clients.get(id(credentials))
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+        clients[id(credentials)] = http
+    return http
 
 def search_drive_files(service, query, mime_type=None, folder_id=None):
     """
@@ -78,54 +139,118 @@ def search_drive_files(service, query, mime_type=None, folder_id=None):
             break
     return results
 
-def download_file(service, file_id, file_name, destination_path='temp_docs'):
-    """
-    Downloads a file from Google Drive.
-    Handles Google Docs/Sheets conversion to more portable formats.
-    """
-    os.makedirs(destination_path, exist_ok=True)
-    file_metadata = service.files().get(fileId=file_id, fields='mimeType, name').execute()
-    mime_type = file_metadata['mimeType']
-    actual_file_name = file_metadata['name']
+# Por encima de este tamaño (si Drive lo informa) la descarga va a un archivo temporal en vez de a memoria.
+MAX_IN_MEMORY_DOWNLOAD_BYTES = int(float(os.getenv("LOLA_MAX_IN_MEMORY_DOWNLOAD_MB", "50")) * 1024 * 1024)
 
-    download_format = None
+# Modo texto: Docs y Slides se exportan como text/plain (sin parseo de .docx/.pptx) y, si se activa,
+# Sheets como text/csv. La exportación CSV de Drive solo incluye la primera hoja, por eso es opcional.
+EXPORT_AS_TEXT = os.getenv("LOLA_EXPORT_AS_TEXT", "1") == "1"
+EXPORT_SHEETS_AS_CSV = os.getenv("LOLA_EXPORT_SHEETS_AS_CSV", "0") == "1"
+
+def _resolve_download_format(mime_type, file_name, export_as_text=False):
+    """Returns the (export/download mime type, local extension) used for a Drive file."""
     if mime_type == 'application/vnd.google-apps.document':
-        download_format = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document' # .docx
-        extension = '.docx'
+        if export_as_text:
+            return 'text/plain', '.txt'
+        return 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', '.docx'
     elif mime_type == 'application/vnd.google-apps.spreadsheet':
-        download_format = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet' # .xlsx
-        extension = '.xlsx'
+        if export_as_text and EXPORT_SHEETS_AS_CSV:
+            return 'text/csv', '.csv'
+        return 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', '.xlsx'
     elif mime_type == 'application/vnd.google-apps.presentation':
-        download_format = 'application/vnd.openxmlformats-officedocument.presentationml.presentation' # .pptx
-        extension = '.pptx'
+        if export_as_text:
+            return 'text/plain', '.txt'
+        return 'application/vnd.openxmlformats-officedocument.presentationml.presentation', '.pptx'
     elif mime_type == 'application/pdf':
-        download_format = 'application/pdf'
-        extension = '.pdf'
+        return 'application/pdf', '.pdf'
+    elif mime_type == 'text/csv':
+        return 'text/csv', '.csv'
     elif mime_type.startswith('text/'): # Plain text
-        download_format = 'text/plain'
-        extension = '.txt'
-    else: # Generic blob or unsupported type
-        # Try to infer extension, or fallback to generic
-        extension = os.path.splitext(actual_file_name)[1] or '.bin'
-        download_format = mime_type # Download as is
-
-    local_file_path = os.path.join(destination_path, f"{file_name}{extension}")
+        return 'text/plain', '.txt'
+    # Generic blob or unsupported type: try to infer extension, or fallback to generic
+    return mime_type, os.path.splitext(file_name)[1] or '.bin'
 
-    request = None
+def _download_request(service, file_id, mime_type, download_format, http=None):
+    """Builds the export (Google-native files) or raw media request for a file."""
     if download_format and mime_type.startswith('application/vnd.google-apps'):
         request = service.files().export_media(fileId=file_id, mimeType=download_format)
     else:
         request = service.files().get_media(fileId=file_id)
+    if http is not None:
+        request.http = http
+    return request
 
-    fh = io.FileIO(local_file_path, 'wb')
+def _stream_download(request, fh, display_name):
     downloader = MediaIoBaseDownload(fh, request)
     done = False
     while done is False:
         status, done = downloader.next_chunk()
-        print(f"Downloading {actual_file_name}: {int(status.progress() * 100)}%")
+        print(f"Downloading {display_name}: {int(status.progress() * 100)}%")
+
+def _get_download_metadata(service, file_id, file_metadata, http=None):
+    """Uses the metadata from a listing when it has what a download needs; otherwise fetches it."""
+    if file_metadata and 'mimeType' in file_metadata and 'name' in file_metadata:
+        return file_metadata
+    return service.files().get(fileId=file_id, fields='mimeType, name, size').execute(http=http)
+
+def download_file(service, file_id, file_name, destination_path='temp_docs', http=None, file_metadata=None):
+    """
+    Downloads a file from Google Drive.
+    Handles Google Docs/Sheets conversion to more portable formats.
+    Pass `http` (see get_thread_http) when calling from a worker thread, and the
+    file's listing entry as `file_metadata` to skip the extra metadata request.
+    """
+    os.makedirs(destination_path, exist_ok=True)
+    file_metadata = _get_download_metadata(service, file_id, file_metadata, http=http)
+    mime_type = file_metadata['mimeType']
+    actual_file_name = file_metadata['name']
+    download_format, extension = _resolve_download_format(mime_type, actual_file_name)
+
+    local_file_path = os.path.join(destination_path, f"{file_name}{extension}")
+    request = _download_request(service, file_id, mime_type, download_format, http=http)
+    with io.FileIO(local_file_path, 'wb') as fh:
+        _stream_download(request, fh, actual_file_name)
     print(f"Downloaded: {local_file_path}")
     return local_file_path
 
+def download_file_content(service, file_id, destination_path='temp_docs', http=None,
+                          max_in_memory_bytes=MAX_IN_MEMORY_DOWNLOAD_BYTES, file_metadata=None,
+                          export_as_text=EXPORT_AS_TEXT):
+    """
+    Downloads a file from Google Drive without touching the disk when possible.
+
+    Returns a `(content, extension)` pair. `content` is the file's bytes, or, for
+    files larger than `max_in_memory_bytes`, the path of a uniquely named temporary
+    file that the caller must delete. Google-native exports report no size and are
+    always kept in memory. Pass the file's listing entry as `file_metadata` to skip
+    the extra metadata request. With `export_as_text`, Google-native files are
+    exported in lightweight text formats instead of Office formats.
+    """
+    file_metadata = _get_download_metadata(service, file_id, file_metadata, http=http)
+    mime_type = file_metadata['mimeType']
+    actual_file_name = file_metadata['name']
+    download_format, extension = _resolve_download_format(mime_type, actual_file_name, export_as_text=export_as_text)
+    request = _download_request(service, file_id, mime_type, download_format, http=http)
+
+    size = int(file_metadata.get('size') or 0)
+    if size > max_in_memory_bytes:
+        os.makedirs(destination_path, exist_ok=True)
+        # mkstemp garantiza un nombre único, así que las descargas concurrentes no se pisan.
+        fd, local_file_path = tempfile.mkstemp(prefix=f"{file_id}-", suffix=extension, dir=destination_path)
+        try:
+            with io.FileIO(fd, 'wb') as fh:
+                _stream_download(request, fh, actual_file_name)
+        except Exception:
+            os.remove(local_file_path)
+            raise
+        print(f"Downloaded (disk, {size} bytes): {local_file_path}")
+        return local_file_path, extension
+
+    buffer = io.BytesIO()
+    _stream_download(request, buffer, actual_file_name)
+    print(f"Downloaded (memory, {buffer.tell()} bytes): {actual_file_name}")
+    return buffer.getvalue(), extension
+
 def upload_file_to_drive(service, file_path, name, parent_folder_id=None, mime_type=None):
     """
     Uploads a file to Google Drive.
@@ -160,7 +285,101 @@ def update_file_in_drive(service, file_id, file_path, mime_type=None):
     print(f"File ID: {file.get('id')} updated. New modified time: {file.get('modifiedTime')}")
     return file
 
-def list_all_files_in_folder_recursive(service, folder_id, query_conditions=""):
+# Carpetas combinadas por consulta ('a' in parents or 'b' in parents ...); Drive limita la longitud de 'q'.
+PARENTS_PER_QUERY = 25
+LIST_PAGE_SIZE = 1000
+LIST_WORKERS = int(os.getenv("LOLA_LIST_WORKERS", "4"))
+# Solo los campos que usan el manifiesto y la ingesta.
+LIST_FIELDS = 'nextPageToken, files(id, name, mimeType, modifiedTime, md5Checksum, size, parents)'
+
+def _list_children(service, parent_ids, query_conditions=""):
+    """
+    Lists every (non-trashed) child of any folder in `parent_ids` with a single
+    paginated query. Runs on a worker thread. Returns (items, error).
+    """
+    parents_clause = " or ".join(f"'{parent_id}' in parents" for parent_id in parent_ids)
+    query = f"({parents_clause}) and trashed = false"
+    if query_conditions:
+        # Las carpetas siempre se listan para poder seguir bajando por el árbol.
+        query += f" and ({query_conditions} or mimeType = '{FOLDER_MIME_TYPE}')"
+
+    items = []
+    page_token = None
+    try:
+        http = get_thread_http(service)
+        while True:
+            response = service.files().list(
+                q=query,
+                spaces='drive',
+                pageSize=LIST_PAGE_SIZE,
+                fields=LIST_FIELDS,
+                pageToken=page_token
+            ).execute(http=http)
+            items.extend(response.get('files', []))
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                return items, None
+    except Exception as e:
+        return items, e
+
+def iter_files_in_folder_tree(service, folder_id, query_conditions="", folder_map=None, errors=None,
+                              parents_per_query=PARENTS_PER_QUERY, max_workers=LIST_WORKERS):
+    """
+    Walks a Google Drive folder tree and yields its files as soon as they are found.
+
+    Folders are listed level by level with several parent ids per query and up to
+    `max_workers` queries in flight, so a tree with hundreds of folders costs a
+    handful of round trips per level instead of one per folder.
+
+    Args:
+        service: The authenticated Google Drive service object.
+        folder_id: The ID of the root folder to start searching from.
+        query_conditions: Optional additional query strings (e.g., for modification time).
+            Folders are always traversed, even if they do not match.
+        folder_map: Optional dict filled with {sub_folder_id: parent_folder_id} for
+            every folder found, used to track the folder tree for incremental sync.
+        errors: Optional list that receives the exception of every failed query, so
+            callers can tell an incomplete listing from a complete one.
+        parents_per_query: How many folders are combined in one files.list query.
+        max_workers: How many queries run concurrently.
+
+    Yields:
+        File objects (dictionaries), excluding folders.
+    """
+    pending_folders = [folder_id]
+    seen_folders = {folder_id}
+    in_flight = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="lola-list") as pool:
+        while pending_folders or in_flight:
+            while pending_folders and len(in_flight) < max_workers:
+                group = pending_folders[:parents_per_query]
+                del pending_folders[:parents_per_query]
+                in_flight[pool.submit(_list_children, service, group, query_conditions)] = group
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                group = set(in_flight.pop(future))
+                items, error = future.result()
+                if error is not None:
+                    print(f"An error occurred while accessing folders {sorted(group)}: {error}")
+                    if errors is not None:
+                        errors.append(error)
+                for item in items:
+                    # If the item is a folder, add it to the list to be searched
+                    if item.get('mimeType') == FOLDER_MIME_TYPE:
+                        if item['id'] in seen_folders:
+                            continue
+                        seen_folders.add(item['id'])
+                        pending_folders.append(item['id'])
+                        if folder_map is not None:
+                            parents = item.get('parents') or []
+                            folder_map[item['id']] = next((p for p in parents if p in group), parents[0] if parents else None)
+                    # Otherwise, it's a file, so hand it to the caller right away
+                    else:
+                        yield item
+
+def list_all_files_in_folder_recursive(service, folder_id, query_conditions="", folder_map=None):
     """
     Recursively finds all files in a given Google Drive folder and its sub-folders.
     Handles pagination to ensure all files are found.
@@ -169,53 +388,86 @@ def list_all_files_in_folder_recursive(service, folder_id, query_conditions=""):
         service: The authenticated Google Drive service object.
         folder_id: The ID of the root folder to start searching from.
         query_conditions: Optional additional query strings (e.g., for modification time).
+        folder_map: Optional dict filled with {sub_folder_id: parent_folder_id} for
+            every folder found, used to track the folder tree for incremental sync.
 
     Returns:
         A list of file objects (dictionaries), excluding folders.
     """
-    all_files = []
-    folders_to_search = [folder_id]
-    searched_folders = set()
-
-    while folders_to_search:
-        current_folder_id = folders_to_search.pop(0)
-        if current_folder_id in searched_folders:
-            continue
-        
-        searched_folders.add(current_folder_id)
-        page_token = None
+    return list(iter_files_in_folder_tree(service, folder_id, query_conditions=query_conditions, folder_map=folder_map))
 
-        while True:
-            # Construct the query
-            query = f"'{current_folder_id}' in parents and trashed = false"
-            if query_conditions:
-                query += f" and {query_conditions}"
-
-            try:
-                response = service.files().list(
-                    q=query,
-                    spaces='drive',
-                    fields='nextPageToken, files(id, name, mimeType, modifiedTime)',
-                    pageToken=page_token
-                ).execute()
-
-                for item in response.get('files', []):
-                    # If the item is a folder, add it to the list to be searched
-                    if item.get('mimeType') == 'application/vnd.google-apps.folder':
-                        folders_to_search.append(item.get('id'))
-                    # Otherwise, it's a file, so add it to our results
-                    else:
-                        all_files.append(item)
+# Límite de peticiones por BatchHttpRequest en la API de Drive.
+MAX_BATCH_REQUESTS = 100
+
+def execute_batch(service, requests, http=None):
+    """
+    Executes many API requests through BatchHttpRequest, 100 per HTTP round trip.
+
+    Returns:
+        A list of (response, exception) tuples in the same order as `requests`.
+    """
+    results = [(None, None)] * len(requests)
+    for start in range(0, len(requests), MAX_BATCH_REQUESTS):
+        batch = service.new_batch_http_request()
+        for index, request in enumerate(requests[start:start + MAX_BATCH_REQUESTS], start=start):
+            def callback(request_id, response, exception, index=index):
+                results[index] = (response, exception)
+            batch.add(request, callback=callback)
+        batch.execute(http=http)
+    return results
 
-                page_token = response.get('nextPageToken', None)
-                if page_token is None:
-                    break
-            
-            except Exception as e:
-                print(f"An error occurred while accessing folder {current_folder_id}: {e}")
-                break # Stop trying if a folder is inaccessible
+def batch_get_file_metadata(service, file_ids, fields='id, name, mimeType, modifiedTime, md5Checksum, size, parents, trashed'):
+    """Fetches metadata for many files in batched requests. Returns {file_id: metadata}; failures are skipped."""
+    file_ids = list(file_ids)
+    requests = [service.files().get(fileId=file_id, fields=fields) for file_id in file_ids]
+    metadata = {}
+    for file_id, (response, error) in zip(file_ids, execute_batch(service, requests, http=get_thread_http(service))):
+        if error is not None:
+            print(f"No se pudieron obtener los metadatos de {file_id}: {error}")
+        else:
+            metadata[file_id] = response
+    return metadata
+
+def batch_list_permissions(service, file_ids, fields='permissions(id, type, role, emailAddress)'):
+    """Lists the permissions of many files in batched requests. Returns {file_id: [permission, ...]}; failures are skipped."""
+    file_ids = list(file_ids)
+    requests = [service.permissions().list(fileId=file_id, fields=fields) for file_id in file_ids]
+    permissions = {}
+    for file_id, (response, error) in zip(file_ids, execute_batch(service, requests, http=get_thread_http(service))):
+        if error is not None:
+            print(f"No se pudieron obtener los permisos de {file_id}: {error}")
+        else:
+            permissions[file_id] = response.get('permissions', [])
+    return permissions
+
+def get_changes_start_page_token(service):
+    """Returns the Drive Changes page token that marks 'now' for future incremental syncs."""
+    return service.changes().getStartPageToken().execute(http=get_thread_http(service))['startPageToken']
+
+def list_drive_changes(service, page_token):
+    """
+    Lists every change in the user's Drive since `page_token`, including removals
+    and trashed files.
 
-    return all_files
+    Returns:
+        A (changes, new_start_page_token) tuple. Persist the token for the next sync.
+    """
+    # El scheduler y las sesiones de Streamlit sincronizan desde sus propios hilos.
+    http = get_thread_http(service)
+    changes = []
+    while True:
+        response = service.changes().list(
+            pageToken=page_token,
+            spaces='drive',
+            includeRemoved=True,
+            pageSize=1000,
+            fields='nextPageToken, newStartPageToken, '
+                   'changes(fileId, removed, file(id, name, mimeType, modifiedTime, md5Checksum, size, parents, trashed))'
+        ).execute(http=http)
+        changes.extend(response.get('changes', []))
+        if 'newStartPageToken' in response:
+            return changes, response['newStartPageToken']
+        page_token = response['nextPageToken']
 
 # --- Your existing search_drive_files function should remain,
 # as it's useful for targeted searches.
@@ -227,12 +479,12 @@ def update_google_doc_content(doc_id, new_content):
     Note: This is more complex than a simple file upload.
     This example clears and inserts.
     """
-    # Se crea un nuevo servicio de Docs, reusando las credenciales de Drive
-    drive_service = get_drive_service()
-    docs_service = build('docs', 'v1', credentials=drive_service._http.credentials) 
+    # Cliente de Docs compartido; cada hilo usa su propia conexión HTTP
+    docs_service = get_service('docs', 'v1')
+    http = get_thread_http(docs_service)
     
     # 1. Obtener el contenido actual para encontrar su longitud
-    doc = docs_service.documents().get(documentId=doc_id).execute()
+    doc = docs_service.documents().get(documentId=doc_id).execute(http=http)
     # Determinar el final del documento para eliminar el contenido
     # Se necesita el índice final del último elemento de la sección de body/content
     try:
@@ -263,18 +515,19 @@ def update_google_doc_content(doc_id, new_content):
             }
         }
     ]
-    result = docs_service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}).execute()
+    result = docs_service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}).execute(http=http)
     print(f"Google Doc '{doc_id}' actualizado.")
     return result
 
 def append_to_google_doc(service, document_id, text_to_append):
     """Añade texto al final de un Google Doc específico."""
     try:
-        # La API de Docs es un servicio separado que se construye usando las credenciales del servicio de Drive
-        docs_service = build('docs', 'v1', credentials=service._http.credentials)
+        # La API de Docs es un servicio separado; se reutiliza el cliente compartido del proceso
+        docs_service = get_service('docs', 'v1')
+        http = get_thread_http(docs_service)
         
         # Primero, obtenemos el documento para encontrar el final del contenido
-        document = docs_service.documents().get(documentId=document_id).execute()
+        document = docs_service.documents().get(documentId=document_id).execute(http=http)
         end_index = document.get('body').get('content')[-1].get('endIndex') - 1
 
         # Preparamos el texto a insertar, asegurándonos de que empiece en una nueva línea
@@ -288,7 +541,7 @@ def append_to_google_doc(service, document_id, text_to_append):
             }
         }]
         
-        docs_service.documents().batchUpdate(documentId=document_id, body={'requests': requests}).execute()
+        docs_service.documents().batchUpdate(documentId=document_id, body={'requests': requests}).execute(http=http)
         print(f"✅ Texto añadido con éxito al Google Doc ID: {document_id}")
         return True
     except Exception as e:
@@ -298,8 +551,8 @@ def append_to_google_doc(service, document_id, text_to_append):
 def append_row_to_google_sheet(service, spreadsheet_id, row_data):
     """Añade una fila de datos al final de una Google Sheet."""
     try:
-        # La API de Sheets también es un servicio separado
-        sheets_service = build('sheets', 'v4', credentials=service._http.credentials)
+        # La API de Sheets también es un servicio separado; se reutiliza el cliente compartido del proceso
+        sheets_service = get_service('sheets', 'v4')
         
         body = {
             'values': [row_data] # La API espera una lista de listas
@@ -310,7 +563,7 @@ def append_row_to_google_sheet(service, spreadsheet_id, row_data):
             range='A1', # La API encontrará la primera tabla en la hoja 'A1' y añadirá al final
             valueInputOption='USER_ENTERED',
             body=body
-        ).execute()
+        ).execute(http=get_thread_http(sheets_service))
         print(f"✅ Fila añadida con éxito a la Google Sheet ID: {spreadsheet_id}")
         return True
     except Exception as e:
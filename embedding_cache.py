@@ -0,0 +1,168 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import numpy as np
+
+# La caché vive junto a './chroma_db'; borrarla solo obliga a recalcular embeddings.
+DEFAULT_EMBEDDING_CACHE_PATH = "./embedding_cache"
+DEFAULT_EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("LOLA_EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+INITIAL_CAPACITY = 1024
+
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed cache of embeddings.
+
+    Vectors are stored as float16 rows of a memory-mapped array ('vectors.f16') and
+    indexed in SQLite ('index.sqlite') by a hash of the model name and the chunk
+    text, so unchanged text is never embedded twice, even across re-ingestions.
+    Once `max_entries` is reached the least recently used entries are evicted and
+    their rows reused.
+    """
+
+    def __init__(self, model_name, path=DEFAULT_EMBEDDING_CACHE_PATH, max_entries=DEFAULT_EMBEDDING_CACHE_MAX_ENTRIES):
+        self.model_name = model_name
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._clock = 0
+        self._vectors = None
+        self._capacity = 0
+        self.dim = None
+
+        os.makedirs(path, exist_ok=True)
+        self._vectors_path = os.path.join(path, "vectors.f16")
+        self._db = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slot INTEGER NOT NULL, last_used INTEGER NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._db.commit()
+
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        if row:
+            self.dim = int(row[0])
+            self._open_vectors()
+        self._clock = self._db.execute("SELECT COALESCE(MAX(last_used), 0) FROM entries").fetchone()[0]
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _open_vectors(self, min_capacity=0):
+        """Maps the vectors file, growing it (doubling) so it holds at least `min_capacity` rows."""
+        row_bytes = self.dim * np.dtype(np.float16).itemsize
+        current = os.path.getsize(self._vectors_path) // row_bytes if os.path.exists(self._vectors_path) else 0
+        capacity = max(current, INITIAL_CAPACITY)
+        while capacity < min_capacity:
+            capacity *= 2
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        mode = "r+" if current else "w+"
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float16, mode=mode, shape=(capacity, self.dim))
+        self._capacity = capacity
+
+    def _find_slots(self, keys):
+        """Maps each cached key in `keys` to its row in the vectors file."""
+        found = {}
+        for start in range(0, len(keys), 500):  # límite de parámetros de SQLite
+            group = keys[start:start + 500]
+            placeholders = ",".join("?" * len(group))
+            found.update(self._db.execute(f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", group).fetchall())
+        return found
+
+    def get_many(self, texts):
+        """Returns a list with the cached vector (float32) of each text, or None for misses."""
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            found = self._find_slots(keys) if self.dim is not None else {}
+            results = []
+            for key in keys:
+                slot = found.get(key)
+                results.append(np.array(self._vectors[slot], dtype=np.float32) if slot is not None else None)
+            if found:
+                self._clock += 1
+                self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(self._clock, key) for key in found])
+                self._db.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return results
+
+    def put_many(self, texts, vectors):
+        """Stores the vectors of `texts`, evicting least recently used entries past `max_entries`."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(texts):
+            return
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dim', ?)", (str(self.dim),))
+                self._open_vectors()
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Dimensión de embedding {vectors.shape[1]} distinta de la caché ({self.dim}).")
+
+            new_entries = {}
+            for text, vector in zip(texts, vectors):
+                new_entries[self._key(text)] = vector
+            existing = self._find_slots(list(new_entries))
+            pending = [(key, vector) for key, vector in new_entries.items() if key not in existing]
+            if not pending:
+                return
+
+            pending = pending[-self.max_entries:]
+            count = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            next_slot = self._db.execute("SELECT COALESCE(MAX(slot), -1) + 1 FROM entries").fetchone()[0]
+            free_slots = []
+            overflow = count + len(pending) - self.max_entries
+            if overflow > 0:
+                evicted = self._db.execute("SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (overflow,)).fetchall()
+                self._db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+                free_slots = [slot for _, slot in evicted]
+
+            self._clock += 1
+            rows = []
+            for key, vector in pending:
+                if free_slots:
+                    slot = free_slots.pop()
+                else:
+                    slot = next_slot
+                    next_slot += 1
+                if slot >= self._capacity:
+                    self._open_vectors(min_capacity=slot + 1)
+                self._vectors[slot] = vector.astype(np.float16)
+                rows.append((key, slot, self._clock))
+            self._vectors.flush()
+            self._db.executemany("INSERT OR REPLACE INTO entries (key, slot, last_used) VALUES (?, ?, ?)", rows)
+            self._db.commit()
+
+    def embed(self, texts, embed_fn):
+        """Returns the embeddings of `texts`, calling `embed_fn` only for the ones not cached."""
+        cached = self.get_many(texts)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        if missing:
+            computed = embed_fn([texts[i] for i in missing])
+            self.put_many([texts[i] for i in missing], computed)
+            for i, vector in zip(missing, computed):
+                cached[i] = np.asarray(vector, dtype=np.float32)
+        return cached
+
+    def stats(self):
+        """Hit/miss counters since startup and the number of cached embeddings."""
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "max_entries": self.max_entries,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+            self._db.close()
@@ -0,0 +1,189 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Motor de embeddings: 'sentence-transformers' (por defecto), 'onnx' u 'onnx-int8'.
+DEFAULT_EMBEDDING_ENGINE = os.getenv("LOLA_EMBEDDING_ENGINE", "sentence-transformers")
+DEFAULT_EMBEDDING_THREADS = int(os.getenv("LOLA_EMBEDDING_THREADS", "0"))  # 0 = lo que decida la librería
+DEFAULT_EMBEDDING_PROCESSES = int(os.getenv("LOLA_EMBEDDING_PROCESSES", "1"))
+DEFAULT_MODEL_NAME = "all-MiniLM-L6-v2"
+HF_REPO_ID = "sentence-transformers/all-MiniLM-L6-v2"
+MAX_SEQ_LENGTH = 256  # igual que el modelo de sentence-transformers; el texto más largo se trunca
+ONNX_CACHE_DIR = os.getenv("LOLA_ONNX_CACHE_DIR", "./onnx_models")
+
+
+def _length_sorted(texts):
+    """Indices of `texts` from longest to shortest, so each batch pads to similar lengths."""
+    return sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+
+
+class SentenceTransformerEngine:
+    """
+    The all-MiniLM-L6-v2 model through sentence-transformers (PyTorch), with explicit
+    batch size and thread count. Its vectors are the ones the collection was built with.
+    """
+
+    def __init__(self, model_name=DEFAULT_MODEL_NAME, batch_size=64, num_threads=DEFAULT_EMBEDDING_THREADS, model=None):
+        import torch
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+            model = SentenceTransformer(model_name, device="cpu")
+        self.model = model
+        self.batch_size = batch_size
+        # Mismo nombre que el modelo: los embeddings ya cacheados siguen siendo válidos.
+        self.name = model_name
+
+    def __call__(self, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+        order = _length_sorted(texts)
+        vectors = self.model.encode([texts[i] for i in order], batch_size=self.batch_size,
+                                    convert_to_numpy=True, show_progress_bar=False)
+        result = [None] * len(texts)
+        for position, i in enumerate(order):
+            result[i] = vectors[position].astype(np.float32)
+        return result
+
+
+class OnnxEngine:
+    """
+    The same model exported to ONNX and run with ONNX Runtime (mean pooling + L2
+    normalisation, as in the sentence-transformers pipeline). With `quantize=True`
+    the weights are dynamically quantized to int8 once and the result kept on disk;
+    int8 vectors stay close to, but not identical with, the PyTorch ones.
+    """
+
+    def __init__(self, batch_size=64, num_threads=DEFAULT_EMBEDDING_THREADS, quantize=False,
+                 repo_id=HF_REPO_ID, cache_dir=ONNX_CACHE_DIR):
+        import onnxruntime
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer
+
+        model_path = hf_hub_download(repo_id, "onnx/model.onnx", cache_dir=cache_dir)
+        if quantize:
+            model_path = self._quantized_model(model_path, cache_dir)
+
+        self.tokenizer = Tokenizer.from_file(hf_hub_download(repo_id, "tokenizer.json", cache_dir=cache_dir))
+        self.tokenizer.enable_truncation(max_length=MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding()
+
+        options = onnxruntime.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.batch_size = batch_size
+        self.name = f"{DEFAULT_MODEL_NAME}/onnx" + ("-int8" if quantize else "")
+
+    @staticmethod
+    def _quantized_model(model_path, cache_dir):
+        quantized_path = os.path.join(cache_dir, "all-MiniLM-L6-v2-int8.onnx")
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            print("⚙️ Cuantizando el modelo de embeddings a int8 (solo la primera vez)...")
+            os.makedirs(cache_dir, exist_ok=True)
+            quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+        return quantized_path
+
+    def _encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+        token_embeddings = self.session.run(None, inputs)[0]
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def __call__(self, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+        order = _length_sorted(texts)
+        result = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            group = order[start:start + self.batch_size]
+            for i, vector in zip(group, self._encode_batch([texts[i] for i in group])):
+                result[i] = vector.astype(np.float32)
+        return result
+
+
+# --- Pool multiproceso para ingestas masivas ---
+_worker_engine = None
+
+
+def _init_worker(engine_name, batch_size, num_threads):
+    global _worker_engine
+    _worker_engine = _build_engine(engine_name, batch_size, num_threads)
+
+
+def _encode_in_worker(texts):
+    return _worker_engine(texts)
+
+
+class MultiProcessEngine:
+    """
+    Spreads large batches over `processes` worker processes, each with its own copy
+    of the engine (and `num_threads` threads). Batches smaller than
+    `min_parallel_batch` (e.g. a single query) run on a local engine instead, so
+    queries never pay the inter-process round trip.
+    """
+
+    def __init__(self, engine_name, processes, batch_size=64, num_threads=1, min_parallel_batch=None, local_engine=None):
+        self.local_engine = local_engine or _build_engine(engine_name, batch_size, DEFAULT_EMBEDDING_THREADS)
+        self.name = self.local_engine.name
+        self.processes = processes
+        self.batch_size = batch_size
+        self.min_parallel_batch = min_parallel_batch or 2 * batch_size
+        # 'spawn': cada proceso carga su propio modelo sin heredar hilos del proceso principal.
+        self.pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker, initargs=(engine_name, batch_size, num_threads))
+
+    def __call__(self, texts):
+        texts = list(texts)
+        if len(texts) < self.min_parallel_batch:
+            return self.local_engine(texts)
+        # Trozos contiguos tras ordenar por longitud: cada proceso recibe textos de tamaño parecido.
+        order = _length_sorted(texts)
+        part_size = -(-len(texts) // self.processes)
+        parts = [order[start:start + part_size] for start in range(0, len(order), part_size)]
+        futures = [self.pool.submit(_encode_in_worker, [texts[i] for i in part]) for part in parts]
+        result = [None] * len(texts)
+        for part, future in zip(parts, futures):
+            for i, vector in zip(part, future.result()):
+                result[i] = vector
+        return result
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _build_engine(engine_name, batch_size, num_threads, model=None):
+    if engine_name == "sentence-transformers":
+        return SentenceTransformerEngine(batch_size=batch_size, num_threads=num_threads, model=model)
+    if engine_name in ("onnx", "onnx-int8"):
+        return OnnxEngine(batch_size=batch_size, num_threads=num_threads, quantize=engine_name == "onnx-int8")
+    raise ValueError(f"Motor de embeddings desconocido: '{engine_name}'")
+
+
+def create_embedding_engine(engine_name=DEFAULT_EMBEDDING_ENGINE, batch_size=64, num_threads=DEFAULT_EMBEDDING_THREADS,
+                            processes=DEFAULT_EMBEDDING_PROCESSES, model=None):
+    """
+    Builds the configured embedding engine: a callable mapping a list of texts to a
+    list of float32 vectors, with a `name` identifying the model and backend.
+    `model` lets the sentence-transformers engine reuse an already loaded model.
+    """
+    local_engine = _build_engine(engine_name, batch_size, num_threads, model=model)
+    if processes > 1:
+        # Reparte los hilos disponibles entre los procesos para no sobresuscribir la CPU.
+        threads_per_process = num_threads or max(1, (os.cpu_count() or 1) // processes)
+        return MultiProcessEngine(engine_name, processes, batch_size=batch_size, num_threads=threads_per_process,
+                                  local_engine=local_engine)
+    return local_engine
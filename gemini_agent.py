@@ -1,6 +1,7 @@
 import os
 from dotenv import load_dotenv
 import google.generativeai as genai
+from llm_cache import CachedGenerativeModel
 
 load_dotenv()
 
@@ -15,7 +16,7 @@ try:
     # Use the stable model name to prevent potential 404 errors during summarization.
     LLM_MODEL_NAME = 'models/gemini-pro-latest' 
     
-    general_gemini_model = genai.GenerativeModel(LLM_MODEL_NAME)
+    general_gemini_model = CachedGenerativeModel(genai.GenerativeModel(LLM_MODEL_NAME))
     print(f"✅ Cliente Gemini configurado para operaciones generales usando '{LLM_MODEL_NAME}'.")
 
 except Exception as e:
@@ -35,7 +36,7 @@ def summarize_text_with_gemini(text_content, context_prompt="Eres Lola Agent, un
     
     try:
         # This is a text generation call, which is correct for this file's purpose.
-        response = general_gemini_model.generate_content(full_prompt)
+        response = general_gemini_model.generate_content(full_prompt, stage="summarization")
         return response.text
         
     except Exception as e:
@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+
+# El manifiesto vive junto a './chroma_db' para que ambos se persistan (o se borren) juntos.
+DEFAULT_MANIFEST_PATH = "./chroma_db_manifest.json"
+MANIFEST_VERSION = 1
+
+
+class IngestManifest:
+    """
+    Persistent record of what has been indexed from Google Drive.
+
+    Entries are keyed by Drive file_id and store the file's 'modifiedTime',
+    'md5Checksum' and the chunk ids written to ChromaDB, so a restart can skip
+    unchanged files, re-index modified ones and purge the ones that disappeared.
+    Sync state (the Drive Changes page token, the known folder tree, files whose
+    indexing must be retried) is kept alongside in `state`.
+    """
+
+    def __init__(self, path=DEFAULT_MANIFEST_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.files = {}
+        self.state = {}
+        self.load()
+
+    def load(self):
+        """Loads the manifest from disk. A missing or corrupt file starts an empty manifest."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != MANIFEST_VERSION:
+                print(f"⚠️ Versión de manifiesto incompatible en {self.path}. Se reindexará todo.")
+                return
+            self.files = data.get("files", {})
+            self.state = data.get("state", {})
+            print(f"📒 Manifiesto de ingesta cargado: {len(self.files)} archivos registrados.")
+        except Exception as e:
+            print(f"⚠️ No se pudo leer el manifiesto {self.path}, se reindexará todo: {e}")
+            self.files = {}
+            self.state = {}
+
+    def save(self):
+        """Writes the manifest atomically so a crash never leaves a half-written file."""
+        with self._lock:
+            data = {"version": MANIFEST_VERSION, "files": self.files, "state": self.state}
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(f"Error al guardar el manifiesto de ingesta {self.path}: {e}")
+
+    def get(self, file_id):
+        return self.files.get(file_id)
+
+    def is_unchanged(self, file):
+        """True if the Drive file listing matches what was indexed last time."""
+        entry = self.files.get(file["id"])
+        if not entry or not entry.get("complete", True):
+            return False
+        # Google-native files (Docs, Sheets, Slides) have no md5Checksum, so modifiedTime decides.
+        return (entry.get("modifiedTime") == file.get("modifiedTime")
+                and entry.get("md5Checksum") == file.get("md5Checksum"))
+
+    def record(self, file, chunk_ids, complete=True):
+        """
+        Stores the state of a freshly indexed file. With `complete=False` some of its
+        chunks could not be written: `chunk_ids` are the ones that were, and the file is
+        re-indexed on the next sync.
+        """
+        with self._lock:
+            self.files[file["id"]] = {
+                "file_name": file.get("name"),
+                "mime_type": file.get("mimeType"),
+                "modifiedTime": file.get("modifiedTime"),
+                "md5Checksum": file.get("md5Checksum"),
+                "parents": file.get("parents", []),
+                "chunk_ids": list(chunk_ids),
+                "complete": complete,
+            }
+
+    def refresh(self, file):
+        """
+        Updates the name and parents of an unchanged file. Moving or renaming a file does not
+        change its content (nor, always, its 'modifiedTime'), but the sync needs the current parents.
+        """
+        with self._lock:
+            entry = self.files.get(file["id"])
+            if entry is None:
+                return
+            if "name" in file:
+                entry["file_name"] = file["name"]
+            if "parents" in file:
+                entry["parents"] = list(file["parents"])
+
+    def remove(self, file_id):
+        """Forgets a file and returns the chunk ids it had in the knowledge base."""
+        with self._lock:
+            entry = self.files.pop(file_id, None)
+        return entry.get("chunk_ids", []) if entry else []
+
+    def file_ids(self):
+        return set(self.files.keys())
+
+    def get_state(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set_state(self, key, value):
+        with self._lock:
+            self.state[key] = value
+
+    def clear(self):
+        with self._lock:
+            self.files = {}
+            self.state = {}
@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Valores por defecto del pipeline de ingesta; se pueden ajustar desde el .env.
+DEFAULT_DOWNLOAD_WORKERS = int(os.getenv("LOLA_DOWNLOAD_WORKERS", "4"))
+DEFAULT_EXTRACT_WORKERS = int(os.getenv("LOLA_EXTRACT_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+
+_FEEDER_DONE = object()
+
+
+def process_files_concurrently(files, download_fn, extract_fn, download_workers=DEFAULT_DOWNLOAD_WORKERS,
+                               extract_workers=DEFAULT_EXTRACT_WORKERS, max_in_flight=None):
+    """
+    Staged download -> extract pipeline over `files`.
+
+    `download_fn(file)` runs on a thread pool (network-bound) and returns a payload.
+    `extract_fn(payload)` runs on a process pool (CPU-bound), so it must be a
+    picklable top-level function or a functools.partial of one. With
+    `extract_workers=0` it runs inline in the download thread instead.
+
+    Yields `(file, result, error)` tuples in completion order. At most `max_in_flight`
+    files are held between the start of their download and the moment the consumer
+    picks up their result, so a slow indexer applies back-pressure to the downloads.
+    A failure in one file is reported as its `error` and never stops the others. If
+    iterating `files` itself raises, the files already submitted are still yielded and
+    the exception is then re-raised, so an interrupted listing never looks complete.
+    """
+    if max_in_flight is None:
+        max_in_flight = 2 * (download_workers + max(extract_workers, 1))
+
+    results = queue.Queue()
+    slots = threading.BoundedSemaphore(max_in_flight)
+    stop = threading.Event()
+
+    download_pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="lola-download")
+    extract_pool = None
+    if extract_workers > 0:
+        # 'spawn' evita hacer fork de un proceso con hilos activos (descargas, scheduler, Streamlit).
+        extract_pool = ProcessPoolExecutor(max_workers=extract_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def on_extracted(file, future):
+        try:
+            results.put((file, future.result(), None))
+        except Exception as e:
+            results.put((file, None, e))
+
+    def download_and_extract(file):
+        if stop.is_set():
+            results.put((file, None, RuntimeError("Pipeline detenido")))
+            return
+        try:
+            payload = download_fn(file)
+            if extract_pool is None:
+                results.put((file, extract_fn(payload), None))
+                return
+            future = extract_pool.submit(extract_fn, payload)
+        except Exception as e:
+            results.put((file, None, e))
+            return
+        future.add_done_callback(lambda f: on_extracted(file, f))
+
+    def feeder():
+        submitted = 0
+        error = None
+        try:
+            for file in files:
+                while not slots.acquire(timeout=0.5):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    slots.release()
+                    return
+                download_pool.submit(download_and_extract, file)
+                submitted += 1
+        except Exception as e:
+            error = e
+        finally:
+            results.put((_FEEDER_DONE, submitted, error))
+
+    feeder_thread = threading.Thread(target=feeder, name="lola-ingest-feeder", daemon=True)
+    feeder_thread.start()
+
+    received = 0
+    expected = None
+    feeder_error = None
+    try:
+        while expected is None or received < expected:
+            file, result, error = results.get()
+            if file is _FEEDER_DONE:
+                expected, feeder_error = result, error
+                continue
+            received += 1
+            slots.release()
+            yield file, result, error
+        if feeder_error is not None:
+            raise feeder_error
+    finally:
+        stop.set()
+        feeder_thread.join()
+        download_pool.shutdown(wait=True, cancel_futures=True)
+        if extract_pool is not None:
+            extract_pool.shutdown(wait=True, cancel_futures=True)
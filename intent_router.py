@@ -0,0 +1,107 @@
+import os
+import threading
+import numpy as np
+
+# Similitud coseno mínima con el centroide ganador y ventaja mínima sobre el segundo;
+# por debajo de cualquiera de las dos se consulta al LLM.
+ROUTER_MIN_SIMILARITY = float(os.getenv("LOLA_ROUTER_MIN_SIMILARITY", "0.45"))
+ROUTER_MIN_MARGIN = float(os.getenv("LOLA_ROUTER_MIN_MARGIN", "0.05"))
+
+INTENT_EXAMPLES = {
+    "qa": [
+        "¿Quién es el CEO?",
+        "¿Cuál es el precio del plan premium?",
+        "¿Cuándo es la próxima reunión con el cliente?",
+        "¿Qué dice el contrato sobre los plazos de pago?",
+        "¿Dónde está la oficina de Madrid?",
+        "¿Cuántos empleados tiene la empresa?",
+        "¿Qué es el modelo freemium?",
+        "Info del itinerario del viaje",
+        "¿Qué fecha tiene la entrega del proyecto?",
+        "¿Cómo funciona el producto?",
+    ],
+    "generation": [
+        "Redacta un email para el cliente",
+        "Escribe un post para LinkedIn sobre el lanzamiento",
+        "Crea un tweet anunciando la nueva función",
+        "Genera un resumen para la newsletter",
+        "Prepara una presentación para inversores",
+        "Hazme un borrador de comunicado de prensa",
+        "Escribe un correo de bienvenida para nuevos usuarios",
+        "Crea un guion para un vídeo promocional",
+    ],
+    "analysis": [
+        "¿Cuáles son nuestros riesgos?",
+        "¿Qué recomiendas para mejorar las ventas?",
+        "Analiza nuestra posición frente a la competencia",
+        "Dame tu opinión sobre la estrategia de precios",
+        "¿Cuáles son las fortalezas y debilidades del proyecto?",
+        "¿Deberíamos entrar en el mercado mexicano?",
+        "Haz un análisis DAFO de la empresa",
+        "¿Qué oportunidades de crecimiento ves?",
+    ],
+    "writing": [
+        "Añade esto al Q&A",
+        "Actualiza el itinerario con esta reunión",
+        "Registra esta venta en la hoja de cálculo",
+        "Escribe en el documento de notas que la reunión se movió al lunes",
+        "Agrega una fila con los datos del nuevo cliente",
+        "Guarda esta información en el documento de preguntas frecuentes",
+        "Apunta en el acta que el presupuesto fue aprobado",
+        "Modifica el documento del itinerario para incluir el vuelo",
+    ],
+}
+
+
+class IntentRouter:
+    """
+    Nearest-centroid intent classifier over the knowledge base's embedding model.
+    Each intent's centroid is the normalised mean of its example utterances;
+    `route()` returns the closest intent, or None when the match is not confident
+    enough and the caller should ask the LLM instead.
+    """
+
+    def __init__(self, embed_fn, examples=INTENT_EXAMPLES, min_similarity=ROUTER_MIN_SIMILARITY,
+                 min_margin=ROUTER_MIN_MARGIN):
+        self.embed_fn = embed_fn
+        self.examples = examples
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+        self.labels = list(examples)
+        self._centroids = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / np.clip(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12, None)
+
+    def _get_centroids(self):
+        # Los ejemplos se embeben una sola vez, en la primera consulta.
+        with self._lock:
+            if self._centroids is None:
+                centroids = []
+                for label in self.labels:
+                    vectors = self._normalize(self.embed_fn(self.examples[label]))
+                    centroids.append(vectors.mean(axis=0))
+                self._centroids = self._normalize(centroids)
+            return self._centroids
+
+    def scores(self, query_text):
+        """Cosine similarity of the query to each intent centroid, as {label: score}."""
+        query_vector = self._normalize(self.embed_fn([query_text])[0])
+        similarities = self._get_centroids() @ query_vector
+        return dict(zip(self.labels, similarities.tolist()))
+
+    def route(self, query_text):
+        """
+        Returns `(label, scores)`. `label` is None if the best similarity is below
+        `min_similarity` or not at least `min_margin` ahead of the runner-up.
+        """
+        scores = self.scores(query_text)
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        best = scores[ranked[0]]
+        runner_up = scores[ranked[1]] if len(ranked) > 1 else -1.0
+        if best < self.min_similarity or best - runner_up < self.min_margin:
+            return None, scores
+        return ranked[0], scores
@@ -1,39 +1,107 @@
+import os
+import threading
+from collections import OrderedDict
 import chromadb
-from chromadb.utils import embedding_functions
+from embedding_cache import EmbeddingCache
+from embedding_engines import create_embedding_engine, DEFAULT_EMBEDDING_ENGINE
+from lexical_index import LexicalIndex
 
-# NOTE: We no longer need 'google.generativeai', 'os', or 'dotenv' in this file
-# because we are handling embeddings locally.
+# Número de fragmentos por pasada del modelo de embeddings (configurable, 64-256 es razonable en CPU).
+DEFAULT_EMBEDDING_BATCH_SIZE = int(os.getenv("LOLA_EMBEDDING_BATCH_SIZE", "128"))
+# Límite de seguridad si la versión de ChromaDB no expone get_max_batch_size().
+FALLBACK_MAX_BATCH_SIZE = 5000
+# Caché en disco de embeddings por contenido (LOLA_EMBEDDING_CACHE=0 la desactiva).
+EMBEDDING_CACHE_ENABLED = os.getenv("LOLA_EMBEDDING_CACHE", "1") == "1"
+# Embeddings de consultas recientes en memoria (0 la desactiva).
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("LOLA_QUERY_CACHE_SIZE", "1024"))
+# Constante k de Reciprocal Rank Fusion (60 es el valor habitual).
+RRF_K = 60
+# Índice léxico BM25 en paralelo a ChromaDB (LOLA_LEXICAL_INDEX=0 lo desactiva).
+LEXICAL_INDEX_ENABLED = os.getenv("LOLA_LEXICAL_INDEX", "1") == "1"
+
+def normalize_query(query_text):
+    """Key for the query cache. all-MiniLM-L6-v2 is uncased, so case and spacing don't change the embedding."""
+    return " ".join(query_text.lower().split())
+
+class QueryEmbeddingCache:
+    """Bounded, thread-safe LRU map from normalised query text to its embedding, with hit/miss counters."""
+
+    def __init__(self, max_size=QUERY_EMBEDDING_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, key, embedding):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+            }
 
 class KnowledgeBase:
-    def __init__(self, collection_name="chainbrief_docs"):
+    def __init__(self, collection_name="chainbrief_docs", embedding_batch_size=DEFAULT_EMBEDDING_BATCH_SIZE,
+                 embedding_engine=DEFAULT_EMBEDDING_ENGINE):
         """
-        Initializes the KnowledgeBase using a local sentence-transformer model for embeddings.
-        This runs on your machine and does not require an API key or internet connection
-        after the initial model download.
+        Initializes the KnowledgeBase with local embeddings computed by `embedding_engine`
+        ('sentence-transformers', 'onnx', 'onnx-int8' or an engine object). This runs on
+        your machine and does not require an API key or internet connection after the
+        initial model download.
         """
         self.is_functional = False
         self.collection = None
+        self.embedding_batch_size = embedding_batch_size
+        self.embedding_cache = None
+        self.embedding_engine = None
+        self.query_cache = QueryEmbeddingCache()
+        self.lexical_index = None
+        # Sube con cada cambio de contenido; las cachés de respuestas lo usan para no servir respuestas obsoletas.
+        self.version = 0
         
         try:
             # Initialize the ChromaDB client, which will store data in the './chroma_db' directory.
             self.client = chromadb.PersistentClient(path="./chroma_db")
             
-            # --- THE KEY CHANGE IS HERE ---
-            # Use a built-in, high-performance SentenceTransformer model for local embeddings.
-            # The model 'all-MiniLM-L6-v2' is small, fast, and effective for semantic search.
-            # It will be downloaded automatically by the library on the first run.
-            print("🧠 Inicializando función de embedding local (modelo: all-MiniLM-L6-v2)...")
-            self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-                model_name="all-MiniLM-L6-v2"
-            )
-            
-            # Create or get the collection, now configured to use the local embedding function.
-            self.collection = self.client.get_or_create_collection(
-                name=collection_name,
-                embedding_function=self.embedding_function
-            )
+            # El motor que calcula los embeddings (sentence-transformers, ONNX, int8, multiproceso).
+            # ChromaDB no carga ningún modelo propio: todos los embeddings se le pasan ya calculados,
+            # así que con ONNX no hace falta PyTorch.
+            self.embedding_engine = self._create_embedding_engine(embedding_engine, embedding_batch_size)
+            print(f"⚙️ Motor de embeddings: {self.embedding_engine.name}")
+            if EMBEDDING_CACHE_ENABLED:
+                try:
+                    self.embedding_cache = EmbeddingCache(model_name=self.embedding_engine.name)
+                except Exception as e:
+                    print(f"⚠️ No se pudo abrir la caché de embeddings, se calcularán siempre: {e}")
+
+            self.collection = self.client.get_or_create_collection(name=collection_name, embedding_function=None)
             print(f"✅ ChromaDB collection '{collection_name}' inicializada con éxito usando embeddings locales.")
             self.is_functional = True
+            if LEXICAL_INDEX_ENABLED:
+                self._load_lexical_index()
 
         except Exception as e:
             print("="*60)
@@ -41,26 +109,182 @@ class KnowledgeBase:
             print("La búsqueda semántica (RAG) estará deshabilitada.")
             print("="*60)
 
+    @staticmethod
+    def _create_embedding_engine(embedding_engine, batch_size):
+        """
+        Builds the engine named `embedding_engine` (an engine object is used as is),
+        falling back to sentence-transformers if the selected one cannot be created.
+        """
+        if not isinstance(embedding_engine, str):
+            return embedding_engine
+        try:
+            return create_embedding_engine(embedding_engine, batch_size=batch_size)
+        except Exception as e:
+            if embedding_engine == "sentence-transformers":
+                raise
+            print(f"⚠️ No se pudo crear el motor de embeddings '{embedding_engine}', se usa sentence-transformers: {e}")
+            return create_embedding_engine("sentence-transformers", batch_size=batch_size)
+
+    def _load_lexical_index(self):
+        """Opens the BM25 index and rebuilds it from the collection if it is missing or out of sync."""
+        try:
+            self.lexical_index = LexicalIndex()
+            total = self.collection.count()
+            if len(self.lexical_index) == total:
+                return
+            print(f"🔤 Reconstruyendo el índice léxico desde ChromaDB ({total} fragmentos)...")
+            self.lexical_index.clear()
+            page_size = self._max_batch_size()
+            for offset in range(0, total, page_size):
+                page = self.collection.get(include=["documents"], limit=page_size, offset=offset)
+                self.lexical_index.add(page['ids'], page['documents'])
+            self.lexical_index.save(force=True)
+        except Exception as e:
+            print(f"⚠️ No se pudo preparar el índice léxico; solo habrá búsqueda semántica: {e}")
+            self.lexical_index = None
+
+    def _content_changed(self):
+        self.version += 1
+
+    def _index_lexically(self, ids, documents):
+        self._content_changed()
+        if self.lexical_index is not None:
+            self.lexical_index.add(ids, documents)
+            self.lexical_index.save()
+
+    def save_lexical_index(self):
+        """Persists pending changes of the BM25 index (autosaves are throttled)."""
+        if self.lexical_index is not None:
+            self.lexical_index.save(force=True)
+
     def add_document(self, doc_id, content, metadata):
         """Adds a single document chunk to the collection."""
         if not self.is_functional: return
         try:
-            # The embedding is now handled automatically by the collection's configured function.
-            self.collection.add(documents=[content], metadatas=[metadata], ids=[doc_id])
+            self.collection.add(documents=[content], embeddings=self._embed([content]), metadatas=[metadata], ids=[doc_id])
+            self._index_lexically([doc_id], [content])
             print(f"Added document chunk {doc_id} to knowledge base.")
         except Exception as e:
             print(f"Error al añadir documento {doc_id} a ChromaDB: {e}")
 
+    def _max_batch_size(self):
+        """Largest batch ChromaDB accepts in a single write."""
+        try:
+            return self.client.get_max_batch_size()
+        except Exception:
+            return FALLBACK_MAX_BATCH_SIZE
+
+    def _embed(self, documents):
+        """Embeds `documents`, reusing cached embeddings for text already seen."""
+        if self.embedding_cache is None:
+            return self.embedding_engine(documents)
+        return self.embedding_cache.embed(documents, self.embedding_engine)
+
+    def embedding_cache_stats(self):
+        """Hit/miss counters of the embedding cache, or None if it is disabled."""
+        return self.embedding_cache.stats() if self.embedding_cache else None
+
+    def _write_in_batches(self, write, batch, action, failed_ids=None):
+        """
+        Embeds `batch` ({'id', 'content', 'metadata'} dicts) in groups of
+        `embedding_batch_size` and writes each group with a single Chroma call.
+        Returns the number of chunks written; the ids of chunks whose group could not
+        be written are appended to `failed_ids`, if given.
+        """
+        if not self.is_functional or not batch:
+            if failed_ids is not None:
+                failed_ids.extend(chunk['id'] for chunk in batch)
+            return 0
+        batch_size = max(1, min(self.embedding_batch_size, self._max_batch_size()))
+        written = 0
+        for start in range(0, len(batch), batch_size):
+            group = batch[start:start + batch_size]
+            ids = [chunk['id'] for chunk in group]
+            try:
+                documents = [chunk['content'] for chunk in group]
+                embeddings = self._embed(documents)
+                write(ids=ids, documents=documents, metadatas=[chunk['metadata'] for chunk in group], embeddings=embeddings)
+                self._index_lexically(ids, documents)
+                written += len(group)
+            except Exception as e:
+                print(f"Error al {action} el lote de {len(group)} fragmentos ({ids[0]}...) en ChromaDB: {e}")
+                if failed_ids is not None:
+                    failed_ids.extend(ids)
+        cache_stats = self.embedding_cache_stats()
+        cache_note = f", caché de embeddings: {cache_stats['hits']} aciertos / {cache_stats['misses']} fallos" if cache_stats else ""
+        print(f"✅ {written}/{len(batch)} fragmentos escritos en la base de conocimiento (lotes de {batch_size}{cache_note}).")
+        return written
+
+    def add_documents(self, batch, failed_ids=None):
+        """Adds many document chunks, embedding them in batches. `batch` is a list of {'id', 'content', 'metadata'}."""
+        return self._write_in_batches(self.collection.add if self.collection else None, batch, "añadir", failed_ids)
+
+    def upsert_documents(self, batch, failed_ids=None):
+        """Adds or replaces many document chunks, embedding them in batches (failed ids go to `failed_ids`)."""
+        return self._write_in_batches(self.collection.upsert if self.collection else None, batch, "actualizar", failed_ids)
+
     def update_document(self, doc_id, new_content, new_metadata):
         """Updates a document by deleting the old version and adding the new one."""
         if not self.is_functional: return
         try:
             # Using upsert is more efficient for updating
-            self.collection.upsert(documents=[new_content], metadatas=[new_metadata], ids=[doc_id])
+            self.collection.upsert(documents=[new_content], embeddings=self._embed([new_content]), metadatas=[new_metadata],
+                                   ids=[doc_id])
+            self._index_lexically([doc_id], [new_content])
             print(f"Updated (upserted) document chunk {doc_id} in knowledge base.")
         except Exception as e:
             print(f"Error al actualizar documento {doc_id} en ChromaDB: {e}")
 
+    def update_metadatas(self, batch):
+        """Replaces the metadata of existing chunks without re-embedding their content."""
+        if not self.is_functional or not batch: return
+        try:
+            max_batch = self._max_batch_size()
+            for start in range(0, len(batch), max_batch):
+                group = batch[start:start + max_batch]
+                self.collection.update(ids=[chunk['id'] for chunk in group], metadatas=[chunk['metadata'] for chunk in group])
+                self._content_changed()
+        except Exception as e:
+            print(f"Error al actualizar metadatos en ChromaDB: {e}")
+
+    def delete_documents(self, doc_ids):
+        """Deletes the given chunk ids from the collection."""
+        if not self.is_functional or not doc_ids: return
+        try:
+            self.collection.delete(ids=list(doc_ids))
+            self._content_changed()
+            if self.lexical_index is not None:
+                self.lexical_index.delete(doc_ids)
+                self.lexical_index.save()
+            print(f"Deleted {len(doc_ids)} document chunks from knowledge base.")
+        except Exception as e:
+            print(f"Error al eliminar documentos de ChromaDB: {e}")
+
+    def delete_file(self, file_id):
+        """Deletes every chunk of a Drive file, found by its 'file_id' metadata. Returns how many were deleted."""
+        if not self.is_functional: return 0
+        try:
+            chunk_ids = self.collection.get(where={"file_id": file_id}, include=[])['ids']
+        except Exception as e:
+            print(f"Error al buscar los fragmentos del archivo {file_id} en ChromaDB: {e}")
+            return 0
+        self.delete_documents(chunk_ids)
+        return len(chunk_ids)
+
+    def get_all_file_ids(self):
+        """Returns the set of Drive file ids that have chunks in the collection."""
+        if not self.is_functional:
+            return set()
+        file_ids = set()
+        try:
+            page_size = self._max_batch_size()
+            for offset in range(0, self.collection.count(), page_size):
+                page = self.collection.get(include=["metadatas"], limit=page_size, offset=offset)
+                file_ids.update(meta.get('file_id') for meta in page['metadatas'] if meta and meta.get('file_id'))
+        except Exception as e:
+            print(f"Error al obtener los archivos de la base de conocimiento: {e}")
+        return file_ids
+
     def count_documents(self):
         """Returns the total number of chunks in the database."""
         if not self.is_functional:
@@ -71,20 +295,150 @@ class KnowledgeBase:
             print(f"Error al contar documentos en ChromaDB: {e}")
             return 0
 
-    def query(self, query_text, n_results=5):
-        """Queries the collection for documents similar to the query text."""
+    def embed_queries(self, query_texts):
+        """Embeds query texts, reusing the embeddings of recently seen queries."""
+        keys = [normalize_query(text) for text in query_texts]
+        embeddings = [self.query_cache.get(key) for key in keys]
+        missing = {}
+        for key, embedding in zip(keys, embeddings):
+            if embedding is None:
+                missing.setdefault(key, None)
+        if missing:
+            # Un solo pase del modelo para todas las consultas nuevas.
+            for key, embedding in zip(missing, self.embedding_engine(list(missing))):
+                missing[key] = embedding
+                self.query_cache.put(key, embedding)
+            embeddings = [missing[key] if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+        return embeddings
+
+    def query_cache_stats(self):
+        """Hit/miss counters of the in-memory query-embedding cache."""
+        return self.query_cache.stats()
+
+    def lexical_search(self, query_text, n_results=5):
+        """BM25 matches for the query as `(chunk_id, score)` pairs, best first (empty if the index is disabled)."""
+        if self.lexical_index is None:
+            return []
+        return self.lexical_index.search(query_text, n_results=n_results)
+
+    def lexical_coverage(self, query_text):
+        """Fraction of the query's terms known to the BM25 index (None if disabled or the query has no terms)."""
+        if self.lexical_index is None:
+            return None
+        return self.lexical_index.term_coverage(query_text)
+
+    def _fetch_chunks(self, chunk_ids):
+        """Documents and metadata of the given chunk ids, as {id: (document, metadata)}."""
+        if not chunk_ids:
+            return {}
+        found = self.collection.get(ids=list(chunk_ids), include=["documents", "metadatas"])
+        return {chunk_id: (document, metadata)
+                for chunk_id, document, metadata in zip(found['ids'], found['documents'], found['metadatas'])}
+
+    def _fuse_rankings(self, rankings, chunks, limit=None):
+        """
+        Merges ranked id lists with reciprocal rank fusion into a single-query shaped
+        result, best first. `chunks` maps each id to its (document, metadata); ids
+        missing from it (e.g. lexical hits) are fetched from the collection.
+        """
+        scores = {}
+        for ranking in rankings:
+            for rank, chunk_id in enumerate(ranking):
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+        ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+        chunks = dict(chunks)
+        chunks.update(self._fetch_chunks([chunk_id for chunk_id in ranked if chunk_id not in chunks]))
+        # Un id del índice léxico que ya no esté en ChromaDB se descarta.
+        ranked = [chunk_id for chunk_id in ranked if chunk_id in chunks]
+        return {
+            'ids': [ranked],
+            'documents': [[chunks[chunk_id][0] for chunk_id in ranked]],
+            'metadatas': [[chunks[chunk_id][1] for chunk_id in ranked]],
+            'scores': [[scores[chunk_id] for chunk_id in ranked]],
+        }
+
+    @staticmethod
+    def _chunks_from_results(results):
+        """Maps chunk id -> (document, metadata) for every chunk in a Chroma query result."""
+        all_ids = results.get('ids') or []
+        all_metadatas = results.get('metadatas') or [[None] * len(ids) for ids in all_ids]
+        chunks = {}
+        for ids, documents, metadatas in zip(all_ids, results['documents'], all_metadatas):
+            for chunk_id, document, metadata in zip(ids, documents, metadatas):
+                chunks.setdefault(chunk_id, (document, metadata))
+        return chunks
+
+    def merge_results(self, results_list, limit=None):
+        """Fuses several single-query shaped results (e.g. from query_many) with reciprocal rank fusion."""
+        rankings, chunks = [], {}
+        for results in results_list:
+            if results and results.get('ids'):
+                rankings.append(results['ids'][0])
+                chunks.update(self._chunks_from_results(results))
+        return self._fuse_rankings(rankings, chunks, limit=limit)
+
+    def query(self, query_text, n_results=5, mode="vector"):
+        """
+        Queries the collection for documents similar to the query text.
+        `mode` is 'vector' (semantic search), 'lexical' (BM25 only) or 'hybrid'
+        (both rankings fused with reciprocal rank fusion).
+        """
         if not self.is_functional:
             print("❌ ChromaDB no funcional. Consulta fallida.")
             return {'documents': [[]], 'metadatas': [[]]}
-        
+        if mode != "vector" and self.lexical_index is None:
+            mode = "vector"
+
         try:
+            if mode == "lexical":
+                hits = [chunk_id for chunk_id, _ in self.lexical_search(query_text, n_results=n_results)]
+                return self._fuse_rankings([hits], {})
+            if mode == "hybrid":
+                # Más candidatos de cada lado para que la fusión tenga donde elegir.
+                results = self.collection.query(
+                    query_embeddings=self.embed_queries([query_text]),
+                    n_results=2 * n_results,
+                )
+                hits = [chunk_id for chunk_id, _ in self.lexical_search(query_text, n_results=2 * n_results)]
+                return self._fuse_rankings([results['ids'][0], hits], self._chunks_from_results(results), limit=n_results)
             return self.collection.query(
-                query_texts=[query_text],
+                query_embeddings=self.embed_queries([query_text]),
                 n_results=n_results,
             )
         except Exception as e:
             print(f"Error en la consulta de ChromaDB: {e}")
             return {'documents': [[]], 'metadatas': [[]]}
+
+    def query_many(self, query_texts, n_results=3, limit=None, mode="vector"):
+        """
+        Runs several queries with one embedding pass and one Chroma search, and merges
+        the per-query rankings with reciprocal rank fusion (deduplicated by chunk id).
+        With `mode='hybrid'` each query's BM25 ranking is fused in as well.
+        Returns a single-query shaped result ({'ids': [[...]], 'documents': [[...]], ...}),
+        best first, with at most `limit` chunks.
+        """
+        empty = {'ids': [[]], 'documents': [[]], 'metadatas': [[]]}
+        if not self.is_functional:
+            print("❌ ChromaDB no funcional. Consulta fallida.")
+            return empty
+        # Consultas repetidas (mismo texto normalizado) solo se buscan una vez.
+        query_texts = list(dict.fromkeys(normalize_query(text) for text in query_texts if text and text.strip()))
+        if not query_texts:
+            return empty
+
+        try:
+            results = self.collection.query(
+                query_embeddings=self.embed_queries(query_texts),
+                n_results=n_results,
+            )
+            rankings = list(results.get('ids') or [])
+            if mode == "hybrid" and self.lexical_index is not None:
+                for query_text in query_texts:
+                    rankings.append([chunk_id for chunk_id, _ in self.lexical_search(query_text, n_results=n_results)])
+            return self._fuse_rankings(rankings, self._chunks_from_results(results), limit=limit)
+        except Exception as e:
+            print(f"Error en la consulta de ChromaDB: {e}")
+            return empty
         
     def get_all_document_names(self):
         """Returns a list of unique document names from the collection's metadata."""
@@ -0,0 +1,213 @@
+import heapq
+import os
+import pickle
+import re
+import threading
+import time
+import unicodedata
+from array import array
+import numpy as np
+
+# El índice léxico vive junto a './chroma_db' y se reconstruye desde ChromaDB si falta.
+DEFAULT_LEXICAL_INDEX_PATH = "./chroma_db_lexical.pkl"
+LEXICAL_INDEX_VERSION = 1
+# Segundos mínimos entre guardados automáticos (save(force=True) guarda siempre).
+SAVE_INTERVAL_SECONDS = float(os.getenv("LOLA_LEXICAL_SAVE_INTERVAL", "10"))
+# Parámetros estándar de BM25.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN = re.compile(r"\w+")
+SPANISH_STOPWORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes aqui asi aun bajo bien cada cual cuales cuando como con
+contra cual de del desde donde dos el ella ellas ello ellos en entre era eran es esa esas ese eso esos esta estaba
+estan estar estas este esto estos fue fueron ha habia han hasta hay la las le les lo los mas me mi mis mucho muy
+nada ni no nos nosotros o os otra otras otro otros para pero poco por porque que quien quienes se sea ser si sido
+sin sobre solo son su sus tambien tan tanto te tiene tienen todo todos tu tus un una unas uno unos y ya yo
+""".split())
+
+
+def normalize_tokens(text):
+    """
+    Spanish-aware tokens: lowercase, accents folded ('información' -> 'informacion'),
+    stopwords dropped and a light plural stemming ('reuniones' and 'reunión' -> 'reunion').
+    """
+    folded = "".join(c for c in unicodedata.normalize("NFD", text.lower()) if unicodedata.category(c) != "Mn")
+    tokens = []
+    for token in _TOKEN.findall(folded):
+        if token in SPANISH_STOPWORDS:
+            continue
+        # Plural ligero: '-es' y '-s' tras vocal (no 'país', 'análisis'), y la 'e' final para que
+        # 'cliente' y 'clientes' coincidan.
+        if len(token) > 4 and token.endswith("es"):
+            token = token[:-2]
+        elif len(token) > 3 and token.endswith("s") and token[-2] in "aeo":
+            token = token[:-1]
+        if len(token) > 3 and token.endswith("e"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class LexicalIndex:
+    """
+    In-memory BM25 inverted index over the knowledge base chunks.
+
+    Each term's postings are two growing arrays (document numbers and term
+    frequencies), so scoring a term is a vectorised numpy operation. Deleting or
+    replacing a chunk leaves a tombstone; the index is compacted once tombstones
+    make up a quarter of it. The index is pickled to disk (atomically).
+    """
+
+    def __init__(self, path=DEFAULT_LEXICAL_INDEX_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self._last_save = 0.0
+        self._dirty = False
+        self._reset()
+        self.load()
+
+    def _reset(self):
+        self.doc_ids = []            # número de documento -> id del fragmento (None si está borrado)
+        self.doc_lengths = array("I")
+        self.id_to_doc = {}          # id del fragmento -> número de documento
+        self.terms = {}              # término -> (array de documentos, array de frecuencias)
+        self.total_length = 0
+        self.deleted = 0
+
+    def __len__(self):
+        return len(self.id_to_doc)
+
+    def load(self):
+        """Loads the index from disk. A missing, old or corrupt file leaves it empty."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+            if data.get("version") != LEXICAL_INDEX_VERSION:
+                print(f"⚠️ Versión de índice léxico incompatible en {self.path}. Se reconstruirá.")
+                return
+            with self._lock:
+                self.doc_ids = data["doc_ids"]
+                self.doc_lengths = data["doc_lengths"]
+                self.terms = data["terms"]
+                self.total_length = data["total_length"]
+                self.id_to_doc = {doc_id: n for n, doc_id in enumerate(self.doc_ids) if doc_id is not None}
+                self.deleted = len(self.doc_ids) - len(self.id_to_doc)
+            print(f"🔤 Índice léxico cargado: {len(self)} fragmentos, {len(self.terms)} términos.")
+        except Exception as e:
+            print(f"⚠️ No se pudo leer el índice léxico {self.path}, se reconstruirá: {e}")
+            self._reset()
+
+    def save(self, force=False):
+        """Writes the index atomically if it changed (at most every SAVE_INTERVAL_SECONDS unless `force`)."""
+        with self._lock:
+            if not self._dirty or (not force and time.monotonic() - self._last_save < SAVE_INTERVAL_SECONDS):
+                return
+            data = {"version": LEXICAL_INDEX_VERSION, "doc_ids": self.doc_ids, "doc_lengths": self.doc_lengths,
+                    "terms": self.terms, "total_length": self.total_length}
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, self.path)
+                self._dirty = False
+                self._last_save = time.monotonic()
+            except Exception as e:
+                print(f"Error al guardar el índice léxico {self.path}: {e}")
+
+    def _remove(self, chunk_id):
+        doc = self.id_to_doc.pop(chunk_id, None)
+        if doc is None:
+            return
+        self.doc_ids[doc] = None
+        self.total_length -= self.doc_lengths[doc]
+        self.deleted += 1
+
+    def add(self, chunk_ids, documents):
+        """Indexes (or re-indexes) chunks."""
+        with self._lock:
+            for chunk_id, document in zip(chunk_ids, documents):
+                self._remove(chunk_id)
+                tokens = normalize_tokens(document or "")
+                doc = len(self.doc_ids)
+                self.doc_ids.append(chunk_id)
+                self.doc_lengths.append(len(tokens))
+                self.id_to_doc[chunk_id] = doc
+                self.total_length += len(tokens)
+                frequencies = {}
+                for token in tokens:
+                    frequencies[token] = frequencies.get(token, 0) + 1
+                for token, frequency in frequencies.items():
+                    postings = self.terms.get(token)
+                    if postings is None:
+                        postings = self.terms[token] = (array("I"), array("I"))
+                    postings[0].append(doc)
+                    postings[1].append(frequency)
+            self._dirty = True
+            self._maybe_compact()
+
+    def delete(self, chunk_ids):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                self._remove(chunk_id)
+            self._dirty = True
+            self._maybe_compact()
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+            self._dirty = True
+
+    def _maybe_compact(self):
+        """Drops tombstoned documents and renumbers the rest once they are 25% of the index."""
+        if self.deleted < 1000 or self.deleted * 4 < len(self.doc_ids):
+            return
+        alive = np.array([doc_id is not None for doc_id in self.doc_ids], dtype=bool)
+        new_numbers = np.cumsum(alive) - 1
+        terms = {}
+        for token, (docs, frequencies) in self.terms.items():
+            docs_np = np.frombuffer(docs, dtype=np.uint32)
+            keep = alive[docs_np]
+            if keep.any():
+                terms[token] = (array("I", new_numbers[docs_np[keep]].astype(np.uint32).tobytes()),
+                                array("I", np.frombuffer(frequencies, dtype=np.uint32)[keep].tobytes()))
+        self.terms = terms
+        self.doc_lengths = array("I", np.frombuffer(self.doc_lengths, dtype=np.uint32)[alive].tobytes())
+        self.doc_ids = [doc_id for doc_id in self.doc_ids if doc_id is not None]
+        self.id_to_doc = {doc_id: n for n, doc_id in enumerate(self.doc_ids)}
+        self.deleted = 0
+
+    def term_coverage(self, query_text):
+        """Fraction of the query's (normalised, non-stopword) terms that appear in the index; None if it has none."""
+        tokens = set(normalize_tokens(query_text))
+        if not tokens:
+            return None
+        with self._lock:
+            return sum(1 for token in tokens if token in self.terms) / len(tokens)
+
+    def search(self, query_text, n_results=5):
+        """Returns the `n_results` best `(chunk_id, bm25_score)` pairs for the query, best first."""
+        tokens = set(normalize_tokens(query_text))
+        with self._lock:
+            live_docs = len(self.id_to_doc)
+            if not tokens or not live_docs:
+                return []
+            doc_lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32).astype(np.float32)
+            average_length = max(self.total_length / live_docs, 1.0)
+            length_norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / average_length)
+            scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+            for token in tokens:
+                postings = self.terms.get(token)
+                if postings is None:
+                    continue
+                docs = np.frombuffer(postings[0], dtype=np.uint32)
+                frequencies = np.frombuffer(postings[1], dtype=np.uint32).astype(np.float32)
+                # Los documentos borrados siguen en las listas hasta compactar; el idf aproxima con ellos.
+                idf = np.log(1 + (live_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                scores[docs] += idf * frequencies * (BM25_K1 + 1) / (frequencies + length_norm[docs])
+            candidates = np.nonzero(scores)[0]
+            # Se piden de más por si algún documento borrado (aún sin compactar) queda entre los mejores.
+            best = heapq.nlargest(n_results + self.deleted, candidates, key=scores.__getitem__)
+            return [(self.doc_ids[doc], float(scores[doc])) for doc in best if self.doc_ids[doc] is not None][:n_results]
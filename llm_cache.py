@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from rate_limiter import get_rate_limiter
+
+# Caché en disco de llamadas a Gemini. LOLA_LLM_CACHE_MODE:
+#   'readwrite' (por defecto): se sirve de la caché si hay respuesta vigente; si no, se llama y se guarda.
+#   'record': se llama siempre y se guarda (refresca la caché).
+#   'replay': modo offline para tests y benchmarks: solo caché, sin red y sin TTL; un fallo lanza LLMCacheMiss.
+#   'off': sin caché.
+DEFAULT_LLM_CACHE_PATH = "./llm_cache.sqlite"
+LLM_CACHE_MODE = os.getenv("LOLA_LLM_CACHE_MODE", "readwrite")
+# Vigencia en segundos por etapa; 0 desactiva la caché para esa etapa. Se puede ajustar con
+# LOLA_LLM_CACHE_TTLS="routing=86400,synthesis=600".
+DEFAULT_STAGE_TTLS = {
+    "routing": 7 * 24 * 3600,
+    "rewrite": 7 * 24 * 3600,
+    "synthesis": 3600,
+    "analysis": 3600,
+    "generation": 3600,
+    "summarization": 7 * 24 * 3600,
+    "writing": 0,  # decide qué se escribe en Drive: siempre se consulta al modelo
+}
+DEFAULT_TTL_SECONDS = 3600
+
+
+def _parse_stage_ttls(value):
+    ttls = dict(DEFAULT_STAGE_TTLS)
+    for item in filter(None, (part.strip() for part in (value or "").split(","))):
+        stage, _, seconds = item.partition("=")
+        try:
+            ttls[stage.strip()] = float(seconds)
+        except ValueError:
+            print(f"⚠️ TTL de caché LLM inválido ignorado: '{item}'")
+    return ttls
+
+
+STAGE_TTLS = _parse_stage_ttls(os.getenv("LOLA_LLM_CACHE_TTLS"))
+
+
+class LLMCacheMiss(Exception):
+    """Raised in replay mode when a call has no cached response."""
+
+
+class CachedResponse:
+    """Stand-in for a Gemini response served from the cache (only `.text` is kept)."""
+
+    def __init__(self, text):
+        self.text = text
+
+
+class LLMCallCache:
+    """SQLite store of LLM responses keyed by a hash of model name, prompt and generation config."""
+
+    def __init__(self, path=DEFAULT_LLM_CACHE_PATH):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS calls (key TEXT PRIMARY KEY, stage TEXT, model TEXT, "
+                         "response TEXT NOT NULL, created REAL NOT NULL)")
+        self._db.commit()
+
+    @staticmethod
+    def make_key(model_name, contents, generation_config=None):
+        payload = json.dumps([model_name, contents, generation_config], sort_keys=True, ensure_ascii=False, default=repr)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key, max_age=None):
+        """Cached response text for `key`, or None if absent or older than `max_age` seconds."""
+        with self._lock:
+            row = self._db.execute("SELECT response, created FROM calls WHERE key = ?", (key,)).fetchone()
+            if row is None or (max_age is not None and time.time() - row[1] > max_age):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, stage, model_name, response_text):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO calls (key, stage, model, response, created) VALUES (?, ?, ?, ?, ?)",
+                             (key, stage, model_name, response_text, time.time()))
+            self._db.commit()
+
+    def prune(self, max_age):
+        """Deletes entries older than `max_age` seconds."""
+        with self._lock:
+            self._db.execute("DELETE FROM calls WHERE created < ?", (time.time() - max_age,))
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM calls").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries}
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_llm_cache(path=DEFAULT_LLM_CACHE_PATH):
+    """Process-wide LLMCallCache, so every wrapped model shares one SQLite file."""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = LLMCallCache(path)
+            if LLM_CACHE_MODE == "readwrite":
+                # Las grabaciones para 'replay' no caducan; en uso normal se purga lo ya vencido.
+                _shared_cache.prune(max(STAGE_TTLS.values()))
+        return _shared_cache
+
+
+class CachedGenerativeModel:
+    """
+    Wraps a `genai.GenerativeModel` so `generate_content` is served from the on-disk
+    call cache when possible. Each call names its `stage` (which selects the TTL);
+    `bypass_cache=True` always calls the model. `generate_content(stream=True)` is
+    passed through uncached; use `stream_text` for a cached text stream.
+    Calls that reach Gemini go through the process-wide rate limiter, with the
+    stage as their priority (see rate_limiter.py). Any other attribute is delegated to the wrapped model.
+    """
+
+    def __init__(self, model, cache=None, mode=LLM_CACHE_MODE, stage_ttls=STAGE_TTLS, limiter=None):
+        self.model = model
+        self.limiter = limiter if limiter is not None else get_rate_limiter()
+        self.model_name = getattr(model, "model_name", repr(model))
+        self.cache = cache if cache is not None else (get_llm_cache() if mode != "off" else None)
+        self.mode = mode
+        self.stage_ttls = stage_ttls
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def _cache_lookup(self, contents, stage, bypass_cache, kwargs):
+        """
+        Returns `(key, cached_response)`. `key` is None when this call must not be cached;
+        `cached_response` is None on a miss. In replay mode a miss raises LLMCacheMiss.
+        """
+        ttl = self.stage_ttls.get(stage, DEFAULT_TTL_SECONDS)
+        cacheable = self.cache is not None and not bypass_cache and not kwargs.get("stream") and \
+            (ttl > 0 or self.mode in ("record", "replay"))
+        if not cacheable:
+            return None, None
+        key = LLMCallCache.make_key(self.model_name, contents, kwargs.get("generation_config"))
+        if self.mode in ("readwrite", "replay"):
+            cached = self.cache.get(key, max_age=None if self.mode == "replay" else ttl)
+            if cached is not None:
+                print(f"💾 Respuesta LLM servida desde caché (etapa '{stage}').")
+                return key, CachedResponse(cached)
+            if self.mode == "replay":
+                raise LLMCacheMiss(f"Sin respuesta en caché para la etapa '{stage}' (modo replay).")
+        return key, None
+
+    def _store(self, key, stage, response):
+        try:
+            text = response.text
+        except Exception:
+            # Respuesta bloqueada o sin texto: no se guarda y el llamador la trata como siempre.
+            return
+        self.cache.put(key, stage, self.model_name, text)
+
+    def generate_content(self, contents, *, stage="default", bypass_cache=False, generation_config=None, **kwargs):
+        if generation_config is not None:
+            kwargs["generation_config"] = generation_config
+        key, cached = self._cache_lookup(contents, stage, bypass_cache, kwargs)
+        if cached is not None:
+            return cached
+        response = self.limiter.call(lambda: self.model.generate_content(contents, **kwargs), contents, stage)
+        if key is not None:
+            self._store(key, stage, response)
+        return response
+
+    async def generate_content_async(self, contents, *, stage="default", bypass_cache=False, generation_config=None, **kwargs):
+        """Async counterpart of generate_content (the model's generate_content_async, same cache)."""
+        if generation_config is not None:
+            kwargs["generation_config"] = generation_config
+        key, cached = self._cache_lookup(contents, stage, bypass_cache, kwargs)
+        if cached is not None:
+            return cached
+        response = await self.limiter.call_async(lambda: self.model.generate_content_async(contents, **kwargs),
+                                                 contents, stage)
+        if key is not None:
+            self._store(key, stage, response)
+        return response
+
+    def stream_text(self, contents, *, stage="default", bypass_cache=False, **kwargs):
+        """
+        Streaming counterpart of generate_content: yields the response text in chunks as
+        Gemini produces them (`stream=True`). A cached response is yielded at once, and
+        a completed stream is stored like any other call.
+        """
+        key, cached = self._cache_lookup(contents, stage, bypass_cache, kwargs)
+        if cached is not None:
+            yield cached.text
+            return
+
+        parts = []
+        for chunk in self.limiter.stream(lambda: self.model.generate_content(contents, stream=True, **kwargs),
+                                         contents, stage):
+            text = chunk.text
+            if text:
+                parts.append(text)
+                yield text
+        if key is not None:
+            self.cache.put(key, stage, self.model_name, "".join(parts))
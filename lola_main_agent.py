@@ -1,16 +1,28 @@
 ﻿import os
 import time
+import asyncio
+import threading
 from datetime import datetime
+from functools import partial
 from dotenv import load_dotenv
 import google.generativeai as genai
 from apscheduler.schedulers.background import BackgroundScheduler
 
 # Import your custom modules
-from drive_utils import get_drive_service, list_all_files_in_folder_recursive, download_file
-from doc_processor import read_text_from_file, chunk_text
+from drive_utils import (get_drive_service, get_thread_http, download_file_content,
+                         get_changes_start_page_token, list_drive_changes, iter_files_in_folder_tree,
+                         batch_get_file_metadata, FOLDER_MIME_TYPE)
+from doc_processor import extract_chunks, content_hash
 from knowledge_base import KnowledgeBase
-from gemini_agent import summarize_text_with_gemini
-from lola_tools import perform_qa, perform_content_generation, perform_strategic_analysis, perform_document_writing
+from intent_router import IntentRouter
+from answer_cache import SemanticAnswerCache
+from llm_cache import CachedGenerativeModel
+from rate_limiter import is_rate_limit_error
+from ingest_manifest import IngestManifest, DEFAULT_MANIFEST_PATH
+from ingest_pipeline import process_files_concurrently, DEFAULT_DOWNLOAD_WORKERS, DEFAULT_EXTRACT_WORKERS
+from lola_tools import (perform_qa, perform_content_generation, perform_strategic_analysis,
+                        perform_qa_stream, perform_content_generation_stream, perform_strategic_analysis_stream,
+                        perform_qa_async, rewrite_qa_query_async, perform_content_generation_async, perform_strategic_analysis_async)
 
 import streamlit as st
 
@@ -19,7 +31,7 @@ load_dotenv()
 # Configure Gemini with a new method that works both locally and deployed
 try:
     GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
-except (KeyError, AttributeError):
+except (KeyError, AttributeError, FileNotFoundError):
     print("Secrets not found on Streamlit, falling back to .env file for local development.")
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
@@ -29,79 +41,313 @@ try:
     
     genai.configure(api_key=GEMINI_API_KEY)
     LOLA_LLM_MODEL_NAME = 'models/gemini-pro-latest'
-    lola_gemini_model = genai.GenerativeModel(LOLA_LLM_MODEL_NAME)
+    # Envuelto en la caché de llamadas en disco (ver llm_cache.py).
+    lola_gemini_model = CachedGenerativeModel(genai.GenerativeModel(LOLA_LLM_MODEL_NAME))
     print(f"✅ Lola's main Gemini model configurado usando '{LOLA_LLM_MODEL_NAME}'.")
 except Exception as e:
     print(f"❌ Error configurando Lola's main Gemini model: {e}")
     lola_gemini_model = None
 
+# Fragmentos acumulados antes de escribir en ChromaDB; acota la memoria de la ingesta.
+DEFAULT_INGEST_BATCH_SIZE = int(os.getenv("LOLA_INGEST_BATCH_SIZE", "256"))
+
 class LolaAgent:
-    def __init__(self, kb_collection_name="chainbrief_docs", temp_dir="temp_docs"):
+    def __init__(self, kb_collection_name="chainbrief_docs", temp_dir="temp_docs", manifest_path=DEFAULT_MANIFEST_PATH,
+                 download_workers=DEFAULT_DOWNLOAD_WORKERS, extract_workers=DEFAULT_EXTRACT_WORKERS,
+                 ingest_batch_size=DEFAULT_INGEST_BATCH_SIZE):
         self.drive_service = get_drive_service()
         self.lola_gemini_model = lola_gemini_model 
         self.knowledge_base = KnowledgeBase(collection_name=kb_collection_name)
+        # Router de intenciones local con el mismo modelo de embeddings que la base de conocimiento.
+        self.intent_router = IntentRouter(self.knowledge_base.embed_queries) if self.knowledge_base.is_functional else None
+        self.answer_cache = SemanticAnswerCache()
         self.temp_dir = temp_dir
+        self.download_workers = download_workers
+        self.extract_workers = extract_workers
+        self.ingest_batch_size = ingest_batch_size
+        self.ingest_progress = {'status': 'idle'}
+        # Evita que la población inicial y una sincronización manual/programada se solapen.
+        self.ingest_lock = threading.RLock()
         os.makedirs(self.temp_dir, exist_ok=True)
         print("Lola Agent initialized.")
         self.last_update_check_time = datetime.min 
         self.chainbrief_root_folder_id = os.getenv("CHAINBRIEF_ROOT_FOLDER_ID") 
         if not self.chainbrief_root_folder_id:
             print("⚠️ ADVERTENCIA: CHAINBRIEF_ROOT_FOLDER_ID no configurado en .env.")
-        print("Limpiando y recreando ChromaDB para reindexación...")
+        # La base de conocimiento ya no se borra al arrancar: el manifiesto indica qué está indexado.
+        self.manifest = IngestManifest(manifest_path)
+        if self.manifest.files and self.knowledge_base.count_documents() == 0:
+            print("⚠️ ChromaDB está vacía pero el manifiesto no. Se descarta el manifiesto y se reindexará todo.")
+            self.manifest.clear()
+
+    def _is_ignored(self, file):
+        """Configuration files in the Drive folder are never indexed."""
+        return file['mimeType'] == 'application/json' or file['name'].lower().endswith('.json')
+
+    def _build_chunks(self, file, extracted_chunks):
+        """
+        Turns a document's `(chunk, extra_metadata)` pairs into the chunk dicts stored in
+        the knowledge base. Chunk ids are derived from a hash of the chunk's content, so an
+        unchanged chunk keeps its id (and its embedding) when the rest of the document is edited.
+        """
+        file_id, file_name, mime_type = file['id'], file['name'], file['mimeType']
+        chunks = []
+        occurrences = {}
+        for chunk_content, extra_metadata in extracted_chunks:
+            chunk_hash = content_hash(chunk_content)
+            # Un mismo texto repetido dentro del archivo necesita ids distintos.
+            occurrence = occurrences.get(chunk_hash, 0)
+            occurrences[chunk_hash] = occurrence + 1
+            chunk_id = f"{file_id}-{chunk_hash}" + (f"-{occurrence}" if occurrence else "")
+            metadata = { "file_id": file_id, "file_name": file_name, "mime_type": mime_type, "content_hash": chunk_hash }
+            metadata.update(extra_metadata)
+            chunks.append({'id': chunk_id, 'content': chunk_content, 'metadata': metadata})
+        return chunks
+
+    def _diff_chunks(self, file, chunks):
+        """
+        Compares a file's new chunks with what the manifest says is indexed. Stale chunks
+        are deleted and the metadata of kept chunks refreshed right away; returns the
+        chunks that are new and must be embedded.
+        """
+        entry = self.manifest.get(file['id'])
+        if entry is None:
+            # Sin registro previo (archivo nuevo o índice antiguo): se parte de cero.
+            self._purge_file(file['id'])
+            return chunks
+        old_ids = set(entry.get('chunk_ids', []))
+        new_ids = {chunk['id'] for chunk in chunks}
+        stale_ids = old_ids - new_ids
+        if stale_ids:
+            self.knowledge_base.delete_documents(list(stale_ids))
+        kept_chunks = [chunk for chunk in chunks if chunk['id'] in old_ids]
+        if kept_chunks:
+            # Nombre de archivo y metadatos pueden cambiar sin tocar el texto: no hace falta re-embeber.
+            self.knowledge_base.update_metadatas(kept_chunks)
+        new_chunks = [chunk for chunk in chunks if chunk['id'] not in old_ids]
+        print(f"Diferencias en {file['name']}: {len(new_chunks)} nuevos, {len(kept_chunks)} sin cambios, {len(stale_ids)} eliminados.")
+        return new_chunks
+
+    def _download_for_pipeline(self, file):
+        """Download stage of the ingest pipeline. Runs on a worker thread."""
+        # Los metadatos del listado evitan un files().get extra por archivo.
+        return download_file_content(self.drive_service, file['id'], self.temp_dir,
+                                     http=get_thread_http(self.drive_service), file_metadata=file)
+
+    def _iter_ingested_chunks(self, files, failed_files, log_prefix=""):
+        """
+        Streaming stage of the ingestion: yields `(file, chunk, None)` for every chunk
+        that must be written and `(file, None, chunk_ids)` once a file is complete, with
+        the ids of all its current chunks. Files that fail are appended to `failed_files`.
+        """
+        # Los archivos ya se extraen en paralelo: un PDF largo no abre otro pool de procesos.
+        extract_fn = partial(extract_chunks, chunk_size=1000, chunk_overlap=100, pdf_workers=1)
+        for file, extracted_chunks, error in process_files_concurrently(
+                files, self._download_for_pipeline, extract_fn,
+                download_workers=self.download_workers, extract_workers=self.extract_workers):
+            file_name = file['name']
+            self.ingest_progress['files_processed'] += 1
+            self.ingest_progress['current_file'] = file_name
+            if error:
+                # No se registra en el manifiesto, así que se reintentará en la próxima sincronización.
+                self.ingest_progress['files_failed'] += 1
+                failed_files.append(file)
+                print(f"❌ {log_prefix}Error procesando {file_name}: {error}")
+                continue
+            if not extracted_chunks:
+                print(f"{log_prefix}No se pudo extraer el contenido de {file_name}.")
+            chunks = self._build_chunks(file, extracted_chunks or [])
+            for chunk_data in self._diff_chunks(file, chunks):
+                yield file, chunk_data, None
+            yield file, None, [chunk['id'] for chunk in chunks]
+
+    def _index_files(self, files, log_prefix=""):
+        """
+        Indexes `files`, flushing chunks to the knowledge base in fixed-size batches as
+        they are produced. A file is recorded in the manifest as indexed only once all of
+        its chunks have been written, and the manifest is saved after every batch, so an
+        interrupted ingestion resumes where it stopped. Returns the files that failed,
+        including those with chunks that could not be written.
+        """
+        batch = []
+        failed_files = []
+        completed_files = []
+        failed_chunk_ids = set()
+
+        def flush():
+            if batch:
+                failed_ids = []
+                self.ingest_progress['chunks_written'] += self.knowledge_base.upsert_documents(batch, failed_ids=failed_ids)
+                failed_chunk_ids.update(failed_ids)
+            for done_file, chunk_ids in completed_files:
+                if failed_chunk_ids.isdisjoint(chunk_ids):
+                    self.manifest.record(done_file, chunk_ids)
+                    continue
+                # Se registran solo los fragmentos que sí están en ChromaDB y el archivo queda pendiente.
+                self.manifest.record(done_file, [chunk_id for chunk_id in chunk_ids if chunk_id not in failed_chunk_ids],
+                                     complete=False)
+                self.ingest_progress['files_failed'] += 1
+                failed_files.append(done_file)
+                print(f"❌ {log_prefix}No se pudieron escribir todos los fragmentos de {done_file['name']}; se reintentará.")
+            if batch or completed_files:
+                self.manifest.save()
+            batch.clear()
+            completed_files.clear()
+
         try:
-            self.knowledge_base.client.delete_collection(name=kb_collection_name)
-            self.knowledge_base = KnowledgeBase(collection_name=kb_collection_name)
-            print("✅ ChromaDB reiniciada con éxito.")
-        except Exception as e:
-            print(f"⚠️ Error al limpiar ChromaDB (puede que no existiera): {e}")
+            for file, chunk_data, chunk_ids in self._iter_ingested_chunks(files, failed_files, log_prefix):
+                if chunk_data is None:
+                    completed_files.append((file, chunk_ids))
+                    print(f"{log_prefix}Procesado: {file['name']} ({len(chunk_ids)} fragmentos)")
+                    continue
+                batch.append(chunk_data)
+                if len(batch) >= self.ingest_batch_size:
+                    flush()
+        finally:
+            # También si la ingesta se interrumpe: lo ya procesado queda escrito y registrado.
+            flush()
+        return failed_files
 
-    def _get_document_content(self, file_id, file_name, mime_type):
-        """Downloads and extracts text from a file."""
-        local_path = download_file(self.drive_service, file_id, file_name, self.temp_dir)
-        if local_path:
-            content = read_text_from_file(local_path, mime_type=mime_type)
-            try:
-                os.remove(local_path)
-            except OSError as e:
-                print(f"Error removing temporary file {local_path}: {e}")
-            return content
-        return None
+    def _start_ingest_progress(self, files_total):
+        self.ingest_progress.update({
+            'status': 'running', 'files_total': files_total, 'files_processed': 0, 'files_failed': 0,
+            'chunks_written': 0, 'current_file': None, 'started_at': datetime.now(), 'finished_at': None,
+        })
+
+    def _finish_ingest_progress(self):
+        self.ingest_progress.update({'status': 'done', 'current_file': None, 'finished_at': datetime.now()})
+
+    def get_ingest_progress(self):
+        """Snapshot of the current (or last) ingestion run, safe to read while it is running."""
+        return dict(self.ingest_progress)
+
+    def _purge_file(self, file_id):
+        """Removes a file's chunks from the knowledge base and forgets it in the manifest."""
+        entry = self.manifest.get(file_id)
+        chunk_ids = self.manifest.remove(file_id)
+        if chunk_ids:
+            self.knowledge_base.delete_documents(chunk_ids)
+        elif entry is None:
+            # Archivo desconocido para el manifiesto: borramos por metadato por si quedaron restos.
+            self.knowledge_base.delete_file(file_id)
 
     def populate_knowledge_base(self):
-        """Initial population of the knowledge base from Google Drive."""
+        """
+        Incremental population of the knowledge base from Google Drive.
+        Unchanged files (per the ingest manifest) are skipped, modified files are
+        re-indexed and files that no longer exist in Drive are purged.
+        """
         if not self.knowledge_base.is_functional: return
         if not self.chainbrief_root_folder_id: return
-        print("--- Fase 1: Recopilando y procesando todos los documentos de Drive ---")
-        all_chunks_to_add = [] 
-        files = list_all_files_in_folder_recursive(self.drive_service, self.chainbrief_root_folder_id)
-        print(f"Se encontraron {len(files)} archivos para procesar en Drive...")
-        for file in files:
-            file_id, file_name, mime_type = file['id'], file['name'], file['mimeType']
-            if mime_type == 'application/json' or file_name.lower().endswith('.json'):
-                print(f"Ignorando archivo de configuración: {file_name}")
-                continue
-            print(f"Procesando: {file_name}")
-            content = self._get_document_content(file_id, file_name, mime_type)
-            if content:
-                chunks = chunk_text(content, chunk_size=1000, chunk_overlap=100)
-                for i, chunk_content in enumerate(chunks):
-                    chunk_id = f"{file_id}-{i}"
-                    metadata = { "file_id": file_id, "file_name": file_name, "mime_type": mime_type }
-                    all_chunks_to_add.append({'id': chunk_id, 'content': chunk_content, 'metadata': metadata})
+        with self.ingest_lock:
+            print("--- Fase 1: Comparando Drive con el manifiesto de ingesta ---")
+            # El token se pide antes de recorrer el árbol para no perder cambios hechos durante el recorrido.
+            try:
+                start_page_token = get_changes_start_page_token(self.drive_service)
+            except Exception as e:
+                print(f"⚠️ No se pudo obtener el token de la API de cambios de Drive: {e}")
+                start_page_token = None
+            # Sin manifiesto (primera ejecución o una base creada antes de que existiera) no se sabe
+            # qué archivos hay indexados: al final se purga por file_id todo lo que no aparezca en Drive.
+            untracked_collection = not self.manifest.files
+            folder_map = {}
+            listing_errors = []
+            seen_file_ids = set()
+            skipped_files = []
+
+            def files_to_index():
+                # El recorrido de Drive alimenta el pipeline directamente: la descarga empieza
+                # antes de que termine el listado.
+                try:
+                    for file in iter_files_in_folder_tree(self.drive_service, self.chainbrief_root_folder_id,
+                                                          folder_map=folder_map, errors=listing_errors):
+                        if self._is_ignored(file):
+                            print(f"Ignorando archivo de configuración: {file['name']}")
+                            continue
+                        seen_file_ids.add(file['id'])
+                        if self.manifest.is_unchanged(file):
+                            self.manifest.refresh(file)
+                            skipped_files.append(file['id'])
+                            continue
+                        self.ingest_progress['files_total'] += 1
+                        yield file
+                except Exception as e:
+                    # El listado quedó a medias: lo ya listado se indexa, pero no se purga nada.
+                    print(f"❌ El listado de Drive se interrumpió: {e}")
+                    listing_errors.append(e)
+
+            print(f"--- Fase 2: Descargando e indexando archivos nuevos o modificados "
+                  f"({self.download_workers} descargas / {self.extract_workers} procesos de extracción) ---")
+            self._start_ingest_progress(0)
+            try:
+                failed_files = self._index_files(files_to_index())
+            finally:
+                self._finish_ingest_progress()
+
+            removed_file_ids = self.manifest.file_ids() - seen_file_ids
+            print(f"Se encontraron {len(seen_file_ids)} archivos en Drive. Sin cambios: {len(skipped_files)} | "
+                  f"Indexados: {self.ingest_progress['files_total']} | Eliminados de Drive: {len(removed_file_ids)}")
+            if listing_errors:
+                # Un listado incompleto no prueba que los archivos hayan desaparecido.
+                print(f"⚠️ El listado de Drive tuvo {len(listing_errors)} errores; no se purgará ningún archivo en esta pasada.")
+            else:
+                for file_id in removed_file_ids:
+                    print(f"Purgando archivo eliminado de Drive: {self.manifest.get(file_id).get('file_name')}")
+                    self._purge_file(file_id)
+                if untracked_collection:
+                    for file_id in self.knowledge_base.get_all_file_ids() - seen_file_ids:
+                        print(f"Purgando fragmentos de un archivo que ya no está en Drive: {file_id}")
+                        self.knowledge_base.delete_file(file_id)
+
+            pending_files = {file['id']: file for file in failed_files}
+            if listing_errors:
+                # El árbol y el token solo se sustituyen tras un listado completo: con un árbol parcial la
+                # sincronización incremental purgaría los archivos de las carpetas no listadas, y con el
+                # token nuevo se perderían los cambios que este listado no llegó a ver.
+                folders = dict(self.manifest.get_state('folders', {}))
+                folders.update(folder_map)
+                self.manifest.set_state('folders', folders)
+                pending_files = {**self.manifest.get_state('pending_files', {}), **pending_files}
             else:
-                print(f"No se pudo extraer el contenido de {file_name}.")
-        print(f"\n--- Fase 2: Añadiendo {len(all_chunks_to_add)} fragmentos a la base de datos ---")
-        if all_chunks_to_add:
-            for chunk_data in all_chunks_to_add:
-                self.knowledge_base.add_document(doc_id=chunk_data['id'], content=chunk_data['content'], metadata=chunk_data['metadata'])
-        print("Knowledge base population complete.")
-        self.last_update_check_time = datetime.now()
+                self.manifest.set_state('folders', folder_map)
+                self.manifest.set_state('folders_complete', True)
+                self.manifest.set_state('changes_page_token', start_page_token)
+            self.manifest.set_state('pending_files', pending_files)
+            self.manifest.save()
+            self.knowledge_base.save_lexical_index()
+            print("Knowledge base population complete.")
+            self.last_update_check_time = datetime.now()
 
     def route_query(self, user_query):
-        """Usa el LLM para clasificar la intención del usuario y elegir una herramienta."""
+        """
+        Elige la herramienta para la petición. Primero usa el router local por embeddings
+        y solo consulta al LLM si su decisión no es lo bastante clara.
+        """
+        tool_name = self._route_query_locally(user_query)
+        if tool_name:
+            return tool_name
+        tool_name = self._route_query_with_llm(user_query)
+        print(f"🚦 Router LLM: '{tool_name}'")
+        return tool_name
+
+    def _route_query_locally(self, user_query):
+        """Router local por embeddings; devuelve None si su decisión no es lo bastante clara."""
         print(f"🚦 Enrutando la petición: '{user_query}'")
-        
-        routing_prompt = f"""
+        if self.intent_router is None:
+            return None
+        try:
+            tool_name, scores = self.intent_router.route(user_query)
+            scores_text = ", ".join(f"{label}={score:.2f}" for label, score in scores.items())
+            if tool_name:
+                print(f"🚦 Router local: '{tool_name}' ({scores_text})")
+                return tool_name
+            print(f"🚦 Router local sin confianza suficiente ({scores_text}); consultando al LLM.")
+        except Exception as e:
+            print(f"⚠️ Falló el router local, se consulta al LLM: {e}")
+        return None
+
+    def _routing_prompt(self, user_query):
+        return f"""
         Dada la siguiente petición de un usuario, clasifícala en una de las siguientes cuatro categorías:
         1.  "qa": Si es una pregunta directa sobre hechos. Ej: "¿Quién es el CEO?".
         2.  "generation": Si pide crear contenido nuevo. Ej: "Redacta un email".
@@ -112,70 +358,304 @@ class LolaAgent:
 
         Responde únicamente con una de las cuatro categorías en minúsculas.
         """
-        
-        response = lola_gemini_model.generate_content(routing_prompt)
-        tool_name = response.text.strip().lower()
+
+    def _parse_route(self, response_text):
+        tool_name = response_text.strip().lower()
         
         if tool_name not in ["qa", "generation", "analysis", "writing"]:
             return "qa"
         
         return tool_name
 
+    def _route_query_with_llm(self, user_query):
+        """Usa el LLM para clasificar la intención del usuario y elegir una herramienta."""
+        response = lola_gemini_model.generate_content(self._routing_prompt(user_query), stage="routing")
+        return self._parse_route(response.text)
+
+    async def _route_query_with_llm_async(self, user_query):
+        response = await lola_gemini_model.generate_content_async(self._routing_prompt(user_query), stage="routing")
+        return self._parse_route(response.text)
+
+    def _answer_cache_key(self, user_query):
+        """Embedding of the query and the knowledge base version for the answer cache (None if unavailable)."""
+        if not self.knowledge_base.is_functional:
+            return None, None
+        try:
+            return self.knowledge_base.embed_queries([user_query])[0], self.knowledge_base.version
+        except Exception as e:
+            print(f"⚠️ No se pudo consultar la caché de respuestas: {e}")
+            return None, None
+
+    def _prepare_answer(self, user_query):
+        """
+        Enruta la petición (router local) y busca una respuesta ya dada a una pregunta equivalente.
+        Devuelve `(respuesta_en_caché, herramienta, embedding, versión_kb)`; la respuesta es None si no hay acierto.
+        """
+        local_tool = self._route_query_locally(user_query)
+        query_embedding, kb_version = self._answer_cache_key(user_query)
+        if query_embedding is not None:
+            cached = self.answer_cache.get(query_embedding, kb_version, tool=local_tool)
+            if cached:
+                print(f"⚡ Respuesta servida desde la caché semántica (herramienta '{cached[0]}').")
+                return cached[1], cached[0], query_embedding, kb_version
+        chosen_tool = local_tool or self._route_query_with_llm(user_query)
+        if chosen_tool not in ("generation", "analysis"):
+            chosen_tool = "qa" # "qa" es el default
+        
+        # --- THIS IS THE NEW DIAGNOSTIC LINE ---
+        print(f"🛠️ Herramienta seleccionada por el router: '{chosen_tool}'")
+        # --- END OF DIAGNOSTIC LINE ---
+        return None, chosen_tool, query_embedding, kb_version
+
+    def _tool_error_message(self, chosen_tool, e):
+        if is_rate_limit_error(e):
+            print(f"❌ Límite de tasa de Gemini alcanzado. Error: {e}")
+            return "He recibido demasiadas peticiones en este momento. Por favor, espera un minuto antes de volver a preguntar."
+        print(f"❌ Error ejecutando la herramienta '{chosen_tool}': {e}")
+        return "Lo siento, tuve un problema inesperado al procesar tu petición."
+
     def answer_query(self, user_query):
         """Responde a una consulta del usuario usando el enrutador de tareas."""
         if not lola_gemini_model:
             return "Lo siento, mi modelo no está inicializado."
         
-        # 1. Enrutar la petición para decidir qué herramienta usar
-        chosen_tool = self.route_query(user_query)
-        
-        # --- THIS IS THE NEW DIAGNOSTIC LINE ---
-        print(f"🛠️ Herramienta seleccionada por el router: '{chosen_tool}'")
-        # --- END OF DIAGNOSTIC LINE ---
+        # 1. Enrutar la petición para decidir qué herramienta usar (o responder desde la caché)
+        chosen_tool = None
+        try:
+            cached_answer, chosen_tool, query_embedding, kb_version = self._prepare_answer(user_query)
+            if cached_answer is not None:
+                return cached_answer
+
+            # 2. Ejecutar la herramienta seleccionada
+            if chosen_tool == "generation":
+                answer = perform_content_generation(user_query, lola_gemini_model, self.knowledge_base)
+            elif chosen_tool == "analysis":
+                answer = perform_strategic_analysis(user_query, lola_gemini_model, self.knowledge_base)
+            else:
+                answer = perform_qa(user_query, lola_gemini_model, self.knowledge_base)
+            if query_embedding is not None:
+                self.answer_cache.put(query_embedding, kb_version, chosen_tool, answer)
+            return answer
+        except Exception as e:
+            return self._tool_error_message(chosen_tool, e)
+
+    async def answer_query_async(self, user_query):
+        """
+        Variante asíncrona de answer_query para llamadores concurrentes. La recuperación para la
+        consulta original y la reescritura arrancan de inmediato (especulativas), en paralelo con el
+        router LLM, así que la latencia se acerca a la de la etapa más lenta y no a la suma de todas.
+        El router local y la clave de la caché calculan embeddings, así que corren fuera del bucle de eventos.
+        """
+        if not lola_gemini_model:
+            return "Lo siento, mi modelo no está inicializado."
+
+        chosen_tool = None
+        speculative = []
+        try:
+            local_tool, (query_embedding, kb_version) = await asyncio.gather(
+                asyncio.to_thread(self._route_query_locally, user_query),
+                asyncio.to_thread(self._answer_cache_key, user_query))
+            if query_embedding is not None:
+                cached = self.answer_cache.get(query_embedding, kb_version, tool=local_tool)
+                if cached:
+                    print(f"⚡ Respuesta servida desde la caché semántica (herramienta '{cached[0]}').")
+                    return cached[1]
+
+            # Recuperación y reescritura especulativas: solo dependen de la consulta original, no del router.
+            qa_retrieval = qa_rewrite = context_retrieval = None
+            if local_tool in (None, "qa", "writing"):
+                qa_retrieval = asyncio.create_task(asyncio.to_thread(
+                    self.knowledge_base.query_many, [user_query], n_results=3, mode="hybrid"))
+                qa_rewrite = asyncio.create_task(rewrite_qa_query_async(user_query, lola_gemini_model, self.knowledge_base))
+                speculative.extend([qa_retrieval, qa_rewrite])
+            if local_tool in (None, "generation", "analysis"):
+                context_retrieval = asyncio.create_task(asyncio.to_thread(
+                    self.knowledge_base.query, user_query, n_results=10))
+                speculative.append(context_retrieval)
+
+            chosen_tool = local_tool or await self._route_query_with_llm_async(user_query)
+            if chosen_tool not in ("generation", "analysis"):
+                chosen_tool = "qa" # "qa" es el default
+            print(f"🛠️ Herramienta seleccionada por el router: '{chosen_tool}'")
+            if chosen_tool != "qa":
+                # La reescritura especulativa ocupa una llamada a Gemini y un hueco del limitador: se libera ya.
+                for task in (qa_rewrite, qa_retrieval):
+                    if task is not None:
+                        task.cancel()
+
+            if chosen_tool == "generation":
+                answer = await perform_content_generation_async(
+                    user_query, lola_gemini_model, self.knowledge_base, results=await context_retrieval)
+            elif chosen_tool == "analysis":
+                answer = await perform_strategic_analysis_async(
+                    user_query, lola_gemini_model, self.knowledge_base, results=await context_retrieval)
+            else:
+                answer = await perform_qa_async(user_query, lola_gemini_model, self.knowledge_base,
+                                                raw_retrieval=qa_retrieval, rewrite=qa_rewrite)
+            if query_embedding is not None:
+                self.answer_cache.put(query_embedding, kb_version, chosen_tool, answer)
+            return answer
+        except Exception as e:
+            return self._tool_error_message(chosen_tool, e)
+        finally:
+            # Una recuperación especulativa que no se llegó a usar no debe dejar excepciones sin recoger.
+            for task in speculative:
+                if task.done() and not task.cancelled():
+                    task.exception()
+                else:
+                    task.cancel()
+
+    def answer_query_stream(self, user_query):
+        """
+        Variante de answer_query para la interfaz de chat: genera la respuesta en fragmentos
+        de texto a medida que Gemini los produce, de modo que el usuario ve el primero cuanto antes.
+        """
+        if not lola_gemini_model:
+            yield "Lo siento, mi modelo no está inicializado."
+            return
 
-        # 2. Ejecutar la herramienta seleccionada
+        start_time = time.monotonic()
+        chosen_tool = None
+        parts = []
         try:
+            cached_answer, chosen_tool, query_embedding, kb_version = self._prepare_answer(user_query)
+            if cached_answer is not None:
+                yield cached_answer
+                return
+
             if chosen_tool == "generation":
-                return perform_content_generation(user_query, lola_gemini_model, self.knowledge_base)
+                stream = perform_content_generation_stream(user_query, lola_gemini_model, self.knowledge_base)
             elif chosen_tool == "analysis":
-                return perform_strategic_analysis(user_query, lola_gemini_model, self.knowledge_base)
-            else: # "qa" es el default
-                return perform_qa(user_query, lola_gemini_model, self.knowledge_base)
+                stream = perform_strategic_analysis_stream(user_query, lola_gemini_model, self.knowledge_base)
+            else:
+                stream = perform_qa_stream(user_query, lola_gemini_model, self.knowledge_base)
+            for chunk in stream:
+                if not parts:
+                    print(f"⏱️ Primer fragmento de la respuesta en {time.monotonic() - start_time:.2f}s.")
+                parts.append(chunk)
+                yield chunk
+            print(f"⏱️ Respuesta completa en {time.monotonic() - start_time:.2f}s.")
+            if query_embedding is not None:
+                self.answer_cache.put(query_embedding, kb_version, chosen_tool, "".join(parts))
         except Exception as e:
-            if "429" in str(e) and "quota" in str(e).lower():
-                print(f"❌ Límite de tasa de Gemini alcanzado. Error: {e}")
-                return "He recibido demasiadas peticiones en este momento. Por favor, espera un minuto antes de volver a preguntar."
+            message = self._tool_error_message(chosen_tool, e)
+            # Si ya se mostró parte de la respuesta, el aviso se añade a continuación.
+            yield f"\n\n{message}" if parts else message
+
+    def _is_in_tree(self, parents, folders):
+        return any(parent == self.chainbrief_root_folder_id or parent in folders for parent in parents or [])
+
+    def _remove_folder_subtree(self, folder_id, folders):
+        """Drops a folder and all of its known sub-folders from the tracked tree."""
+        to_remove = {folder_id}
+        while True:
+            children = {child for child, parent in folders.items() if parent in to_remove and child not in to_remove}
+            if not children:
+                break
+            to_remove |= children
+        for removed_id in to_remove:
+            folders.pop(removed_id, None)
+
+    def _sync_drive_changes(self, page_token):
+        """
+        Applies only the Drive changes since `page_token`: new and modified files are
+        indexed, and removed, trashed or moved-out files (or folders) are purged.
+        """
+        changes, new_page_token = list_drive_changes(self.drive_service, page_token)
+        print(f"[SCHEDULER] {len(changes)} cambios en Drive desde la última sincronización.")
+        folders = dict(self.manifest.get_state('folders', {}))
+        listing_errors = []
+        # Los archivos que fallaron en la sincronización anterior se reintentan ahora, con metadatos frescos.
+        files_to_index = {}
+        pending_file_ids = list(self.manifest.get_state('pending_files', {}))
+        if pending_file_ids:
+            for file_id, file in batch_get_file_metadata(self.drive_service, pending_file_ids).items():
+                if not file.get('trashed'):
+                    files_to_index[file_id] = file
+
+        # Primera pasada: carpetas, para que los archivos se evalúen contra el árbol ya actualizado.
+        for change in changes:
+            file = change.get('file') or {}
+            if file.get('mimeType') != FOLDER_MIME_TYPE:
+                continue
+            folder_id = change['fileId']
+            if change.get('removed') or file.get('trashed') or not self._is_in_tree(file.get('parents'), folders):
+                if folder_id in folders:
+                    print(f"[SCHEDULER] Carpeta eliminada o movida fuera de la raíz: {file.get('name', folder_id)}")
+                    self._remove_folder_subtree(folder_id, folders)
+            elif folder_id not in folders:
+                # Una carpeta movida dentro del árbol trae contenido que no aparece como cambio.
+                print(f"[SCHEDULER] Nueva carpeta en el árbol: {file.get('name')}")
+                folders[folder_id] = file['parents'][0]
+                for new_file in iter_files_in_folder_tree(self.drive_service, folder_id, folder_map=folders,
+                                                          errors=listing_errors):
+                    files_to_index[new_file['id']] = new_file
             else:
-                print(f"❌ Error ejecutando la herramienta '{chosen_tool}': {e}")
-                return "Lo siento, tuve un problema inesperado al procesar tu petición."
+                folders[folder_id] = file['parents'][0]
+
+        # Segunda pasada: archivos.
+        for change in changes:
+            file = change.get('file') or {}
+            if file.get('mimeType') == FOLDER_MIME_TYPE:
+                continue
+            file_id = change['fileId']
+            if change.get('removed') or file.get('trashed') or not self._is_in_tree(file.get('parents'), folders):
+                files_to_index.pop(file_id, None)
+                if self.manifest.get(file_id):
+                    print(f"[SCHEDULER] Purgando archivo eliminado, en la papelera o movido: {self.manifest.get(file_id).get('file_name')}")
+                    self._purge_file(file_id)
+            elif self._is_ignored(file):
+                continue
+            elif self.manifest.is_unchanged(file):
+                # Un archivo movido dentro del árbol no cambia de contenido, pero sí de carpeta padre.
+                self.manifest.refresh(file)
+            else:
+                files_to_index[file_id] = file
+
+        # Archivos que quedaron fuera del árbol porque se movió o eliminó una carpeta antecesora.
+        # Solo con un árbol que proviene de un listado completo: en uno parcial faltan carpetas que sí existen.
+        tree_is_complete = self.manifest.get_state('folders_complete', False) and not listing_errors
+        for file_id in list(self.manifest.file_ids()) if tree_is_complete else []:
+            parents = self.manifest.get(file_id).get('parents')
+            if parents and not self._is_in_tree(parents, folders):
+                print(f"[SCHEDULER] Purgando archivo fuera de la carpeta raíz: {self.manifest.get(file_id).get('file_name')}")
+                self._purge_file(file_id)
+                files_to_index.pop(file_id, None)
+
+        if files_to_index:
+            print(f"✅ [SCHEDULER] Se encontraron {len(files_to_index)} archivos nuevos o actualizados.")
+        self._start_ingest_progress(len(files_to_index))
+        try:
+            failed_files = self._index_files(list(files_to_index.values()), log_prefix="[SCHEDULER] ")
+        finally:
+            self._finish_ingest_progress()
+        if listing_errors:
+            # El contenido de alguna carpeta nueva quedó sin listar: árbol y token se quedan como estaban
+            # para que estos cambios se vuelvan a aplicar (y la carpeta a listar) en la próxima pasada.
+            print(f"⚠️ [SCHEDULER] {len(listing_errors)} errores listando carpetas nuevas; no se avanza el token de cambios.")
+        else:
+            self.manifest.set_state('folders', folders)
+            self.manifest.set_state('changes_page_token', new_page_token)
+        self.manifest.set_state('pending_files', {file['id']: file for file in failed_files})
+        self.manifest.save()
+        self.knowledge_base.save_lexical_index()
 
     def check_for_updates(self):
-        """Periodically checks Google Drive for new or modified files and updates the KB."""
+        """
+        Periodically syncs the KB with Google Drive. Uses the Drive Changes API, so the
+        cost is proportional to the number of changes rather than the folder tree.
+        Falls back to a full reconcile when there is no saved page token yet.
+        """
         print("\n--- [SCHEDULER] Realizando verificación periódica de actualizaciones en Drive ---")
-        current_time = datetime.now()
-        query_time_str = self.last_update_check_time.isoformat("T") + "Z"
-        updated_files = list_all_files_in_folder_recursive(self.drive_service, self.chainbrief_root_folder_id, query_conditions=f"modifiedTime > '{query_time_str}'")
-        if not updated_files:
-            print("[SCHEDULER] No se encontraron nuevas actualizaciones.")
-        else:
-            print(f"✅ [SCHEDULER] Se encontraron {len(updated_files)} archivos actualizados.")
-            for file in updated_files:
-                file_id, file_name, mime_type = file['id'], file['name'], file['mimeType']
-                try:
-                    self.knowledge_base.collection.delete(where={"file_id": file_id})
-                    print(f"[SCHEDULER] Eliminados los fragmentos antiguos del archivo: {file_name}")
-                except Exception as e:
-                    print(f"Advertencia: No se pudieron eliminar los fragmentos antiguos (puede que no existieran): {e}")
-                print(f"[SCHEDULER] Procesando archivo actualizado: {file_name}")
-                content = self._get_document_content(file_id, file_name, mime_type)
-                if content:
-                    chunks = chunk_text(content, chunk_size=1000, chunk_overlap=100)
-                    for i, chunk in enumerate(chunks):
-                        chunk_id = f"{file_id}-{i}"
-                        metadata = { "file_id": file_id, "file_name": file_name, "mime_type": mime_type }
-                        self.knowledge_base.add_document(chunk_id, chunk, metadata)
-        self.last_update_check_time = current_time
-        print("--- [SCHEDULER] Verificación de actualizaciones finalizada. ---")
+        with self.ingest_lock:
+            page_token = self.manifest.get_state('changes_page_token')
+            if not page_token:
+                print("[SCHEDULER] Sin token de cambios guardado. Realizando una sincronización completa...")
+                self.populate_knowledge_base()
+            else:
+                self._sync_drive_changes(page_token)
+            self.last_update_check_time = datetime.now()
+            print("--- [SCHEDULER] Verificación de actualizaciones finalizada. ---")
 
 if __name__ == '__main__':
     print("Iniciando Lola Agent...")
@@ -209,7 +689,7 @@ if __name__ == '__main__':
                 response = lola.answer_query(user_input)
                 print(f"\nLola: {response}")
             except Exception as e:
-                if "429" in str(e) and "quota" in str(e).lower():
+                if is_rate_limit_error(e):
                     print(f"\nLola: He recibido demasiadas peticiones en este momento. Por favor, espera un minuto antes de volver a preguntar.")
                 else:
                     print(f"\nLola: Lo siento, tuve un problema inesperado al procesar tu petición. Error: {e}")
@@ -1,4 +1,6 @@
 import os
+import json
+import asyncio
 import google.generativeai as genai
 
 from drive_utils import append_to_google_doc, append_row_to_google_sheet
@@ -6,63 +8,113 @@ from drive_utils import append_to_google_doc, append_row_to_google_sheet
 # Asumimos que lola_gemini_model y knowledge_base se pasarán a estas funciones
 # para que no tengamos que inicializarlos aquí.
 
-def perform_qa(user_query, lola_gemini_model, knowledge_base):
+# Consultas de hasta este número de palabras, con todos sus términos presentes en el índice léxico,
+# se buscan tal cual, sin la llamada de reescritura al LLM.
+REWRITE_BYPASS_MAX_WORDS = int(os.getenv("LOLA_REWRITE_BYPASS_MAX_WORDS", "8"))
+REWRITE_ALTERNATIVES = 3
+
+def _format_source(metadata):
+    """Etiqueta de fuente de un fragmento (archivo y páginas, si se conocen) para que Lola pueda citarla."""
+    metadata = metadata or {}
+    label = metadata.get('file_name', 'Documento')
+    page_start, page_end = metadata.get('page_start'), metadata.get('page_end')
+    if page_start:
+        label += f", pág. {page_start}" if page_start == page_end else f", págs. {page_start}-{page_end}"
+    return f"[Fuente: {label}]"
+
+def _format_retrieved_chunks(results):
+    """Convierte el resultado de knowledge_base.query en fragmentos de contexto con su fuente."""
+    if not results or not results.get('documents') or not results['documents'][0]:
+        return []
+    metadatas = (results.get('metadatas') or [[]])[0] or [None] * len(results['documents'][0])
+    return [f"{_format_source(metadata)}\n{document}" for document, metadata in zip(results['documents'][0], metadatas)]
+
+def _can_skip_rewrite(user_query, knowledge_base):
     """
-    Herramienta para Q&A que primero corrige y expande la consulta, y luego usa multi-consulta.
+    True for short queries whose every term already appears in the documents (per the
+    lexical index): there is nothing to correct, so the rewrite call is skipped.
     """
-    print("🧠 Usando Herramienta: Pregunta y Respuesta (Q&A) - Modo Auto-Corrección")
-    
-    # --- NEW STAGE 0: QUERY CORRECTION AND EXPANSION ---
-    correction_prompt = f"""
+    if len(user_query.split()) > REWRITE_BYPASS_MAX_WORDS:
+        return False
+    return knowledge_base.lexical_coverage(user_query) == 1.0
+
+def _rewrite_prompt(user_query, n_alternatives):
+    return f"""
     Analiza la siguiente 'Pregunta Original del Usuario'. Tu tarea es reescribirla para que sea una consulta de búsqueda más efectiva.
     Corrige cualquier error ortográfico. Expande los términos a sus conceptos clave.
     Por ejemplo, si el usuario escribe 'info del modelo freemiun', una buena reescritura sería 'modelo de negocio freemium precios características'.
+    Además, genera {n_alternatives} consultas alternativas y concisas que busquen la misma información con otras palabras.
 
     Pregunta Original del Usuario: "{user_query}"
 
-    Consulta Mejorada:
+    Responde únicamente con un objeto JSON con esta forma:
+    {{"consulta_mejorada": "...", "alternativas": ["...", "..."]}}
+    """
+
+def _parse_rewrite(response_text, user_query, n_alternatives):
+    text = response_text.strip()
+    if text.startswith("```"):
+        text = text.strip("`").removeprefix("json").strip()
+    data = json.loads(text)
+    corrected_query = str(data.get("consulta_mejorada") or "").strip() or user_query
+    alternatives = [str(query).strip() for query in data.get("alternativas") or [] if str(query).strip()]
+    print(f"✅ Consulta original corregida y mejorada a: '{corrected_query}'")
+    return corrected_query, alternatives[:n_alternatives]
+
+def _rewrite_query(user_query, lola_gemini_model, n_alternatives=REWRITE_ALTERNATIVES):
+    """
+    Una sola llamada al LLM que corrige y expande la consulta y propone alternativas.
+    Devuelve `(consulta_corregida, [alternativas])`; ante cualquier fallo, la consulta original.
     """
     try:
-        response = lola_gemini_model.generate_content(correction_prompt)
-        corrected_query = response.text.strip()
-        print(f"✅ Consulta original corregida y mejorada a: '{corrected_query}'")
+        response = lola_gemini_model.generate_content(
+            _rewrite_prompt(user_query, n_alternatives),
+            generation_config={"response_mime_type": "application/json"},
+            stage="rewrite",
+        )
+        return _parse_rewrite(response.text, user_query, n_alternatives)
     except Exception as e:
-        print(f"Advertencia: Falló la corrección de la consulta. Usando la consulta original. Error: {e}")
-        corrected_query = user_query # Fallback to the original query
-    # --- END OF NEW STAGE ---
-
-    # --- STAGE 1: KEYWORD GENERATION (Now uses the corrected query) ---
-    keyword_generation_prompt = f"""
-    Dada la siguiente consulta de búsqueda, genera 3 consultas alternativas y concisas.
-    Consulta de búsqueda: "{corrected_query}"
-    Consultas alternativas:
-    """
+        print(f"Advertencia: Falló la reescritura de la consulta. Usando la consulta original. Error: {e}")
+        return user_query, []
+
+async def _rewrite_query_async(user_query, lola_gemini_model, n_alternatives=REWRITE_ALTERNATIVES):
+    """Versión asíncrona de _rewrite_query."""
     try:
-        response = lola_gemini_model.generate_content(keyword_generation_prompt)
-        alternative_queries = response.text.strip().split(';')
+        response = await lola_gemini_model.generate_content_async(
+            _rewrite_prompt(user_query, n_alternatives),
+            generation_config={"response_mime_type": "application/json"},
+            stage="rewrite",
+        )
+        return _parse_rewrite(response.text, user_query, n_alternatives)
     except Exception as e:
-        print(f"Advertencia: Falló la generación de consultas alternativas. Usando solo la consulta mejorada. Error: {e}")
-        alternative_queries = []
+        print(f"Advertencia: Falló la reescritura de la consulta. Usando la consulta original. Error: {e}")
+        return user_query, []
+
+NO_INFORMATION_ANSWER = "No tengo esa información específica en mis documentos."
 
-    # Combine the corrected query with the generated ones
-    all_queries = [corrected_query] + alternative_queries
+def _build_qa_prompt(user_query, lola_gemini_model, knowledge_base):
+    """Etapas 0-2 del Q&A (reescritura y recuperación). Devuelve el prompt de síntesis, o None si no hay contexto."""
+    print("🧠 Usando Herramienta: Pregunta y Respuesta (Q&A) - Modo Auto-Corrección")
+    
+    # --- STAGE 0-1: QUERY CORRECTION, EXPANSION AND ALTERNATIVES (one call, or none for clear queries) ---
+    if _can_skip_rewrite(user_query, knowledge_base):
+        print("⚡ Consulta corta y conocida por el índice léxico: se busca sin reescribirla.")
+        all_queries = [user_query]
+    else:
+        corrected_query, alternative_queries = _rewrite_query(user_query, lola_gemini_model)
+        all_queries = [corrected_query] + alternative_queries
     print(f"🔍 Ejecutando búsquedas para las consultas: {all_queries}")
     
     # --- STAGE 2: MULTI-QUERY RETRIEVAL ---
-    all_retrieved_chunks = []
-    retrieved_ids = set()
-    for query in all_queries:
-        if not query: continue
-        results = knowledge_base.query(query, n_results=3)
-        if results and results['ids'] and results['ids'][0]:
-            for i in range(len(results['ids'][0])):
-                chunk_id = results['ids'][0][i]
-                if chunk_id not in retrieved_ids:
-                    all_retrieved_chunks.append(results['documents'][0][i])
-                    retrieved_ids.add(chunk_id)
+    # Una sola pasada de embeddings y una sola búsqueda para todas las consultas, fusionadas por RRF
+    # junto con los aciertos léxicos (BM25) de cada una.
+    results = knowledge_base.query_many(all_queries, n_results=3, mode="hybrid")
+    return _qa_synthesis_prompt(user_query, _format_retrieved_chunks(results))
 
+def _qa_synthesis_prompt(user_query, all_retrieved_chunks):
+    """Prompt de la etapa 3 (síntesis) del Q&A, o None si no se recuperó ningún fragmento."""
     if not all_retrieved_chunks:
-        return "No tengo esa información específica en mis documentos."
+        return None
 
     # --- STAGE 3: SYNTHESIS (The same strict but synthesizing prompt) ---
     persona_prompt = (
@@ -70,18 +122,73 @@ def perform_qa(user_query, lola_gemini_model, knowledge_base):
         "REGLAS IMPORTANTES:\n"
         "1. Tu respuesta DEBE derivarse exclusivamente del 'Contexto del Documento'.\n"
         "2. Sintetiza la información para construir una respuesta completa y coherente.\n"
-        "3. Si la respuesta no se puede construir, responde de forma clara y directa: 'No tengo esa información específica en mis documentos.'"
+        "3. Si la respuesta no se puede construir, responde de forma clara y directa: 'No tengo esa información específica en mis documentos.'\n"
+        "4. Cuando sea útil, cita la fuente indicada en cada fragmento (documento y página)."
     )
     
     context_prompt = "\n\n**Contexto del Documento:**\n---\n" + "\n---\n".join(all_retrieved_chunks) + "\n---\n"
     # Note: We use the *original* user_query here for the final answer, which feels more natural.
-    full_prompt = f"{persona_prompt}\n\n**Pregunta del Usuario Original:** {user_query}\n\n**Respuesta de Lola:**"
-    
-    final_response = lola_gemini_model.generate_content(full_prompt)
+    return f"{persona_prompt}{context_prompt}\n\n**Pregunta del Usuario Original:** {user_query}\n\n**Respuesta de Lola:**"
+
+def perform_qa(user_query, lola_gemini_model, knowledge_base):
+    """
+    Herramienta para Q&A que primero corrige y expande la consulta, y luego usa multi-consulta.
+    """
+    full_prompt = _build_qa_prompt(user_query, lola_gemini_model, knowledge_base)
+    if full_prompt is None:
+        return NO_INFORMATION_ANSWER
+    final_response = lola_gemini_model.generate_content(full_prompt, stage="synthesis")
     return final_response.text
 
-def perform_content_generation(user_query, lola_gemini_model, knowledge_base):
-    """Herramienta para generar contenido creativo (emails, tweets, etc.) basado en los documentos."""
+def perform_qa_stream(user_query, lola_gemini_model, knowledge_base):
+    """Variante de perform_qa que genera la respuesta en fragmentos de texto a medida que llegan."""
+    full_prompt = _build_qa_prompt(user_query, lola_gemini_model, knowledge_base)
+    if full_prompt is None:
+        yield NO_INFORMATION_ANSWER
+        return
+    yield from lola_gemini_model.stream_text(full_prompt, stage="synthesis")
+
+async def rewrite_qa_query_async(user_query, lola_gemini_model, knowledge_base):
+    """
+    Etapas 0-1 del Q&A asíncrono: devuelve la consulta corregida y sus alternativas, o []
+    si la consulta es corta y conocida. Los llamadores pueden lanzarla como tarea antes de
+    saber la herramienta (especulativa) y pasarla a perform_qa_async como `rewrite`.
+    """
+    if _can_skip_rewrite(user_query, knowledge_base):
+        print("⚡ Consulta corta y conocida por el índice léxico: se busca sin reescribirla.")
+        return []
+    corrected_query, alternative_queries = await _rewrite_query_async(user_query, lola_gemini_model)
+    return [corrected_query] + alternative_queries
+
+async def perform_qa_async(user_query, lola_gemini_model, knowledge_base, raw_retrieval=None, rewrite=None):
+    """
+    Variante asíncrona de perform_qa. La recuperación para la consulta original (`raw_retrieval`,
+    una tarea ya iniciada por el llamador, o una nueva) corre en paralelo con la reescritura
+    (`rewrite`, una tarea de rewrite_qa_query_async ya iniciada, o una nueva); las consultas
+    alternativas se buscan en cuanto llegan y ambos rankings se fusionan.
+    """
+    print("🧠 Usando Herramienta: Pregunta y Respuesta (Q&A) - Modo Asíncrono")
+    if raw_retrieval is None:
+        raw_retrieval = asyncio.create_task(
+            asyncio.to_thread(knowledge_base.query_many, [user_query], n_results=3, mode="hybrid"))
+    if rewrite is None:
+        rewrite = rewrite_qa_query_async(user_query, lola_gemini_model, knowledge_base)
+
+    rewritten_queries = await rewrite
+    print(f"🔍 Ejecutando búsquedas para las consultas: {[user_query] + rewritten_queries}")
+
+    rankings = [await raw_retrieval]
+    if rewritten_queries:
+        rankings.append(await asyncio.to_thread(knowledge_base.query_many, rewritten_queries, n_results=3, mode="hybrid"))
+    results = knowledge_base.merge_results(rankings)
+
+    full_prompt = _qa_synthesis_prompt(user_query, _format_retrieved_chunks(results))
+    if full_prompt is None:
+        return NO_INFORMATION_ANSWER
+    final_response = await lola_gemini_model.generate_content_async(full_prompt, stage="synthesis")
+    return final_response.text
+
+def _build_generation_prompt(user_query, knowledge_base, results=None):
     print("✍️ Usando Herramienta: Generador de Contenido")
 
     persona_prompt = (
@@ -91,19 +198,31 @@ def perform_content_generation(user_query, lola_gemini_model, knowledge_base):
     )
     
     # Lógica RAG (idéntica, para obtener el contexto)
-    results = knowledge_base.query(user_query, n_results=7) # Podemos tomar más contexto para creatividad
-    retrieved_content = []
-    if results and results['documents'] and results['documents'][0]:
-        retrieved_content = results['documents'][0]
+    if results is None:
+        results = knowledge_base.query(user_query, n_results=7) # Podemos tomar más contexto para creatividad
+    retrieved_content = _format_retrieved_chunks(results)[:7]
 
     context_prompt = "\n\n**Información Relevante de Documentos Internos:**\n" + "\n---\n".join(retrieved_content)
-    full_prompt = f"{persona_prompt}{context_prompt}\n\n**Petición del Usuario:** {user_query}\n\n**Contenido Generado por Lola:**"
-    
-    response = lola_gemini_model.generate_content(full_prompt)
+    return f"{persona_prompt}{context_prompt}\n\n**Petición del Usuario:** {user_query}\n\n**Contenido Generado por Lola:**"
+
+def perform_content_generation(user_query, lola_gemini_model, knowledge_base):
+    """Herramienta para generar contenido creativo (emails, tweets, etc.) basado en los documentos."""
+    full_prompt = _build_generation_prompt(user_query, knowledge_base)
+    response = lola_gemini_model.generate_content(full_prompt, stage="generation")
     return response.text
 
-def perform_strategic_analysis(user_query, lola_gemini_model, knowledge_base):
-    """Herramienta para dar recomendaciones y análisis, citando sus fuentes."""
+def perform_content_generation_stream(user_query, lola_gemini_model, knowledge_base):
+    """Variante de perform_content_generation que genera el contenido en fragmentos de texto."""
+    full_prompt = _build_generation_prompt(user_query, knowledge_base)
+    yield from lola_gemini_model.stream_text(full_prompt, stage="generation")
+
+async def perform_content_generation_async(user_query, lola_gemini_model, knowledge_base, results=None):
+    """Variante asíncrona de perform_content_generation; `results` es una recuperación ya hecha (especulativa)."""
+    full_prompt = _build_generation_prompt(user_query, knowledge_base, results=results)
+    response = await lola_gemini_model.generate_content_async(full_prompt, stage="generation")
+    return response.text
+
+def _build_analysis_prompt(user_query, knowledge_base, results=None):
     print("📈 Usando Herramienta: Analista Estratégico")
 
     persona_prompt = (
@@ -114,15 +233,28 @@ def perform_strategic_analysis(user_query, lola_gemini_model, knowledge_base):
     )
     
     # Lógica RAG (idéntica, para obtener el contexto)
-    results = knowledge_base.query(user_query, n_results=10) # Tomamos mucho contexto para un buen análisis
-    retrieved_content = []
-    if results and results['documents'] and results['documents'][0]:
-        retrieved_content = results['documents'][0]
+    if results is None:
+        results = knowledge_base.query(user_query, n_results=10) # Tomamos mucho contexto para un buen análisis
+    retrieved_content = _format_retrieved_chunks(results)[:10]
 
     context_prompt = "\n\n**Información Relevante de la Base de Conocimiento:**\n" + "\n---\n".join(retrieved_content)
-    full_prompt = f"{persona_prompt}{context_prompt}\n\n**Solicitud de Análisis del Usuario:** {user_query}\n\n**Análisis de Lola:**"
-    
-    response = lola_gemini_model.generate_content(full_prompt)
+    return f"{persona_prompt}{context_prompt}\n\n**Solicitud de Análisis del Usuario:** {user_query}\n\n**Análisis de Lola:**"
+
+def perform_strategic_analysis(user_query, lola_gemini_model, knowledge_base):
+    """Herramienta para dar recomendaciones y análisis, citando sus fuentes."""
+    full_prompt = _build_analysis_prompt(user_query, knowledge_base)
+    response = lola_gemini_model.generate_content(full_prompt, stage="analysis")
+    return response.text
+
+def perform_strategic_analysis_stream(user_query, lola_gemini_model, knowledge_base):
+    """Variante de perform_strategic_analysis que genera el análisis en fragmentos de texto."""
+    full_prompt = _build_analysis_prompt(user_query, knowledge_base)
+    yield from lola_gemini_model.stream_text(full_prompt, stage="analysis")
+
+async def perform_strategic_analysis_async(user_query, lola_gemini_model, knowledge_base, results=None):
+    """Variante asíncrona de perform_strategic_analysis; `results` es una recuperación ya hecha (especulativa)."""
+    full_prompt = _build_analysis_prompt(user_query, knowledge_base, results=results)
+    response = await lola_gemini_model.generate_content_async(full_prompt, stage="analysis")
     return response.text
 
 def perform_document_writing(user_query, lola_gemini_model, drive_service):
@@ -153,7 +285,7 @@ def perform_document_writing(user_query, lola_gemini_model, drive_service):
     """
 
     try:
-        response = lola_gemini_model.generate_content(writing_prompt)
+        response = lola_gemini_model.generate_content(writing_prompt, stage="writing")
         # Limpiamos la respuesta para obtener solo el JSON
         json_response_text = response.text.strip().replace("```json", "").replace("```", "")
         
@@ -0,0 +1,281 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import re
+import statistics
+import threading
+import time
+from collections import deque
+
+try:
+    from google.api_core import exceptions as google_exceptions
+    _RATE_LIMIT_EXCEPTIONS = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+except ImportError:
+    _RATE_LIMIT_EXCEPTIONS = ()
+
+# Presupuesto compartido por todo el proceso (todas las sesiones de Streamlit usan la misma clave).
+GEMINI_RPM = float(os.getenv("LOLA_GEMINI_RPM", "60"))
+GEMINI_TPM = float(os.getenv("LOLA_GEMINI_TPM", "1000000"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("LOLA_GEMINI_MAX_CONCURRENCY", "4"))
+# Reintentos ante un 429: espera exponencial con jitter, acotada por BACKOFF_MAX_SECONDS.
+GEMINI_MAX_RETRIES = int(os.getenv("LOLA_GEMINI_MAX_RETRIES", "5"))
+BACKOFF_BASE_SECONDS = float(os.getenv("LOLA_GEMINI_BACKOFF_BASE", "2"))
+BACKOFF_MAX_SECONDS = float(os.getenv("LOLA_GEMINI_BACKOFF_MAX", "60"))
+# Espera máxima en la cola antes de rendirse con RateLimitTimeout.
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("LOLA_GEMINI_QUEUE_TIMEOUT", "120"))
+
+# Menor número = antes en la cola. Lo interactivo (la respuesta que el usuario espera) va primero.
+STAGE_PRIORITIES = {
+    "synthesis": 0,
+    "generation": 0,
+    "analysis": 0,
+    "writing": 0,
+    "rewrite": 1,
+    "routing": 2,
+    "summarization": 3,
+}
+DEFAULT_PRIORITY = 2
+
+_RETRY_DELAY = re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)")
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a call waited longer than the queue timeout for Gemini quota."""
+
+
+def is_rate_limit_error(error):
+    """True for Gemini quota errors (HTTP 429 / ResourceExhausted) and queue timeouts."""
+    if isinstance(error, RateLimitTimeout) or (_RATE_LIMIT_EXCEPTIONS and isinstance(error, _RATE_LIMIT_EXCEPTIONS)):
+        return True
+    message = str(error).lower()
+    return "429" in message and ("quota" in message or "resource exhausted" in message or "rate" in message)
+
+
+def estimate_tokens(contents):
+    """Rough token count of a prompt (about four characters per token) for the TPM budget."""
+    if isinstance(contents, str):
+        return max(1, len(contents) // 4)
+    if isinstance(contents, (list, tuple)):
+        return max(1, sum(estimate_tokens(part) for part in contents))
+    return max(1, len(str(contents)) // 4)
+
+
+def response_tokens(response):
+    """Tokens actually billed for a response (prompt + output), or None if it does not report them."""
+    usage = getattr(response, "usage_metadata", None)
+    total = getattr(usage, "total_token_count", None) if usage is not None else None
+    return total or None
+
+
+class _TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` is available (0 if it already is)."""
+        missing = amount - self.level
+        return 0.0 if missing <= 0 else missing / self.rate
+
+
+class GeminiRateLimiter:
+    """
+    Process-wide limiter in front of every Gemini call.
+
+    Each call takes a slot from a concurrency limit plus one request and its
+    estimated tokens from two token buckets (RPM and TPM). Waiting calls form a
+    priority queue (see STAGE_PRIORITIES): only the head of the queue may take
+    quota, so an interactive synthesis call overtakes queued routing or
+    summarisation calls. A 429 pauses the whole limiter for an exponential
+    backoff with jitter (or the delay Gemini suggests) before the call is
+    retried, so concurrent sessions back off together instead of piling on.
+    """
+
+    def __init__(self, rpm=GEMINI_RPM, tpm=GEMINI_TPM, max_concurrency=GEMINI_MAX_CONCURRENCY,
+                 max_retries=GEMINI_MAX_RETRIES, backoff_base=BACKOFF_BASE_SECONDS, backoff_max=BACKOFF_MAX_SECONDS,
+                 queue_timeout=QUEUE_TIMEOUT_SECONDS):
+        self.requests = _TokenBucket(rpm)
+        self.tokens = _TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.paused_until = 0.0
+        self._queue = []  # heap de (prioridad, orden de llegada)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        # Métricas
+        self.calls = 0
+        self.rate_limited = 0
+        self.timeouts = 0
+        self.max_queue_depth = 0
+        self._waits = deque(maxlen=1000)  # (etapa, segundos en cola) de las últimas llamadas
+
+    def acquire(self, stage="default", tokens=1):
+        """
+        Blocks until the call may go ahead and takes its quota; returns the seconds it waited.
+        Raises RateLimitTimeout after `queue_timeout` seconds in the queue.
+        """
+        priority = STAGE_PRIORITIES.get(stage, DEFAULT_PRIORITY)
+        tokens = min(tokens, self.tokens.capacity)  # una petición enorme no puede bloquear la cola para siempre
+        start = time.monotonic()
+        with self._condition:
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._queue, ticket)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.requests.refill(now)
+                    self.tokens.refill(now)
+                    if self._queue[0] == ticket and self.active < self.max_concurrency:
+                        delay = max(self.paused_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                        if delay <= 0:
+                            break
+                    else:
+                        delay = None  # esperar a que otro libere un hueco o salga de la cola
+                    remaining = self.queue_timeout - (now - start)
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise RateLimitTimeout(f"Sin cupo de Gemini tras {self.queue_timeout:.0f}s en cola (etapa '{stage}').")
+                    self._condition.wait(remaining if delay is None else min(delay, remaining))
+            finally:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._condition.notify_all()
+            self.requests.level -= 1
+            self.tokens.level -= tokens
+            self.active += 1
+            self.calls += 1
+        waited = time.monotonic() - start
+        self._waits.append((stage, waited))
+        if waited > 1:
+            print(f"⏳ Llamada a Gemini (etapa '{stage}') esperó {waited:.1f}s en la cola de cuota.")
+        return waited
+
+    def release(self, estimated_tokens=0, used_tokens=None):
+        """Frees the call's concurrency slot and corrects the TPM bucket with the tokens actually used."""
+        with self._condition:
+            self.active -= 1
+            if used_tokens is not None:
+                self.tokens.level -= used_tokens - min(estimated_tokens, self.tokens.capacity)
+            self._condition.notify_all()
+
+    def backoff(self, attempt, error=None):
+        """Pauses every caller after a 429 and returns the pause in seconds."""
+        match = _RETRY_DELAY.search(str(error)) if error is not None else None
+        if match:
+            delay = float(match.group(1))
+        else:
+            delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+        with self._condition:
+            self.rate_limited += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self._condition.notify_all()
+        print(f"⚠️ Gemini devolvió un límite de cuota (intento {attempt + 1}); se pausan las llamadas {delay:.1f}s.")
+        return delay
+
+    def call(self, fn, contents, stage="default"):
+        """Runs `fn()` (one Gemini request for `contents`) under the limiter, retrying on 429."""
+        estimated = estimate_tokens(contents)
+        for attempt in itertools.count():
+            self.acquire(stage, estimated)
+            response = None
+            try:
+                response = fn()
+                return response
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                    raise
+                self.backoff(attempt, e)
+            finally:
+                self.release(estimated, response_tokens(response))
+
+    async def acquire_async(self, stage="default", tokens=1):
+        """acquire() without blocking the event loop. A cancelled waiter gives its slot back."""
+        waiter = asyncio.ensure_future(asyncio.to_thread(self.acquire, stage, tokens))
+        try:
+            return await asyncio.shield(waiter)
+        except asyncio.CancelledError:
+            waiter.add_done_callback(lambda f: f.cancelled() or f.exception() or self.release(tokens))
+            raise
+
+    async def call_async(self, fn, contents, stage="default"):
+        """Async counterpart of call(): `fn()` returns the awaitable Gemini request."""
+        estimated = estimate_tokens(contents)
+        for attempt in itertools.count():
+            await self.acquire_async(stage, estimated)
+            response = None
+            try:
+                response = await fn()
+                return response
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                    raise
+                self.backoff(attempt, e)
+            finally:
+                self.release(estimated, response_tokens(response))
+
+    def stream(self, fn, contents, stage="default"):
+        """
+        Yields the chunks of the stream returned by `fn()` under the limiter. The slot
+        is held until the stream ends; a 429 is retried only before the first chunk.
+        """
+        estimated = estimate_tokens(contents)
+        for attempt in itertools.count():
+            self.acquire(stage, estimated)
+            last_chunk = None
+            try:
+                for chunk in fn():
+                    last_chunk = chunk
+                    yield chunk
+                return
+            except Exception as e:
+                if last_chunk is not None or not is_rate_limit_error(e) or attempt >= self.max_retries:
+                    raise
+                self.backoff(attempt, e)
+            finally:
+                # El último fragmento del stream trae el recuento de tokens de toda la respuesta.
+                self.release(estimated, response_tokens(last_chunk))
+
+    def stats(self):
+        with self._condition:
+            waits = [wait for _, wait in self._waits]
+            by_stage = {}
+            for stage, wait in self._waits:
+                by_stage.setdefault(stage, []).append(wait)
+            return {
+                "queue_depth": len(self._queue),
+                "max_queue_depth": self.max_queue_depth,
+                "active": self.active,
+                "calls": self.calls,
+                "rate_limited": self.rate_limited,
+                "timeouts": self.timeouts,
+                "wait_p50": statistics.median(waits) if waits else 0.0,
+                "wait_p95": statistics.quantiles(waits, n=20)[-1] if len(waits) > 1 else (waits[0] if waits else 0.0),
+                "wait_max": max(waits, default=0.0),
+                "wait_mean_by_stage": {stage: statistics.fmean(values) for stage, values in by_stage.items()},
+            }
+
+
+_shared_limiter = None
+_shared_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Process-wide GeminiRateLimiter, shared by every wrapped model and Streamlit session."""
+    global _shared_limiter
+    with _shared_limiter_lock:
+        if _shared_limiter is None:
+            _shared_limiter = GeminiRateLimiter()
+        return _shared_limiter
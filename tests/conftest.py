@@ -0,0 +1,124 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeKnowledgeBase:
+    """In-memory stand-in for KnowledgeBase with the subset of its API the agent's ingestion uses."""
+
+    def __init__(self, chunks=None, failing_file_ids=()):
+        self.is_functional = True
+        self.chunks = dict(chunks or {})  # id -> (contenido, metadatos)
+        self.failing_file_ids = set(failing_file_ids)  # archivos cuyas escrituras fallan
+        self.version = 0
+
+    def upsert_documents(self, batch, failed_ids=None):
+        written = 0
+        for chunk in batch:
+            if chunk['metadata']['file_id'] in self.failing_file_ids:
+                if failed_ids is not None:
+                    failed_ids.append(chunk['id'])
+                continue
+            self.chunks[chunk['id']] = (chunk['content'], chunk['metadata'])
+            written += 1
+        self.version += 1
+        return written
+
+    def update_metadatas(self, batch):
+        for chunk in batch:
+            if chunk['id'] in self.chunks:
+                self.chunks[chunk['id']] = (self.chunks[chunk['id']][0], chunk['metadata'])
+
+    def delete_documents(self, doc_ids):
+        for doc_id in doc_ids:
+            self.chunks.pop(doc_id, None)
+        self.version += 1
+
+    def delete_file(self, file_id):
+        doc_ids = [doc_id for doc_id, (_, metadata) in self.chunks.items() if metadata.get('file_id') == file_id]
+        self.delete_documents(doc_ids)
+        return len(doc_ids)
+
+    def get_all_file_ids(self):
+        return {metadata['file_id'] for _, metadata in self.chunks.values()}
+
+    def count_documents(self):
+        return len(self.chunks)
+
+    def save_lexical_index(self):
+        pass
+
+    def embed_queries(self, query_texts):
+        raise AssertionError("la ingesta no debe calcular embeddings de consultas")
+
+
+def drive_file(file_id, text, parent="root", modified="2026-01-01T00:00:00Z", name=None):
+    """A Drive listing entry for a plain-text file; the agent's download stage returns its `text`."""
+    return {'id': file_id, 'name': name or f"{file_id}.txt", 'mimeType': 'text/plain', 'modifiedTime': modified,
+            'md5Checksum': f"md5-{file_id}-{modified}", 'parents': [parent], 'text': text}
+
+
+class FakeDrive:
+    """Drive folder tree and Changes feed served to the agent through the drive_utils functions it imports."""
+
+    def __init__(self, files, folders=None):
+        self.files = {file['id']: file for file in files}
+        self.folders = dict(folders or {})  # carpeta -> carpeta padre
+        self.changes = []
+        self.page_token = "token-1"
+        self.fail_listing_after = None  # número de archivos listados antes de que falle el recorrido
+        self.failed_folders = set()  # carpetas cuya consulta de hijos falla (se notifica en `errors`)
+
+    def _is_hidden(self, parent):
+        """True if a child of `parent` is not reached because the listing of an ancestor failed."""
+        while parent is not None:
+            if parent in self.failed_folders:
+                return True
+            parent = self.folders.get(parent)
+        return False
+
+    def iter_files_in_folder_tree(self, service, folder_id, query_conditions="", folder_map=None, errors=None, **kwargs):
+        if errors is not None:
+            errors.extend(ConnectionError(f"Error listando {folder}") for folder in self.failed_folders)
+        if folder_map is not None:
+            folder_map.update({folder: parent for folder, parent in self.folders.items() if not self._is_hidden(parent)})
+        listed = [file for file in self.files.values() if not self._is_hidden(file['parents'][0])]
+        for count, file in enumerate(listed):
+            if self.fail_listing_after is not None and count >= self.fail_listing_after:
+                raise ConnectionError("Drive dejó de responder durante el listado")
+            yield dict(file)
+
+    def get_changes_start_page_token(self, service):
+        return self.page_token
+
+    def list_drive_changes(self, service, page_token):
+        changes, self.changes = self.changes, []
+        return changes, self.page_token
+
+    def batch_get_file_metadata(self, service, file_ids):
+        return {file_id: dict(self.files[file_id]) for file_id in file_ids if file_id in self.files}
+
+
+@pytest.fixture
+def make_agent(tmp_path, monkeypatch):
+    """Builds a LolaAgent wired to a FakeDrive and a FakeKnowledgeBase, with inline extraction."""
+    import lola_main_agent
+
+    def factory(drive, knowledge_base=None, manifest_path=None):
+        knowledge_base = knowledge_base if knowledge_base is not None else FakeKnowledgeBase()
+        monkeypatch.setattr(lola_main_agent, "get_drive_service", lambda: None)
+        monkeypatch.setattr(lola_main_agent, "KnowledgeBase", lambda collection_name: knowledge_base)
+        for name in ("iter_files_in_folder_tree", "get_changes_start_page_token", "list_drive_changes",
+                     "batch_get_file_metadata"):
+            monkeypatch.setattr(lola_main_agent, name, getattr(drive, name))
+        monkeypatch.setenv("CHAINBRIEF_ROOT_FOLDER_ID", "root")
+        agent = lola_main_agent.LolaAgent(temp_dir=str(tmp_path / "temp_docs"),
+                                          manifest_path=manifest_path or str(tmp_path / "manifest.json"),
+                                          download_workers=2, extract_workers=0, ingest_batch_size=4)
+        monkeypatch.setattr(agent, "_download_for_pipeline", lambda file: (file['text'].encode('utf-8'), '.txt'))
+        return agent
+
+    return factory
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import threading
+
+import lola_main_agent
+from conftest import FakeDrive, FakeKnowledgeBase
+
+EMPTY_RESULTS = {'ids': [[]], 'documents': [[]], 'metadatas': [[]]}
+
+
+class SearchableKnowledgeBase(FakeKnowledgeBase):
+    def __init__(self):
+        super().__init__()
+        self.searches = []
+        self.merged = []
+
+    def query_many(self, query_texts, n_results=3, limit=None, mode="vector"):
+        self.searches.append(list(query_texts))
+        chunk_id = f"c{len(self.searches)}"
+        return {'ids': [[chunk_id]], 'documents': [[f"Fragmento {chunk_id}: el CEO es Ana."]],
+                'metadatas': [[{'file_name': 'equipo.txt'}]]}
+
+    def query(self, query_text, n_results=5, mode="vector"):
+        return EMPTY_RESULTS
+
+    def merge_results(self, results_list, limit=None):
+        self.merged.append([results['ids'][0] for results in results_list])
+        return {'ids': [sum((results['ids'][0] for results in results_list), [])],
+                'documents': [sum((results['documents'][0] for results in results_list), [])],
+                'metadatas': [sum((results['metadatas'][0] for results in results_list), [])]}
+
+    def lexical_coverage(self, query_text):
+        return None
+
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+
+
+class ScriptedGemini:
+    """
+    Answers each stage. The LLM router only answers once the rewrite has started, as it must
+    run alongside it; with `hold_rewrite` the rewrite never answers until it is cancelled.
+    """
+
+    def __init__(self, route="qa", hold_rewrite=False):
+        self.route = route
+        self.hold_rewrite = hold_rewrite
+        self.stages = []
+        self.prompts = {}
+        self.rewrite_started = asyncio.Event()
+        self.rewrite_cancelled = False
+
+    async def generate_content_async(self, prompt, stage=None, **kwargs):
+        self.stages.append(stage)
+        self.prompts[stage] = prompt
+        if stage == "rewrite":
+            self.rewrite_started.set()
+            if self.hold_rewrite:
+                try:
+                    await asyncio.Event().wait()
+                except asyncio.CancelledError:
+                    self.rewrite_cancelled = True
+                    raise
+            return Response(json.dumps({"consulta_mejorada": "quién es el CEO de la empresa",
+                                        "alternativas": ["director ejecutivo de la empresa"]}))
+        if stage == "routing":
+            await asyncio.wait_for(self.rewrite_started.wait(), timeout=5)
+            return Response(self.route)
+        if stage == "analysis":
+            await asyncio.sleep(0)
+            assert self.rewrite_cancelled, "la reescritura especulativa debe cancelarse al elegir otra herramienta"
+        return Response("Ana.")
+
+
+def _agent(make_agent, monkeypatch, knowledge_base):
+    agent = make_agent(FakeDrive([]), knowledge_base=knowledge_base)
+    threads = []
+
+    def route_locally(user_query):
+        threads.append(threading.current_thread())
+        return None
+
+    monkeypatch.setattr(agent, "_route_query_locally", route_locally)
+    return agent, threads
+
+
+def test_rewrite_runs_alongside_the_llm_router_and_alternatives_are_fused(make_agent, monkeypatch):
+    knowledge_base = SearchableKnowledgeBase()
+    agent, threads = _agent(make_agent, monkeypatch, knowledge_base)
+
+    async def run():
+        gemini = ScriptedGemini()
+        monkeypatch.setattr(lola_main_agent, "lola_gemini_model", gemini)
+        return await agent.answer_query_async("¿Quién es el CEO?"), gemini
+
+    answer, gemini = asyncio.run(run())
+    assert answer == "Ana."
+    assert gemini.stages[-1] == "synthesis" and sorted(gemini.stages[:2]) == ["rewrite", "routing"]
+    assert threads and threads[0] is not threading.main_thread()
+    # La consulta original (especulativa) y la reescrita con su alternativa se buscan y se fusionan.
+    assert knowledge_base.searches == [["¿Quién es el CEO?"],
+                                       ["quién es el CEO de la empresa", "director ejecutivo de la empresa"]]
+    assert knowledge_base.merged == [[["c1"], ["c2"]]]
+    assert "Fragmento c2" in gemini.prompts["synthesis"]
+
+
+def test_speculative_rewrite_is_cancelled_when_another_tool_is_chosen(make_agent, monkeypatch):
+    agent, _ = _agent(make_agent, monkeypatch, SearchableKnowledgeBase())
+
+    async def run():
+        gemini = ScriptedGemini(route="analysis", hold_rewrite=True)
+        monkeypatch.setattr(lola_main_agent, "lola_gemini_model", gemini)
+        return await agent.answer_query_async("¿Cuáles son nuestros riesgos?"), gemini
+
+    answer, gemini = asyncio.run(run())
+    assert answer == "Ana." and gemini.rewrite_cancelled
+    assert gemini.stages[-1] == "analysis"
@@ -0,0 +1,32 @@
+from answer_cache import SemanticAnswerCache
+
+
+def test_similar_question_hits_only_for_the_same_version_and_tool():
+    cache = SemanticAnswerCache(threshold=0.95)
+    cache.put([1.0, 0.0, 0.0], kb_version=3, tool="qa", answer="Ana.")
+    assert cache.get([0.99, 0.05, 0.0], kb_version=3) == ("qa", "Ana.")
+    assert cache.get([0.99, 0.05, 0.0], kb_version=3, tool="analysis") is None
+    assert cache.get([0.99, 0.05, 0.0], kb_version=4) is None
+    assert cache.get([0.0, 1.0, 0.0], kb_version=3) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 3
+
+
+def test_new_version_drops_old_answers_and_size_is_bounded():
+    cache = SemanticAnswerCache(max_entries=2)
+    cache.put([1.0, 0.0], kb_version=1, tool="qa", answer="vieja")
+    cache.put([0.0, 1.0], kb_version=2, tool="qa", answer="b")
+    assert cache.stats()["size"] == 1
+    cache.put([1.0, 1.0], kb_version=2, tool="qa", answer="c")
+    cache.put([1.0, -1.0], kb_version=2, tool="qa", answer="d")
+    assert cache.get([0.0, 1.0], kb_version=2) is None
+    assert cache.get([1.0, -1.0], kb_version=2) == ("qa", "d")
+
+
+def test_entries_expire(monkeypatch):
+    import answer_cache
+    now = [100.0]
+    monkeypatch.setattr(answer_cache.time, "monotonic", lambda: now[0])
+    cache = SemanticAnswerCache(ttl_seconds=60)
+    cache.put([1.0, 0.0], kb_version=1, tool="qa", answer="Ana.")
+    now[0] += 61
+    assert cache.get([1.0, 0.0], kb_version=1) is None
@@ -0,0 +1,104 @@
+import io
+import random
+
+from doc_processor import content_hash, iter_pdf_chunks, iter_text_spans, extract_chunks
+
+WORDS = "contrato cliente factura proyecto entrega reunión presupuesto informe equipo plazo servicio pago".split()
+
+
+def _paragraphs(count=150, seed=1):
+    rng = random.Random(seed)
+    sentence = lambda: " ".join(rng.choices(WORDS, k=rng.randint(8, 30))).capitalize() + "."
+    return [" ".join(sentence() for _ in range(rng.randint(3, 9))) for _ in range(count)]
+
+
+def _hashes(text):
+    return [span.hash for span in iter_text_spans(text, chunk_size=1000, chunk_overlap=100, unit="words")]
+
+
+def test_spans_respect_size_and_cover_the_text():
+    text = "\n\n".join(_paragraphs())
+    spans = list(iter_text_spans(text, chunk_size=300, chunk_overlap=30, unit="words"))
+    assert all(len(span.text.split()) <= 300 for span in spans)
+    assert spans[0].start == 0 and spans[-1].end == len(text.rstrip())
+    # Sin huecos: cada fragmento empieza antes de que acabe el anterior (superposición) o justo después.
+    for previous, current in zip(spans, spans[1:]):
+        assert current.start <= previous.end + 2
+        assert span_text_is_slice(text, current)
+
+
+def span_text_is_slice(text, span):
+    return span.text == text[span.start:span.end] and span.hash == content_hash(span.text)
+
+
+def test_deleting_a_sentence_only_changes_nearby_chunks():
+    paragraphs = _paragraphs()
+    text = "\n\n".join(paragraphs)
+    before = _hashes(text)
+    for index in (20, 75, 130):
+        sentence = paragraphs[index].split(". ")[1] + ". "
+        after = _hashes(text.replace(sentence, "", 1))
+        assert len(set(after) - set(before)) <= 3, f"{len(before)} fragmentos, edición en el párrafo {index}"
+
+
+def test_pdf_edit_only_changes_chunks_of_that_page():
+    rng = random.Random(2)
+    pages = [(number, "\n".join(" ".join(rng.choices(WORDS, k=12)) + "." for _ in range(50))) for number in range(1, 31)]
+    before = [(content_hash(chunk), metadata["page_start"]) for chunk, metadata in iter_pdf_chunks(pages)]
+    edited = list(pages)
+    edited[3] = (4, edited[3][1].replace(" ", " dos palabras ", 1))
+    after = [(content_hash(chunk), metadata["page_start"]) for chunk, metadata in iter_pdf_chunks(edited)]
+    changed = set(after) - set(before)
+    assert changed and {page for _, page in changed} == {4}
+
+
+def test_extract_chunks_text_offsets():
+    text = "Primera frase del documento. Segunda frase.\n\nOtro párrafo."
+    chunks = extract_chunks((text.encode("utf-8"), ".txt"), chunk_size=1000, chunk_overlap=100)
+    assert [(chunk, metadata) for chunk, metadata in chunks] == [(text, {"char_start": 0, "char_end": len(text)})]
+
+
+def _pdf_bytes(page_count):
+    import pypdf
+    writer = pypdf.PdfWriter()
+    for _ in range(page_count):
+        writer.add_blank_page(width=72, height=72)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def test_pdf_pages_are_read_inline_inside_a_worker_process(monkeypatch):
+    import doc_processor
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("no se debe abrir un pool de procesos anidado")
+
+    monkeypatch.setattr(doc_processor, "ProcessPoolExecutor", no_pool)
+    monkeypatch.setattr(doc_processor.multiprocessing, "parent_process", lambda: object())
+    pages = list(doc_processor.iter_pdf_pages(_pdf_bytes(doc_processor.PDF_PARALLEL_MIN_PAGES + 5), max_workers=4))
+    assert [number for number, _ in pages] == list(range(1, doc_processor.PDF_PARALLEL_MIN_PAGES + 6))
+
+
+def test_pdf_from_a_file_like_object_is_parsed_once_and_left_open(monkeypatch):
+    import doc_processor
+
+    readers = []
+    real_reader = doc_processor.pypdf.PdfReader
+
+    def counting_reader(*args, **kwargs):
+        readers.append(args)
+        return real_reader(*args, **kwargs)
+
+    monkeypatch.setattr(doc_processor.pypdf, "PdfReader", counting_reader)
+    stream = io.BytesIO(_pdf_bytes(45))
+    assert doc_processor.read_text_from_file(stream, extension=".pdf") == ""
+    assert not stream.closed and len(readers) == 1
+
+
+def test_blank_text_yields_no_chunks():
+    for text in ("", "   ", "\n\n\t \n", "\u00a0\n\n  \n\n"):
+        assert list(iter_text_spans(text, chunk_size=50, chunk_overlap=10)) == []
+    # Los saltos de párrafo repetidos entre frases tampoco generan fragmentos vacíos.
+    assert [span.text for span in iter_text_spans("Hola.\n\n   \n\nAdiós.", chunk_size=1, chunk_overlap=0)] == ["Hola.", "Adiós."]
+    assert extract_chunks((b"  \n\n  ", ".txt")) == []
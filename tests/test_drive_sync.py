@@ -0,0 +1,118 @@
+from conftest import FakeDrive, FakeKnowledgeBase, drive_file
+
+
+def _tree():
+    # root/ -> doc2, carpeta f1/ -> doc1
+    return FakeDrive([drive_file("doc1", "Documento en una subcarpeta.", parent="f1"),
+                      drive_file("doc2", "Documento en la raíz.")],
+                     folders={"f1": "root"})
+
+
+def test_partial_listing_keeps_folder_map_and_page_token(make_agent):
+    drive = _tree()
+    knowledge_base = FakeKnowledgeBase()
+    agent = make_agent(drive, knowledge_base)
+    agent.populate_knowledge_base()
+    assert agent.manifest.get_state("folders") == {"f1": "root"}
+
+    # Un populate con el listado de la raíz fallido no debe dejar un árbol ni un token incompletos...
+    drive.failed_folders = {"root"}
+    drive.page_token = "token-2"
+    agent.populate_knowledge_base()
+    assert agent.manifest.get_state("folders") == {"f1": "root"}
+    assert agent.manifest.get_state("changes_page_token") == "token-1"
+
+    # ...así que la siguiente sincronización incremental, sin cambios en Drive, no purga nada.
+    drive.failed_folders = set()
+    agent.check_for_updates()
+    assert knowledge_base.get_all_file_ids() == {"doc1", "doc2"}
+    assert agent.manifest.file_ids() == {"doc1", "doc2"}
+
+
+def test_out_of_tree_purge_needs_a_complete_folder_map(make_agent):
+    drive = _tree()
+    drive.failed_folders = {"root"}
+    knowledge_base = FakeKnowledgeBase()
+    agent = make_agent(drive, knowledge_base)
+    agent.populate_knowledge_base()
+
+    # Sin un listado completo nunca se ha guardado un árbol fiable: la sincronización no purga por carpeta.
+    agent.manifest.record(drive.files["doc1"], [])
+    agent.manifest.set_state("changes_page_token", "token-1")
+    agent.check_for_updates()
+    assert "doc1" in agent.manifest.file_ids()
+
+
+def test_changes_purge_trashed_and_moved_files(make_agent):
+    drive = _tree()
+    knowledge_base = FakeKnowledgeBase()
+    agent = make_agent(drive, knowledge_base)
+    agent.populate_knowledge_base()
+
+    moved = dict(drive.files["doc2"], parents=["otra-carpeta"])
+    drive.changes = [{"fileId": "doc1", "removed": False, "file": dict(drive.files["doc1"], trashed=True)},
+                     {"fileId": "doc2", "removed": False, "file": moved}]
+    agent.check_for_updates()
+    assert knowledge_base.get_all_file_ids() == set()
+    assert agent.manifest.file_ids() == set()
+
+
+def test_changes_index_modified_files(make_agent):
+    drive = _tree()
+    knowledge_base = FakeKnowledgeBase()
+    agent = make_agent(drive, knowledge_base)
+    agent.populate_knowledge_base()
+
+    modified = drive_file("doc2", "Documento en la raíz, ahora con otro texto.", modified="2026-02-01T00:00:00Z")
+    drive.files["doc2"] = modified
+    drive.changes = [{"fileId": "doc2", "removed": False, "file": modified}]
+    agent.check_for_updates()
+    assert agent.manifest.is_unchanged(modified)
+    contents = [content for content, metadata in knowledge_base.chunks.values() if metadata["file_id"] == "doc2"]
+    assert contents == ["Documento en la raíz, ahora con otro texto."]
+
+
+def _two_folder_tree():
+    # root/ -> carpeta f1/ -> doc1, carpeta f2/ (vacía)
+    return FakeDrive([drive_file("doc1", "Documento que cambia de carpeta.", parent="f1")],
+                     folders={"f1": "root", "f2": "root"})
+
+
+def _trash_folder(drive, folder_id):
+    folder = {"id": folder_id, "name": folder_id, "mimeType": "application/vnd.google-apps.folder",
+              "parents": [drive.folders.pop(folder_id)], "trashed": True}
+    drive.changes = [{"fileId": folder_id, "removed": False, "file": folder}]
+
+
+def test_file_moved_by_a_change_survives_trashing_its_old_folder(make_agent):
+    drive = _two_folder_tree()
+    knowledge_base = FakeKnowledgeBase()
+    agent = make_agent(drive, knowledge_base)
+    agent.populate_knowledge_base()
+
+    # Mover un archivo no cambia su contenido: el manifiesto debe quedarse con la carpeta nueva.
+    drive.files["doc1"]["parents"] = ["f2"]
+    drive.changes = [{"fileId": "doc1", "removed": False, "file": dict(drive.files["doc1"])}]
+    agent.check_for_updates()
+    assert agent.manifest.get("doc1")["parents"] == ["f2"]
+
+    _trash_folder(drive, "f1")
+    agent.check_for_updates()
+    assert knowledge_base.get_all_file_ids() == {"doc1"}
+    assert agent.manifest.file_ids() == {"doc1"}
+
+
+def test_file_moved_before_a_full_listing_survives_trashing_its_old_folder(make_agent):
+    drive = _two_folder_tree()
+    knowledge_base = FakeKnowledgeBase()
+    agent = make_agent(drive, knowledge_base)
+    agent.populate_knowledge_base()
+
+    drive.files["doc1"]["parents"] = ["f2"]
+    agent.populate_knowledge_base()
+    assert agent.manifest.get("doc1")["parents"] == ["f2"]
+
+    _trash_folder(drive, "f1")
+    agent.check_for_updates()
+    assert knowledge_base.get_all_file_ids() == {"doc1"}
+    assert agent.manifest.file_ids() == {"doc1"}
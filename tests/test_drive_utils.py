@@ -0,0 +1,81 @@
+import drive_utils
+
+THREAD_HTTP = object()
+
+
+class FakeRequest:
+    def __init__(self, service, kind, **kwargs):
+        self.service = service
+        self.kind = kind
+        self.kwargs = kwargs
+
+    def execute(self, http=None):
+        self.service.executed.append((self.kind, http))
+        return self.service.responses[self.kind].pop(0)
+
+
+class FakeBatch:
+    def __init__(self, service):
+        self.service = service
+        self.requests = []
+
+    def add(self, request, callback):
+        self.requests.append((request, callback))
+
+    def execute(self, http=None):
+        self.service.batches.append((len(self.requests), http))
+        for number, (request, callback) in enumerate(self.requests):
+            file_id = request.kwargs['fileId']
+            if file_id in self.service.failing_ids:
+                callback(str(number), None, RuntimeError("403 sin acceso"))
+            else:
+                callback(str(number), {'permissions': [{'id': f"p-{file_id}", 'role': 'reader'}]}, None)
+
+
+class FakeService:
+    """Just enough of the Drive v3 client for the permissions and changes helpers."""
+
+    def __init__(self, responses=None, failing_ids=()):
+        self.responses = responses or {}
+        self.failing_ids = set(failing_ids)
+        self.executed = []
+        self.batches = []
+
+    def permissions(self):
+        return self
+
+    def changes(self):
+        return self
+
+    def list(self, **kwargs):
+        return FakeRequest(self, 'permissions' if 'fileId' in kwargs else 'changes', **kwargs)
+
+    def getStartPageToken(self):
+        return FakeRequest(self, 'start')
+
+    def new_batch_http_request(self):
+        return FakeBatch(self)
+
+
+def test_batch_list_permissions_uses_one_round_trip_per_hundred_files(monkeypatch):
+    monkeypatch.setattr(drive_utils, "get_thread_http", lambda service: THREAD_HTTP)
+    service = FakeService(failing_ids={"f7"})
+    file_ids = [f"f{n}" for n in range(150)]
+
+    permissions = drive_utils.batch_list_permissions(service, file_ids)
+    assert service.batches == [(100, THREAD_HTTP), (50, THREAD_HTTP)]
+    assert set(permissions) == set(file_ids) - {"f7"}
+    assert permissions["f3"] == [{'id': "p-f3", 'role': 'reader'}]
+
+
+def test_changes_api_calls_use_the_thread_http_client(monkeypatch):
+    monkeypatch.setattr(drive_utils, "get_thread_http", lambda service: THREAD_HTTP)
+    service = FakeService(responses={
+        'start': [{'startPageToken': "t1"}],
+        'changes': [{'changes': [{'fileId': "a"}], 'nextPageToken': "t2"},
+                    {'changes': [{'fileId': "b"}], 'newStartPageToken': "t3"}],
+    })
+
+    assert drive_utils.get_changes_start_page_token(service) == "t1"
+    assert drive_utils.list_drive_changes(service, "t1") == ([{'fileId': "a"}, {'fileId': "b"}], "t3")
+    assert service.executed == [('start', THREAD_HTTP), ('changes', THREAD_HTTP), ('changes', THREAD_HTTP)]
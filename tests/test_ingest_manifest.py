@@ -0,0 +1,41 @@
+import json
+
+from ingest_manifest import IngestManifest, MANIFEST_VERSION
+
+
+def _file(file_id="f1", modified="2026-01-01T00:00:00Z", md5="abc"):
+    return {'id': file_id, 'name': f"{file_id}.pdf", 'mimeType': 'application/pdf', 'modifiedTime': modified,
+            'md5Checksum': md5, 'parents': ["root"]}
+
+
+def test_round_trip_and_change_detection(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    manifest = IngestManifest(path)
+    manifest.record(_file(), ["f1-0", "f1-1"])
+    manifest.set_state('changes_page_token', "token-7")
+    manifest.save()
+
+    reloaded = IngestManifest(path)
+    assert reloaded.get_state('changes_page_token') == "token-7"
+    assert reloaded.is_unchanged(_file())
+    assert not reloaded.is_unchanged(_file(modified="2026-02-01T00:00:00Z"))
+    assert not reloaded.is_unchanged(_file(md5="def"))
+    assert not reloaded.is_unchanged(_file("f2"))
+    assert reloaded.remove("f1") == ["f1-0", "f1-1"] and reloaded.file_ids() == set()
+
+
+def test_incomplete_file_is_reindexed(tmp_path):
+    manifest = IngestManifest(str(tmp_path / "manifest.json"))
+    manifest.record(_file(), ["f1-0"], complete=False)
+    assert not manifest.is_unchanged(_file())
+    assert manifest.get("f1")["chunk_ids"] == ["f1-0"]
+
+
+def test_corrupt_or_incompatible_manifest_starts_empty(tmp_path):
+    corrupt = tmp_path / "corrupt.json"
+    corrupt.write_text("{no es json", encoding="utf-8")
+    assert IngestManifest(str(corrupt)).files == {}
+
+    old = tmp_path / "old.json"
+    old.write_text(json.dumps({"version": MANIFEST_VERSION + 1, "files": {"f1": {}}, "state": {}}), encoding="utf-8")
+    assert IngestManifest(str(old)).files == {}
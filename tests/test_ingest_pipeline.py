@@ -0,0 +1,31 @@
+import pytest
+
+from ingest_pipeline import process_files_concurrently
+
+
+def _download(file):
+    if file == "roto":
+        raise IOError("descarga fallida")
+    return file.upper()
+
+
+def test_yields_every_file_with_per_file_errors():
+    results = {file: (result, error) for file, result, error in
+               process_files_concurrently(["a", "roto", "b"], _download, str.lower, download_workers=2, extract_workers=0)}
+    assert results["a"] == ("a", None)
+    assert results["b"] == ("b", None)
+    assert results["roto"][0] is None and isinstance(results["roto"][1], IOError)
+
+
+def test_listing_error_is_reraised_after_submitted_files():
+    def listing():
+        yield "a"
+        yield "b"
+        raise ConnectionError("Drive dejó de responder")
+
+    seen = []
+    with pytest.raises(ConnectionError):
+        for file, result, error in process_files_concurrently(listing(), _download, str.lower,
+                                                              download_workers=2, extract_workers=0):
+            seen.append(file)
+    assert sorted(seen) == ["a", "b"]
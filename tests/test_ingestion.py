@@ -0,0 +1,85 @@
+from conftest import FakeDrive, FakeKnowledgeBase, drive_file
+
+
+def test_populate_indexes_new_files_and_skips_unchanged(make_agent):
+    drive = FakeDrive([drive_file("doc1", "Primer documento."), drive_file("doc2", "Segundo documento.")])
+    knowledge_base = FakeKnowledgeBase()
+    agent = make_agent(drive, knowledge_base)
+
+    agent.populate_knowledge_base()
+    assert knowledge_base.get_all_file_ids() == {"doc1", "doc2"}
+    assert agent.manifest.file_ids() == {"doc1", "doc2"}
+
+    version = knowledge_base.version
+    agent.populate_knowledge_base()
+    assert knowledge_base.version == version  # nada que escribir ni borrar
+
+
+def test_failed_chunk_write_is_not_recorded_as_indexed(make_agent):
+    doc2 = drive_file("doc2", "Segundo documento.")
+    drive = FakeDrive([drive_file("doc1", "Primer documento."), doc2])
+    knowledge_base = FakeKnowledgeBase(failing_file_ids={"doc2"})
+    agent = make_agent(drive, knowledge_base)
+
+    agent.populate_knowledge_base()
+    assert not agent.manifest.is_unchanged(doc2)
+    assert agent.manifest.get("doc2")["chunk_ids"] == []
+    assert set(agent.manifest.get_state("pending_files")) == {"doc2"}
+    assert knowledge_base.get_all_file_ids() == {"doc1"}
+
+    # Cuando ChromaDB vuelve a aceptar escrituras, el archivo se reintenta.
+    knowledge_base.failing_file_ids.clear()
+    agent.populate_knowledge_base()
+    assert agent.manifest.is_unchanged(doc2)
+    assert knowledge_base.get_all_file_ids() == {"doc1", "doc2"}
+    assert set(agent.manifest.get("doc2")["chunk_ids"]) == set(knowledge_base.chunks) - set(agent.manifest.get("doc1")["chunk_ids"])
+
+
+def test_interrupted_listing_does_not_purge(make_agent):
+    drive = FakeDrive([drive_file("doc1", "Primer documento."), drive_file("doc2", "Segundo documento.")])
+    knowledge_base = FakeKnowledgeBase()
+    agent = make_agent(drive, knowledge_base)
+    agent.populate_knowledge_base()
+
+    drive.fail_listing_after = 1
+    agent.populate_knowledge_base()
+    assert knowledge_base.get_all_file_ids() == {"doc1", "doc2"}
+    assert agent.manifest.file_ids() == {"doc1", "doc2"}
+
+
+def test_interrupted_listing_still_indexes_what_was_listed(make_agent):
+    drive = FakeDrive([drive_file("doc1", "Primer documento."), drive_file("doc2", "Segundo documento.")])
+    drive.fail_listing_after = 1
+    knowledge_base = FakeKnowledgeBase()
+    agent = make_agent(drive, knowledge_base)
+
+    agent.populate_knowledge_base()
+    assert knowledge_base.get_all_file_ids() == {"doc1"}
+    assert agent.manifest.file_ids() == {"doc1"}
+
+
+def test_modified_file_only_rewrites_the_chunks_around_the_edit(make_agent):
+    sentences = [f"La reunión número {n} revisó el contrato {n * 7} con el cliente {n % 13} y fijó la entrega." for n in range(400)]
+    text = " ".join(sentences)
+    drive = FakeDrive([drive_file("doc1", text)])
+    knowledge_base = FakeKnowledgeBase()
+    agent = make_agent(drive, knowledge_base)
+    agent.populate_knowledge_base()
+    before = set(knowledge_base.chunks)
+    assert len(before) > 10
+
+    written = []
+    upsert = knowledge_base.upsert_documents
+
+    def recording_upsert(batch, failed_ids=None):
+        written.extend(chunk['id'] for chunk in batch)
+        return upsert(batch, failed_ids)
+
+    knowledge_base.upsert_documents = recording_upsert
+    drive.files["doc1"] = drive_file("doc1", text.replace(sentences[200] + " ", ""), modified="2026-02-01T00:00:00Z")
+    agent.populate_knowledge_base()
+
+    after = set(knowledge_base.chunks)
+    assert 0 < len(written) <= 3 and set(written) == after - before
+    assert len(before - after) <= 3
+    assert set(agent.manifest.get("doc1")["chunk_ids"]) == after
@@ -0,0 +1,101 @@
+import zlib
+
+import pytest
+from chromadb.api.client import SharedSystemClient
+
+import knowledge_base
+from knowledge_base import KnowledgeBase
+
+DIM = 64
+
+
+class HashingEngine:
+    """Deterministic bag-of-words embeddings, so the KnowledgeBase runs without downloading a model."""
+
+    name = "tests/hashing"
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, texts):
+        self.calls += 1
+        vectors = []
+        for text in texts:
+            vector = [0.0] * DIM
+            for word in text.lower().split():
+                vector[zlib.crc32(word.encode()) % DIM] += 1.0
+            norm = sum(value * value for value in vector) ** 0.5 or 1.0
+            vectors.append([value / norm for value in vector])
+        return vectors
+
+
+@pytest.fixture
+def kb(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # ChromaDB reutiliza el cliente por ruta ('./chroma_db'), que aquí cambia de directorio en cada test.
+    SharedSystemClient.clear_system_cache()
+    yield KnowledgeBase(collection_name="tests_docs", embedding_engine=HashingEngine())
+    SharedSystemClient.clear_system_cache()
+
+
+def _chunk(chunk_id, content, file_id="f1"):
+    return {'id': chunk_id, 'content': content, 'metadata': {'file_id': file_id, 'file_name': f"{file_id}.txt"}}
+
+
+def test_uses_the_selected_engine_for_documents_and_queries(kb):
+    assert kb.is_functional
+    assert kb.embedding_cache.model_name == "tests/hashing"
+    kb.upsert_documents([_chunk("a", "factura del cliente pendiente"), _chunk("b", "reunión del equipo el lunes")])
+    kb.add_document("c", "plazo de entrega del proyecto", {'file_id': 'f2', 'file_name': 'f2.txt'})
+    kb.update_document("b", "reunión del equipo el martes", {'file_id': 'f1', 'file_name': 'f1.txt'})
+    results = kb.query("reunión del equipo martes", n_results=1)
+    assert results['ids'] == [["b"]]
+    assert kb.collection.get(ids=["c"], include=["embeddings"])['embeddings'] is not None
+
+
+def test_falls_back_to_sentence_transformers_when_the_engine_fails(monkeypatch):
+    built = []
+
+    def create(engine_name, batch_size):
+        built.append(engine_name)
+        if engine_name == "onnx":
+            raise ImportError("onnxruntime no instalado")
+        return HashingEngine()
+
+    monkeypatch.setattr(knowledge_base, "create_embedding_engine", create)
+    engine = KnowledgeBase._create_embedding_engine("onnx", 32)
+    assert isinstance(engine, HashingEngine) and built == ["onnx", "sentence-transformers"]
+
+
+def test_delete_file_removes_only_that_files_chunks(kb):
+    kb.upsert_documents([_chunk("a", "uno"), _chunk("b", "dos"), _chunk("c", "tres", file_id="f2")])
+    assert kb.get_all_file_ids() == {"f1", "f2"}
+    assert kb.delete_file("f1") == 2
+    assert kb.collection.get()['ids'] == ["c"]
+
+
+def test_merge_results_fuses_rankings_with_rrf_and_deduplicates(kb):
+    def result(*chunk_ids):
+        return {'ids': [list(chunk_ids)], 'documents': [[f"texto {chunk_id}" for chunk_id in chunk_ids]],
+                'metadatas': [[{'file_id': chunk_id} for chunk_id in chunk_ids]]}
+
+    merged = kb.merge_results([result("a", "b", "c"), result("b", "d"), {}], limit=3)
+    # 'b' aparece en las dos listas y supera al primero de una sola; 'a' y 'd' empatan pero 'a' llega antes.
+    assert merged['ids'] == [["b", "a", "d"]]
+    assert merged['documents'] == [["texto b", "texto a", "texto d"]]
+    assert merged['scores'][0][0] == 1 / 62 + 1 / 61
+
+
+def test_hybrid_query_fetches_lexical_hits_and_drops_stale_ids(kb):
+    kb.upsert_documents([_chunk("a", "factura del cliente"), _chunk("b", "presupuesto anual del proyecto")])
+    kb.lexical_index.add(["borrado"], ["presupuesto de un documento eliminado"])
+    results = kb.query("presupuesto", n_results=2, mode="hybrid")
+    assert "b" in results['ids'][0] and "borrado" not in results['ids'][0]
+    assert results['documents'][0][results['ids'][0].index("b")] == "presupuesto anual del proyecto"
+
+
+def test_repeated_queries_reuse_the_cached_embedding(kb):
+    kb.embed_queries(["¿Quién es el CEO?"])
+    calls = kb.embedding_engine.calls
+    kb.embed_queries(["¿quién es  el CEO?", "¿Quién es el CEO?"])
+    assert kb.embedding_engine.calls == calls and kb.query_cache_stats()['hits'] == 2
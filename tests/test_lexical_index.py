@@ -0,0 +1,44 @@
+from lexical_index import LexicalIndex, normalize_tokens
+
+
+def _index(tmp_path):
+    return LexicalIndex(path=str(tmp_path / "lexical.pkl"))
+
+
+def test_normalize_tokens_folds_accents_stopwords_and_plurals():
+    assert normalize_tokens("Las reuniones con los Clientes") == normalize_tokens("reunión cliente")
+    assert normalize_tokens("la información del país") == ["informacion", "pais"]
+
+
+def test_search_ranks_by_bm25(tmp_path):
+    index = _index(tmp_path)
+    index.add(["a", "b", "c"], ["factura del cliente factura pendiente", "reunión con el cliente",
+                                "informe anual de ventas y gastos del equipo comercial"])
+    assert [chunk_id for chunk_id, _ in index.search("facturas")] == ["a"]
+    assert [chunk_id for chunk_id, _ in index.search("cliente factura")] == ["a", "b"]
+    assert index.search("palabra desconocida") == []
+    assert index.term_coverage("factura desconocida") == 0.5
+
+
+def test_replaced_and_deleted_chunks_are_not_returned(tmp_path):
+    index = _index(tmp_path)
+    index.add(["a", "b"], ["presupuesto del proyecto", "presupuesto anual"])
+    index.add(["a"], ["calendario del proyecto"])
+    index.delete(["b"])
+    assert index.search("presupuesto") == []
+    assert [chunk_id for chunk_id, _ in index.search("calendario")] == ["a"] and len(index) == 1
+
+
+def test_compaction_keeps_results(tmp_path):
+    index = _index(tmp_path)
+    index.add([f"d{n}" for n in range(2000)], [f"documento numero{n} contrato" for n in range(2000)])
+    index.delete([f"d{n}" for n in range(1000)])
+    assert index.deleted == 0 and len(index.doc_ids) == 1000
+    assert [chunk_id for chunk_id, _ in index.search("numero1500")] == ["d1500"]
+
+
+def test_save_and_load(tmp_path):
+    index = _index(tmp_path)
+    index.add(["a"], ["contrato de servicio"])
+    index.save(force=True)
+    assert [chunk_id for chunk_id, _ in _index(tmp_path).search("contratos")] == ["a"]
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from rate_limiter import GeminiRateLimiter, RateLimitTimeout, estimate_tokens, is_rate_limit_error
+
+
+class QuotaError(Exception):
+    pass
+
+
+def test_rate_limit_errors_are_recognised():
+    assert is_rate_limit_error(QuotaError("429 Resource exhausted: quota exceeded"))
+    assert is_rate_limit_error(RateLimitTimeout("sin cupo"))
+    assert not is_rate_limit_error(ValueError("500 internal error"))
+    assert estimate_tokens(["a" * 40, "b" * 40]) == 20
+
+
+def test_retries_after_a_429():
+    limiter = GeminiRateLimiter(rpm=600, tpm=10 ** 6, backoff_base=0.05, backoff_max=0.05)
+    attempts = []
+
+    def flaky():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise QuotaError("429 quota exceeded, retry_delay { seconds: 0 }")
+        return "ok"
+
+    assert limiter.call(flaky, "hola") == "ok"
+    assert len(attempts) == 2 and limiter.stats()["rate_limited"] == 1 and limiter.active == 0
+
+
+def test_other_errors_are_not_retried():
+    limiter = GeminiRateLimiter()
+
+    def broken():
+        raise ValueError("prompt inválido")
+
+    with pytest.raises(ValueError):
+        limiter.call(broken, "hola")
+    assert limiter.stats()["calls"] == 1 and limiter.active == 0
+
+
+def test_interactive_stage_overtakes_queued_background_calls():
+    limiter = GeminiRateLimiter(max_concurrency=1, queue_timeout=5)
+    limiter.acquire("synthesis")
+    order = []
+
+    def worker(stage):
+        limiter.acquire(stage)
+        order.append(stage)
+        limiter.release()
+
+    threads = [threading.Thread(target=worker, args=(stage,)) for stage in ("summarization", "routing", "synthesis")]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)  # todas en cola antes de liberar el hueco
+    limiter.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == ["synthesis", "routing", "summarization"]
+
+
+def test_queue_timeout_raises():
+    limiter = GeminiRateLimiter(max_concurrency=1, queue_timeout=0.1)
+    limiter.acquire()
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire()
+    assert limiter.stats()["timeouts"] == 1 and limiter.stats()["queue_depth"] == 0
+
+
+def test_cancelled_async_waiter_gives_its_slot_back():
+    limiter = GeminiRateLimiter(max_concurrency=1, queue_timeout=5)
+
+    async def run():
+        limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire_async("routing"))
+        await asyncio.sleep(0.05)
+        waiter.cancel()
+        limiter.release()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        # El hilo que esperaba obtiene el hueco y lo devuelve en cuanto ve la cancelación.
+        for _ in range(200):
+            if limiter.calls == 2 and limiter.active == 0:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert limiter.calls == 2 and limiter.active == 0